@@ -1,10 +1,11 @@
 import argparse
+import json
 import os
 import traceback
 import uuid
 import requests
 
-from threading import Thread
+from threading import Thread, Event
 from multiprocessing import Queue
 from dvic_demo_cli.utils.crypto import CryptClient
 from dvic_demo_cli.interactive_session import InteractiveSession
@@ -29,7 +30,9 @@ class DVICDemoWatcherCli(DVICDemoWatcherCliBase):
         super().__init__()
         self.uid = os.environ.get("DEMO_WATCHER_UID") or DEFAULT_UID
         self.send_queue = Queue()
+        self.binary = False # binary codec negotiated with the server, JSON otherwise
         self.sessions: dict[str, InteractiveSession] = {}
+        self.queries: dict[str, tuple[PacketQuery, Event]] = {} # request id -> (first page request, set after the last page)
         self.config: CliConfig = None
         self.load_config(cfg_location)
         self.connect()
@@ -53,7 +56,8 @@ class DVICDemoWatcherCli(DVICDemoWatcherCliBase):
 
         # 2. ws creation
         print(f'[CONNECTION] Connection to {self.url}')
-        self.ws: WebSocket = create_connection(f'{self.url}{token}')
+        self.ws: WebSocket = create_connection(f'{self.url}{token}', subprotocols=SUBPROTOCOLS)
+        self.binary = self.ws.getsubprotocol() == SUBPROTOCOL_BINARY
 
         # 3. Start threads
         Thread(target=self._packet_reception_thread_target, daemon=True).start()
@@ -84,16 +88,36 @@ class DVICDemoWatcherCli(DVICDemoWatcherCliBase):
         while True:
             try:
                 pck: Packet = self.send_queue.get()
-                self.ws.send(pck.encode())
+                if self.binary: self.ws.send_binary(pck.encode_binary())
+                else: self.ws.send(pck.encode())
             except:
                 traceback.print_exc()
 
     def request_node_list(self):
         self.send_packet(PacketNodeStatus(action=NodeStatusAction.LIST_NODES))
 
+    def watch_nodes(self):
+        '''Subscribe to the node status: a snapshot, then the changes as they happen'''
+        self.send_packet(PacketNodeStatus(action=NodeStatusAction.SUBSCRIBE))
+
+    def tail_logs(self, nodes: list[str] = None, kinds: list[str] = None, names: list[str] = None, regex: str = None) -> str:
+        '''Subscribe to the live logs matching the filters (None matches everything), returns the subscription id'''
+        subscription_id = str(uuid.uuid4())
+        self.send_packet(PacketLogSubscription(LogSubscriptionAction.SUBSCRIBE, subscription_id, nodes, kinds, names, regex))
+        return subscription_id
+
+    def query(self, index: str, filters: dict = None, fields: list[str] = None, size: int = 500, descending: bool = False) -> Event:
+        '''Print the stored documents of `index` matching the filters (see PacketQuery) as JSON lines, one page at a time.
+        Returns an event set once the last page was printed'''
+        request = PacketQuery(str(uuid.uuid4()), index, filters, fields, size, descending=descending)
+        done = Event()
+        self.queries[request.request_id] = (request, done)
+        self.send_packet(request)
+        return done
+
     def receive_packet(self, pck: Packet):
         try:
-            getattr(self, f'_handle_packet_{pck.identifier}')(pck)
+            self.HANDLERS[pck.identifier](self, pck)
         except:
             traceback.print_exc()
 
@@ -124,8 +148,44 @@ class DVICDemoWatcherCli(DVICDemoWatcherCliBase):
             print(pck.value.decode('utf-8'), end="", flush=True) #FIXME multi session handlign should come here
 
     def _handle_packet_node_status(self, pck: PacketNodeStatus):
-        print(pck.node_status)
+        if pck.action == NodeStatusAction.DELTA:
+            for uid, change in pck.node_status.items(): print(f'[NODES] {uid}: {change}')
+        else: print(pck.node_status)
+
+    def _handle_packet_heartbeat(self, pck: PacketHeartbeat):
+        self.send_packet(pck) # liveness probe of the server, sent back as is
+
+    def _handle_packet_retry_after(self, pck: PacketRetryAfter):
+        print(f'[CONNECTION] Server busy ({pck.reason.value}), retry in {pck.delay:.0f}s')
+
+    def _handle_packet_session_ticket(self, pck: PacketSessionTicket):
+        pass # the cli connects once per run, nothing to resume
+
+    def _handle_packet_resume(self, pck: PacketResume):
+        pass # resumption offer, left unanswered: the cli connection stays unsequenced
+
+    def _handle_packet_ack(self, pck: PacketAck):
+        pass
+
+    def _handle_packet_log_entry(self, pck: PacketLogEntry):
+        print(f'[{pck.node}] {pck.name}: {pck.log}', end="" if pck.log.endswith('\n') else "\n", flush=True)
 
+    def _handle_packet_log_subscription(self, pck: PacketLogSubscription):
+        if pck.action == LogSubscriptionAction.REJECTED: print(f'[TAIL] Subscription rejected by the server (invalid filter)')
+        elif pck.action == LogSubscriptionAction.SHED: print(f'[TAIL] Subscription dropped by the server, the client did not keep up')
+
+    def _handle_packet_query(self, pck: PacketQuery):
+        if pck.request_id not in self.queries: return
+        request, done = self.queries[pck.request_id]
+        if pck.error is not None: print(f'[QUERY] {pck.error}')
+        for hit in pck.hits or (): print(json.dumps(hit), flush=True)
+        if pck.error is None and pck.next_cursor is not None: # next page only once this one is printed
+            self.send_packet(PacketQuery(request.request_id, request.index, request.filters, request.fields, request.size, pck.next_cursor, request.descending))
+            return
+        del self.queries[pck.request_id]
+        done.set()
+
+DVICDemoWatcherCli.HANDLERS = handler_table(DVICDemoWatcherCli, prefix='_handle_packet_')
 
 def main():
     parser = argparse.ArgumentParser()
@@ -135,6 +195,18 @@ def main():
     parser.add_argument("--join", type=str)
     parser.add_argument("--script", type=str)
     parser.add_argument("--config", "-c", type=str, default=DEFAULT_CONFIG_LOCATION)
+    parser.add_argument("--watch", action="store_true", help="print the node status, then its changes")
+    parser.add_argument("--tail", action="store_true", help="print the live logs matching --node, --kind, --name and --grep")
+    parser.add_argument("--node", type=str, action="append", help="node uid, repeatable")
+    parser.add_argument("--kind", type=str, action="append", help="file or journal, repeatable")
+    parser.add_argument("--name", type=str, action="append", help="log file path or systemd unit, repeatable")
+    parser.add_argument("--grep", type=str, help="regex searched in the log lines")
+    parser.add_argument("--query", type=str, metavar="INDEX", help="print the stored documents of an index (machine_logs, machine_hardware_state, ...) matching --node, --kind, --name, --text, --start and --end")
+    parser.add_argument("--text", type=str, help="text searched in the stored log lines")
+    parser.add_argument("--start", type=float, help="seconds since epoch")
+    parser.add_argument("--end", type=float, help="seconds since epoch")
+    parser.add_argument("--fields", type=str, help="comma separated fields of the printed documents")
+    parser.add_argument("--desc", action="store_true", help="newest documents first")
     args = parser.parse_args()
 
     if args.join and args.target:
@@ -150,7 +222,19 @@ def main():
         # cli.request_node_list()
         # input()    
         from pathlib import Path
-        if args.script:
+        if args.watch:
+            cli.watch_nodes()
+            input()
+
+        elif args.tail:
+            cli.tail_logs(args.node, args.kind, args.name, args.grep)
+            input()
+
+        elif args.query:
+            filters = {'nodes': args.node, 'kinds': args.kind, 'names': args.name, 'start': args.start, 'end': args.end, 'text': args.text}
+            cli.query(args.query, filters, args.fields.split(',') if args.fields else None, descending=args.desc).wait()
+
+        elif args.script:
             script = Path(args.script).read_text()
             cli.send_packet(PacketScriptInteractiveSession(script, [args.target]))
             input()
@@ -0,0 +1,48 @@
+'''Reconnection delays of the DVIC node.'''
+
+import random
+from typing import Callable
+
+
+class ReconnectBackoff:
+    '''Decorrelated jitter exponential backoff: every delay is drawn in [base, 3 * previous delay] and capped,
+    so the nodes dropped together by a server restart spread their reconnections instead of coming back in waves.
+    The delay goes back to `base` once a connection stayed up `stable_after` seconds.
+
+        ----- Parameters -----
+        base : float = 1.0
+            Shortest delay in seconds
+        cap : float = 300.0
+            Longest delay in seconds, server hints included
+        stable_after : float = 60.0
+            Seconds a connection has to last to reset the backoff
+        rng : Callable[[], float] = random.random
+            Uniform draws in [0, 1)
+    '''
+    def __init__(self, base: float = 1.0, cap: float = 300.0, stable_after: float = 60.0, rng: Callable[[], float] = random.random) -> None:
+        self.base = base
+        self.cap = cap
+        self.stable_after = stable_after
+        self.rng = rng
+        self.previous = base
+
+    def next(self, connected_for: float = 0.0, hint: float = None) -> float:
+        """Delay before the next connection attempt
+
+        Parameters
+        ----------
+        connected_for : float, optional
+            Duration of the last connection, 0 if the attempt failed
+        hint : float, optional
+            Delay asked by the server (Retry-After), the delay is never shorter
+
+        Returns
+        -------
+        float
+            Seconds to wait
+        """
+        if connected_for >= self.stable_after: self.previous = self.base
+        delay = min(self.cap, self.base + self.rng() * (3 * self.previous - self.base))
+        if hint: delay = min(self.cap, max(delay, hint))
+        self.previous = delay
+        return delay
@@ -0,0 +1,73 @@
+'''Batching stage for the packets sent by the collectors of the DVIC node.'''
+
+import threading
+import time
+import traceback
+from typing import Callable
+
+from client.network.packets import Packet
+
+
+class PacketBatcher:
+    '''Groups bulk packets (log lines, hardware metrics) before they are sent to the server.
+    The pending packets are flushed when `max_packets` are waiting or when the oldest one waited `max_delay` seconds.
+
+        ----- Parameters -----
+        flush_target : Callable[[list[Packet]], None]
+            Called with the pending packets on every flush
+        max_packets : int = 256
+        max_delay : float = 0.5
+    '''
+    def __init__(self, flush_target: Callable[[list[Packet]], None], max_packets: int = 256, max_delay: float = 0.5) -> None:
+        self.flush_target = flush_target
+        self.max_packets = max_packets
+        self.max_delay = max_delay
+        self.pending: list[Packet] = []
+        self.deadline: float = None # flush time of the pending packets
+        self.running = True
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._thread_target, daemon=True)
+        self.thread.start()
+
+    def add(self, pck: Packet) -> None:
+        '''Add a packet to the pending batch, flush right away if the batch is full'''
+        with self.condition:
+            self.pending.append(pck)
+            if len(self.pending) == 1:
+                self.deadline = time.monotonic() + self.max_delay
+                self.condition.notify()
+            if len(self.pending) < self.max_packets: return
+            packets = self._take()
+        self._flush(packets)
+
+    def flush(self) -> None:
+        '''Flush the pending packets now'''
+        with self.condition:
+            packets = self._take()
+        self._flush(packets)
+
+    def stop(self) -> None:
+        '''Flush the pending packets and stop the timer thread'''
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        self.flush()
+
+    def _take(self) -> list[Packet]:
+        packets, self.pending, self.deadline = self.pending, [], None
+        return packets
+
+    def _flush(self, packets: list[Packet]) -> None:
+        if not packets: return
+        try: self.flush_target(packets)
+        except: traceback.print_exc()
+
+    def _thread_target(self) -> None:
+        '''Timer flushing the pending packets once their max delay is reached'''
+        while True:
+            with self.condition:
+                while self.running and (self.deadline is None or self.deadline > time.monotonic()):
+                    self.condition.wait(None if self.deadline is None else self.deadline - time.monotonic())
+                if not self.running: return
+                packets = self._take()
+            self._flush(packets)
@@ -0,0 +1,78 @@
+'''Read positions of the log collectors of the DVIC node, kept across restarts.'''
+
+import json
+import os
+import threading
+import traceback
+from collections import OrderedDict
+from pathlib import Path
+
+from client.network.packets import Packet, PacketBatch, PacketLogEntry
+
+MAX_TRACKED = 4096 # packets waiting for their acknowledgement, the oldest are forgotten beyond (a later one moves the checkpoint)
+
+
+def positions(packets: list[Packet]) -> dict[str, str]:
+    '''Latest position (PacketLogEntry.key) of every source in the packets'''
+    res = {}
+    for pck in packets:
+        for entry in (pck.packets if isinstance(pck, PacketBatch) else (pck,)):
+            if isinstance(entry, PacketLogEntry) and entry.key is not None: res[source(entry.kind, entry.name)] = entry.key
+    return res
+
+def source(kind: str, name: str) -> str:
+    return f'{kind}:{name}'
+
+class CheckpointStore:
+    '''Position of every log source (journal cursor, file inode:generation:offset) up to which the entries are safe: stored in
+    the outbox or acknowledged by the server. Collectors resume from it on startup, the entries read twice are
+    dropped by the server thanks to their key.
+    Packets handed to the websocket are `track`ed, their positions are committed once `confirmed` (PacketAck).
+    The file is rewritten atomically on every commit, so at batch boundaries.
+
+        ----- Parameters -----
+        path : str
+            JSON file of the checkpoints, None to keep them in memory only
+    '''
+    def __init__(self, path: str = None) -> None:
+        self.path = Path(path) if path is not None else None
+        self.lock = threading.Lock()
+        self.checkpoints: dict[str, str] = {}
+        self.tracked: OrderedDict[int, tuple[Packet, dict[str, str]]] = OrderedDict() # id(packet) -> (packet, positions)
+        if self.path is not None and self.path.exists():
+            try: self.checkpoints = json.loads(self.path.read_text())
+            except ValueError: traceback.print_exc()
+
+    def get(self, kind: str, name: str) -> str:
+        with self.lock:
+            return self.checkpoints.get(source(kind, name))
+
+    def commit(self, packets: list[Packet]) -> None:
+        '''The entries of the packets are safe, move the checkpoints of their sources'''
+        self._commit(positions(packets))
+
+    def track(self, pck: Packet) -> None:
+        '''The packet is about to be sent, commit its positions once confirmed'''
+        found = positions([pck])
+        if not found: return
+        with self.lock:
+            self.tracked[id(pck)] = (pck, found) # the reference keeps the id unique
+            while len(self.tracked) > MAX_TRACKED: self.tracked.popitem(last=False)
+
+    def confirmed(self, packets: list[Packet]) -> None:
+        '''The packets reached the server'''
+        found = {}
+        with self.lock:
+            for pck in packets:
+                entry = self.tracked.pop(id(pck), None)
+                if entry is not None: found.update(entry[1])
+        self._commit(found)
+
+    def _commit(self, found: dict[str, str]) -> None:
+        if not found: return
+        with self.lock:
+            self.checkpoints.update(found)
+            if self.path is None: return
+            tmp = self.path.with_name(f'{self.path.name}.tmp')
+            tmp.write_text(json.dumps(self.checkpoints))
+            os.replace(tmp, self.path)
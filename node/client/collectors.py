@@ -6,10 +6,12 @@ from client.dvic_client import DVICClient, AbstractDVICNode
 
 
 import datetime
+import json
 import subprocess
 import threading
 import time
 import os
+import traceback
 
 #################### Only for testing ####################
 import logging
@@ -51,26 +53,114 @@ class DataAggregator(ABC):
         
 
 
+def journal_entry(line: bytes) -> tuple[str, str, float]:
+    '''Log line, cursor and time of an entry of `journalctl -o json`, the line looks like the short output without date and host'''
+    entry = json.loads(line)
+    message = entry.get('MESSAGE') or ''
+    if isinstance(message, list): message = bytes(message).decode(errors='replace') # not valid UTF-8
+    identifier = entry.get('SYSLOG_IDENTIFIER') or entry.get('_COMM', '')
+    if entry.get('_PID'): identifier = f"{identifier}[{entry['_PID']}]"
+    realtime = entry.get('__REALTIME_TIMESTAMP')
+    return f'{identifier}: {message}\n', entry.get('__CURSOR'), int(realtime) / 1e6 if realtime else time.time()
+
+
+class FileFollower:
+    '''Pure python `tail -F` of a log file, every complete line comes with its position `inode:generation:offset`
+    (end of the line). The generation is the time the file was first read from its start, a rotation (new inode) or a
+    truncation (smaller, or its first bytes changed) starts a new one, so a position is never given to two lines.
+    A file truncated and grown past the checkpoint while the node is stopped is not detected.
+
+        ----- Parameters -----
+        path : str
+        checkpoint : str
+            Position to resume from, the end of the file is used if None (only the new lines are read)
+            The file is read from the start if it was rotated since (other inode)
+    '''
+    PREFIX_BYTES = 64 # first bytes compared to detect a rewrite of the file
+
+    def __init__(self, path: str, checkpoint: str = None) -> None:
+        self.path = path
+        self.checkpoint = checkpoint
+        self.file = None
+        self.inode: int = None
+        self.generation: int = None
+        self.offset = 0 # end of the last complete line
+        self.partial = b''
+        self.prefix = b''
+        if not self._open(): self.inode = 0 # created later, read from its start
+
+    def _open(self) -> bool:
+        try: self.file = open(self.path, 'rb')
+        except OSError: return False
+        stat = os.fstat(self.file.fileno())
+        first, self.inode, self.generation, self.offset, self.partial = self.inode is None, stat.st_ino, time.time_ns(), 0, b''
+        if first and self.checkpoint is None: self.offset = stat.st_size
+        elif first:
+            try: inode, generation, offset = (int(v) for v in self.checkpoint.split(':'))
+            except ValueError: inode = None
+            if inode == stat.st_ino and offset <= stat.st_size: self.generation, self.offset = generation, offset
+        self.prefix = os.pread(self.file.fileno(), self.PREFIX_BYTES, 0)
+        self.file.seek(self.offset)
+        return True
+
+    def _truncated(self) -> bool:
+        if os.fstat(self.file.fileno()).st_size < self.offset + len(self.partial): return True
+        prefix = os.pread(self.file.fileno(), self.PREFIX_BYTES, 0)
+        if not prefix.startswith(self.prefix): return True # rewritten, maybe to the same size
+        self.prefix = prefix
+        return False
+
+    def _reopen(self) -> list[tuple[str, str]]:
+        self.close()
+        return self.poll()
+
+    def poll(self) -> list[tuple[str, str]]:
+        '''New complete lines with their positions'''
+        if self.file is None and not self._open(): return []
+        if self._truncated(): return self._reopen()
+        data = self.file.read()
+        if not data:
+            try: stat = os.stat(self.path)
+            except OSError: return [] # rotated, the new file is not there yet
+            return self._reopen() if stat.st_ino != self.inode else []
+        *lines, self.partial = (self.partial + data).split(b'\n')
+        res = []
+        for line in lines:
+            self.offset += len(line) + 1
+            res.append((line.decode(errors='replace') + '\n', f'{self.inode}:{self.generation}:{self.offset}'))
+        return res
+
+    def close(self) -> None:
+        if self.file is not None: self.file.close()
+        self.file = None
+
+
 class LogReader(DataAggregator):
-    '''Class used to handle the log reading
+    '''Class used to handle the log reading, resumed from the checkpoint of the client (if any) after a restart
         ----- Parameters -----
         file_path : str = None
         journal_unit : str = None
     '''
+    POLL_INTERVAL = 0.5
+
     def __init__(self, client : AbstractDVICNode, *, file_path : str = None, journal_unit : str = None) -> None:
         super().__init__(client)
         self.file_path = file_path
         self.journal_unit = journal_unit
+        checkpoints = getattr(client, 'checkpoints', None)
+        self.checkpoint = checkpoints.get(*self._get_reader_type_with_target()) if checkpoints is not None else None
         self.process = self._define_process()
         print("Proc started")
     
     def _define_process(self) -> subprocess.Popen:
-        '''Define the process to use'''
+        '''Define the process to use, None for a file (followed in python)'''
 
         if self.file_path is not None:
-            return subprocess.Popen(['tail', '-f', self.file_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True) #TODO @Matthieu just in case tail is actually not installed, use a pure python logic
+            return None
         elif self.journal_unit is not None:
-            return subprocess.Popen(['journalctl', '-f', '-u', self.journal_unit], stdout=subprocess.PIPE, stderr=subprocess.PIPE) #NOTE journaltcl is installed on all systemd managed machines
+            args = ['journalctl', '-f', '-u', self.journal_unit, '-o', 'json'] #NOTE journaltcl is installed on all systemd managed machines
+            if self.checkpoint is not None: args.append(f'--after-cursor={self.checkpoint}')
+            return subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         else:
             raise Exception('No file path or journal unit specified')
 
@@ -91,23 +181,38 @@ class LogReader(DataAggregator):
         {
             'kind': 'file or systemd' 
             'name' : '/var/log/syslog',
-            'log': value
+            'log': value,
+            'key': 'inode:generation:offset or journal cursor',
+            'timestamp': 'read time of the line or time of the journal entry'
         }
         ```
 
         Where `kind` can be "file" if the log is watching a file or "systemd" if the object is watching a systemd unit
         `logs` can contain multiple lines
+        `key` is the position of the line, saved in the checkpoints once the line is safe and used by the server to drop duplicates
+        `timestamp` is kept by the copies sent again (outbox, replay), the server stores them in the same partition
 
         """
+        kind, name = self._get_reader_type_with_target()
+        if self.process is None:
+            follower = FileFollower(self.file_path, self.checkpoint)
+            while self.running:
+                now = time.time()
+                for content, key in follower.poll():
+                    self.client.send_packet(PacketLogEntry(kind, name, content, key=key, timestamp=now))
+                time.sleep(self.POLL_INTERVAL)
+            follower.close()
+            return
         while self.running:
-            content = self.process.stdout.readline().decode()
-            if content:
-                kind, name = self._get_reader_type_with_target()
-                data = {'kind': kind, 'name': name}
-                if data['kind'] == 'journal': 
-                    content = ' '.join(content.split(' ')[4:]) 
-                data['log'] = content
-                self.client.send_packet(PacketLogEntry(**data))              
+            line = self.process.stdout.readline()
+            if not line:
+                if self.process.poll() is not None: break
+                continue
+            try: content, key, timestamp = journal_entry(line)
+            except ValueError:
+                traceback.print_exc()
+                continue
+            self.client.send_packet(PacketLogEntry(kind, name, content, key=key, timestamp=timestamp))
 
 
 
@@ -1,27 +1,34 @@
 '''Client for the DVIC log server. Run as system service on the DVIC node.'''
 
 import json
-from multiprocessing import Queue
 import os
 from queue import Empty
 import subprocess
 import traceback
 import atexit
 from dataclasses import dataclass
+from time import time, sleep
 from typing import NoReturn
-from client.network.packets import Packet, decode as decode_packet, PacketInteractiveSession
+from client.network.packets import Packet, decode as decode_packet, handler_table, PacketInteractiveSession, PacketHeartbeat, PacketSessionTicket, PacketRetryAfter, RetryReason, PacketResume, PacketAck, PacketBatch, PacketLogEntry, PacketHardwareState, SUBPROTOCOLS, SUBPROTOCOL_BINARY
 from threading import Thread
 
-from websocket import create_connection, WebSocket
+from websocket import create_connection, WebSocket, WebSocketTimeoutException
 import logging
 from pathlib import Path
 import requests
 from client.interactive_session import InteractiveSession
+from client.batching import PacketBatcher
+from client.backoff import ReconnectBackoff
+from client.outbox import Outbox, OutboxConfig, flatten
+from client.checkpoints import CheckpointStore
+from client.network.queues import PriorityPacketQueue, queue_config_from_dict
+from client.network.replay import ResumableSession, replay_config_from_dict
 from client.meta import AbstractDVICNode
 from client.utils.crypto import CryptPhonebook, CryptClient
 
 DEFAULT_UID = "1d1f0545-2b60-488e-9419-d54b23bda47d" #fixed for testing TODO: read from config.
 DEFAULT_ENDPOINT = 'wss://dvic.devinci.fr/demo_control/ws/'
+BATCHED_PACKETS = (PacketLogEntry, PacketHardwareState) # bulk packets grouped in PacketBatch frames
 
 @dataclass
 class ClientConfig():
@@ -30,6 +37,15 @@ class ClientConfig():
     server_root_path: str
     latest_install_source: str
     preauth_source: str
+    batch_max_packets: int = 256 # flush a batch of bulk packets once it holds this many packets
+    batch_max_delay: float = 0.5 # or once its oldest packet waited this many seconds
+    outbound_queues: dict = None # outbound queue classes, see network.queues.queue_config_from_dict
+    reconnect_base: float = 1.0 # shortest delay before a reconnection, see backoff.ReconnectBackoff
+    reconnect_cap: float = 300.0 # longest delay before a reconnection
+    reconnect_stable_after: float = 60.0 # a connection this long resets the delay to reconnect_base
+    replay: dict = None # sequenced session resumed across reconnections, see network.replay.ReplayConfig
+    outbox: dict = None # disk outbox of the bulk packets collected while offline, see outbox.OutboxConfig
+    checkpoints_path: str = 'checkpoints.json' # read positions of the log collectors, see checkpoints.CheckpointStore
 
     def __str__(self):
         p = Path(self.private_key_path)
@@ -39,10 +55,25 @@ class DVICClient(AbstractDVICNode, CryptPhonebook):
     '''Client for the DVIC log server. Run as system service on the DVIC node.'''
     def __init__(self, config_file: str):        
         super().__init__()
-        self.send_queue = Queue()
+        self.ws: WebSocket = None
+        self.crypt: CryptClient = None # private key, parsed on the first connection and kept for the next ones
+        self.ticket: tuple[str, float] = None # (resumption ticket, deadline) for the next connection
+        self.session_ticket: PacketSessionTicket = None # ticket sent by the server on the current connection
+        self.connected_at: float = None
+        self.disconnected_at: float = None
+        self.retry_after: float = None # delay asked by the server before the next connection
+        self.binary = False # binary codec negotiated with the server, JSON otherwise
+        self.batching = False # the server understands PacketBatch
         self.config: ClientConfig = None
         self.interactive_sessions: dict[str, InteractiveSession] = {}
         self.read_config(config_file)
+        cfg = self.config or ClientConfig # class defaults if the config could not be loaded
+        self.send_queue = PriorityPacketQueue(queue_config_from_dict(cfg.outbound_queues))
+        self.batcher = PacketBatcher(self._send_batch, cfg.batch_max_packets, cfg.batch_max_delay)
+        self.checkpoints = CheckpointStore(cfg.checkpoints_path)
+        self.session = ResumableSession(replay_config_from_dict(cfg.replay), self.checkpoints.confirmed) # numbering and unacknowledged packets, kept across reconnections
+        outbox = OutboxConfig(**(cfg.outbox or {}))
+        self.outbox = Outbox(outbox, self._queue_batch, self._outbox_ready) if outbox.path else None
 
 
     def read_config(self, config_file: str):
@@ -73,23 +104,48 @@ class DVICClient(AbstractDVICNode, CryptPhonebook):
             print(f'[AUTH] Bypassing auth')
             return self.uid
         
-        cc = CryptClient(private_key=self.config.private_key_path)
-        p_answer = requests.get(f'{self.config.preauth_source}{self.uid}').json()
+        ticket, self.ticket = self.ticket, None # single use
+        if ticket is not None and ticket[1] > time():
+            print(f'[CONNECTION] Resuming the session with a ticket')
+            return ticket[0]
+
+        if self.crypt is None: self.crypt = CryptClient(private_key=self.config.private_key_path)
+        answer = requests.get(f'{self.config.preauth_source}{self.uid}')
+        if answer.status_code == 429: # server busy with other handshakes
+            self.retry_after = float(answer.headers.get('Retry-After', 0))
+            print(f'[CONNECTION] Server busy, retry in {self.retry_after:.0f}s')
+            return None
+        p_answer = answer.json()
         if not 'preauth_key' in p_answer:
             print(f"[CONNECTION] Pre-auth failed: {p_answer}")
             return None
-        token = cc.craft_initial_token(self.uid, p_answer['preauth_key'])
+        token = self.crypt.craft_initial_token(self.uid, p_answer['preauth_key'])
         print(f'[CONNECTION] Attempting login with token {token}')
         return token
 
-    def _send_thread_target(self):
+    def _send_frame(self, ws: WebSocket, pck: Packet, replayed: bool = False):
+        '''Send a packet with the negotiated codec, once sent it is kept until the server acknowledges it'''
+        frame = pck.encode_binary() if self.binary else pck.encode()
+        if not replayed: self.checkpoints.track(pck) # before sending, the ack can come back right away
+        if self.binary: ws.send_binary(frame)
+        else: ws.send(frame)
+        if not replayed and self.session.sent_packet(pck, len(frame)) is None: self.checkpoints.confirmed([pck]) # unsequenced, no ack will come
+
+    def _send_thread_target(self, ws: WebSocket):
+        '''Send the queued packets on ws until it is closed, a packet that could not be sent is put back for the next connection'''
         try:
-            while True:
-                pck: Packet = self.send_queue.get(True)
-                self.ws.send(pck.encode())
+            while ws.connected:
+                due = self.session.ack_due()
+                pck: Packet = self.send_queue.get(True, min(1.0, due) if due is not None else 1.0)
+                if pck is not None:
+                    try: self._send_frame(ws, pck)
+                    except:
+                        self.send_queue.requeue([pck])
+                        raise
+                if (ack := self.session.flush_ack()) is not None: self._send_frame(ws, ack) # end of a burst of the server
         except:
             traceback.print_exc()
-            try: self.ws.close()
+            try: ws.close()
             except: pass
 
     @property
@@ -103,48 +159,116 @@ class DVICClient(AbstractDVICNode, CryptPhonebook):
         return f'{base}'
 
     def send_packet(self, pck: Packet):
-        self.send_queue.put(pck)
+        if isinstance(pck, BATCHED_PACKETS): self.batcher.add(pck)
+        else: self.send_queue.put(pck)
+
+    def _online(self) -> bool:
+        return self.ws is not None and self.ws.connected
+
+    def _outbox_ready(self) -> bool:
+        return self._online() and len(self.send_queue) == 0 # live packets first
+
+    def _send_batch(self, packets: list[Packet]):
+        if self.outbox is not None and not self._online(): # kept on disk until reconnected
+            self.outbox.put(packets)
+            self.checkpoints.commit(packets)
+        else: self._queue_batch(packets)
+
+    def _queue_batch(self, packets: list[Packet]):
+        if len(packets) > 1 and self.batching: self.send_queue.put(PacketBatch(packets))
+        else:
+            for pck in packets: self.send_queue.put(pck)
 
     def receive_packet(self, pck: Packet):
-        try: getattr(self, f'_handle_{pck.identifier}')(pck)
+        ack = self.session.received_packet(pck)
+        if ack is not None: self.send_queue.put(ack)
+        try: self.HANDLERS[pck.identifier](self, pck)
         except: traceback.print_exc()
 
     def teardown(self):
-        self.ws.close()
+        if self.ws is not None: self.ws.close()
+        self.batcher.stop() # offline now, the pending batch goes to the outbox
+        if self.outbox is not None:
+            spilled = flatten([p for p in self.send_queue.drain() if isinstance(p, BATCHED_PACKETS + (PacketBatch,))])
+            self.outbox.put(spilled)
+            self.checkpoints.commit(spilled)
+            self.outbox.stop()
 
 
+    def run_forever(self) -> NoReturn:
+        '''Connect, then reconnect after every drop with a jittered exponential backoff, reusing the loaded config and key'''
+        cfg = self.config or ClientConfig
+        backoff = ReconnectBackoff(cfg.reconnect_base, cfg.reconnect_cap, cfg.reconnect_stable_after)
+        while True:
+            self.connected_at = self.disconnected_at = None
+            try: self.run() # will run until disconnected
+            except: traceback.print_exc()
+            connected_for = self.disconnected_at - self.connected_at if self.connected_at and self.disconnected_at else 0.0
+            delay = backoff.next(connected_for, self.retry_after)
+            self.retry_after = None
+            print(f'[CONNECTION] Waiting {delay:.1f} seconds before reconnection')
+            sleep(delay)
+
     def run(self) -> None:
+        '''Connect once and return when the connection drops'''
         auth_token = self._craft_auth_token()
+        if auth_token is None: raise ConnectionError('Pre-auth failed')
         url = self.url + auth_token
         print(f'[STARTUP] Connection to {url}')
-        self.ws: WebSocket = create_connection(url)
-        print(f'[STARTUP] Connected')
+        self.ws = ws = create_connection(url, subprotocols=SUBPROTOCOLS)
+        self.connected_at = time()
+        self.binary = self.ws.getsubprotocol() == SUBPROTOCOL_BINARY
+        self.batching = self.ws.getsubprotocol() is not None # servers negotiating a subprotocol understand PacketBatch
+        print(f'[STARTUP] Connected ({"binary" if self.binary else "json"} codec)')
+        self._resume(ws)
         
         # TODO moveatexit.register(self.exit_handler)
-        self.send_thread = Thread(target=self._send_thread_target,  daemon=True)
-        self.recp_thread = Thread(target=self._recpt_thread_target, daemon=True)
+        self.send_thread = Thread(target=self._send_thread_target, args=(ws,), daemon=True)
+        self.recp_thread = Thread(target=self._recpt_thread_target, args=(ws,), daemon=True)
         
         self.send_thread.start()
         self.recp_thread.start()
 
-        from time import sleep
         while True:
             sleep(1)
-            if not self.ws.connected:
+            if not ws.connected:
+                self.disconnected_at = time()
                 print("[CONNECTION] Disconnected")
                 break
+        if self.session_ticket is not None: # valid for its lifetime from now
+            self.ticket = (self.session_ticket.ticket, self.disconnected_at + self.session_ticket.lifetime)
+            self.session_ticket = None
+
 
 
+    def _resume(self, ws: WebSocket):
+        '''Answer the resumption offer of the server (first frame) and send again the packets it did not receive.
+        Without an offer (older servers) the connection stays unsequenced'''
+        self.session.stop()
+        if not self.batching: return # no subprotocol, no offer
+        ws.settimeout(self.session.config.resume_timeout)
+        try: data = ws.recv()
+        except WebSocketTimeoutException: return
+        finally: ws.settimeout(None)
+        pck = decode_packet(data)
+        if not isinstance(pck, PacketResume):
+            if pck is not None: self.receive_packet(pck)
+            return
+        self.session.peer_resumed(pck)
+        answer, replayed = self.session.resume()
+        self._send_frame(ws, answer)
+        for p in replayed: self._send_frame(ws, p, replayed=True)
+        if replayed: print(f'[CONNECTION] Resumed the session, {len(replayed)} packets sent again')
 
-    def _recpt_thread_target(self):
+    def _recpt_thread_target(self, ws: WebSocket):
         while True:
             try:
-                data = self.ws.recv()
-                if data is None: return #EOF 
+                data = ws.recv()
+                if not data: return #EOF (empty frame once closed)
                 self.receive_packet(decode_packet(data))
             except:
                 traceback.print_exc()
-                if not self.ws.connected: return
+                if not ws.connected: return
 
     # def on_data(self, ws: WebSocketApp, data: str, data_type, more):
     #     if more == 0:
@@ -168,6 +292,25 @@ class DVICClient(AbstractDVICNode, CryptPhonebook):
             print(f'[SESSION] Launching interactive session {uid}')
             self.interactive_sessions[uid].launch()
     
+    def _handle_heartbeat(self, pck: PacketHeartbeat):
+        self.send_packet(pck) # liveness probe of the server, sent back as is
+
+    def _handle_retry_after(self, pck: PacketRetryAfter):
+        if pck.reason == RetryReason.HANDSHAKE: # connection refused, the server closes it
+            self.retry_after = pck.delay
+            print(f'[CONNECTION] Server busy, retry in {pck.delay:.0f}s')
+        else: print(f'[CONNECTION] Sending faster than the server accepts, slowed down for {pck.delay:.2f}s')
+
+    def _handle_resume(self, pck: PacketResume):
+        if pck.next_seq is None: return # offer, answered before the threads start
+        if lost := self.session.peer_resumed(pck): print(f'[CONNECTION] {lost} packets of the server were lost before the reconnection')
+
+    def _handle_ack(self, pck: PacketAck):
+        self.session.acked(pck)
+
+    def _handle_session_ticket(self, pck: PacketSessionTicket):
+        self.session_ticket = pck
+
     def _unregister_interactive_session(self, uid: str):
         if uid in self.interactive_sessions:
             del self.interactive_sessions[uid]
@@ -179,3 +322,5 @@ class DVICClient(AbstractDVICNode, CryptPhonebook):
         with subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as process:
             stdout, stderr = process.communicate()
         self.create_json_message('shell_command_response', {'stdout': stdout.decode('utf-8'), 'stderr': stderr.decode('utf-8')}) # send packet directly with return uid 
+
+DVICClient.HANDLERS = handler_table(DVICClient)
@@ -0,0 +1,92 @@
+'''Disk outbox of the DVIC node: bulk packets collected while the server is unreachable.'''
+
+import threading
+import time
+import traceback
+from dataclasses import dataclass
+from typing import Callable
+
+from client.network.packets import Packet, PacketBatch, decode as decode_packet
+from client.utils.spool import Spool, SpoolPosition, EVICT_OLDEST
+
+
+@dataclass
+class OutboxConfig:
+    path: str = 'outbox'              # directory of the segments, None to keep the packets in memory only
+    max_bytes: int = 256 * 2**20      # disk cap, the oldest segments are evicted beyond
+    segment_bytes: int = 4 * 2**20
+    fsync: bool = False               # fsync every append, survives power losses but wears SD cards
+    drain_batch: int = 500            # packets read from disk and sent at once after a reconnection
+    drain_rate: float = 250.0         # packets per second sent from disk (0 for no limit), below the inbound rate allowed by the server
+
+class Outbox:
+    '''Append-only segmented outbox on disk (utils.spool), filled with the bulk packets of the collectors while the
+    node is offline and drained once it is back, oldest first.
+    The drain thread sends `drain_batch` packets at once, at most `drain_rate` packets per second, and only when the
+    send queue is empty so the live packets are never held behind the backlog. The read position is committed once
+    the previous batch left the send queue: a crash in between sends the batch again rather than losing it.
+
+        ----- Parameters -----
+        config : OutboxConfig
+        send : Callable[[list[Packet]], None]
+            Queues packets read back from disk for sending
+        ready : Callable[[], bool]
+            True when connected and the send queue is empty
+    '''
+    def __init__(self, config: OutboxConfig, send: Callable[[list[Packet]], None], ready: Callable[[], bool]) -> None:
+        self.config = config
+        self.send = send
+        self.ready = ready
+        self.spool = Spool(config.path, config.segment_bytes, config.max_bytes, EVICT_OLDEST, config.fsync)
+        self.stats = {'stored': 0, 'drained': 0}
+        self.position: SpoolPosition = None # end of the batch being sent, committed once it left the send queue
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self._thread_target, daemon=True)
+        self.thread.start()
+
+    def put(self, packets: list[Packet]) -> int:
+        '''Store packets on disk, returns the number stored (all of them, the oldest ones are evicted when full)'''
+        n = self.spool.append_many([p.encode_binary() for p in packets])
+        self.stats['stored'] += n
+        self.wakeup.set()
+        return n
+
+    def pending(self) -> bool:
+        return self.position is not None or not self.spool.is_empty()
+
+    def stop(self) -> None:
+        self.running = False
+        self.wakeup.set()
+        self.thread.join(2)
+        self.spool.close()
+
+    def info(self) -> dict:
+        return {**self.stats, **self.spool.stats, 'size_bytes': self.spool.size_bytes}
+
+    def _thread_target(self):
+        while self.running:
+            if not self.pending() or not self.ready():
+                self.wakeup.wait(0.1 if self.pending() else 1.0)
+                self.wakeup.clear()
+                continue
+            try: self._drain_once()
+            except:
+                traceback.print_exc()
+                time.sleep(1.0)
+
+    def _drain_once(self):
+        if self.position is not None: # previous batch handed to the websocket
+            self.spool.commit(self.position)
+            self.position = None
+        records, position = self.spool.read(self.config.drain_batch)
+        if not records: return
+        self.send([p for p in map(decode_packet, records) if p is not None])
+        self.position = position
+        self.stats['drained'] += len(records)
+        print(f'[OUTBOX] Sending {len(records)} stored packets')
+        if self.config.drain_rate > 0: time.sleep(len(records) / self.config.drain_rate)
+
+def flatten(packets: list[Packet]) -> list[Packet]:
+    '''Sub-packets of the batches, in order'''
+    return [s for p in packets for s in (p.packets if isinstance(p, PacketBatch) else (p,))]
@@ -1,9 +1,8 @@
 #!/usr/bin/env python3
 import argparse
+import signal
 import sys
 from client.dvic_client import DVICClient
-import traceback
-from time import sleep
 
 if __name__ == "__main__":
 
@@ -12,13 +11,8 @@ if __name__ == "__main__":
 
     args = parser.parse_args()
 
-    while True:
-        try:
-            print(f'[STARTUP] Starting DVIC Demo Watcher Node')
-            client = DVICClient(args.config)
-            client.run() # will run until disconnected
-            client.teardown()
-        except:
-            traceback.print_exc()
-        print('[CONNECTION] Waiting 5 seconds before reconnection')
-        sleep(5)
\ No newline at end of file
+    print(f'[STARTUP] Starting DVIC Demo Watcher Node')
+    client = DVICClient(args.config) # config and key loaded once, reused by every reconnection
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0)) # service stop, unsent bulk packets are kept in the outbox
+    try: client.run_forever()
+    finally: client.teardown()
@@ -0,0 +1,25 @@
+'''Testing the reconnection delays of the node'''
+
+import random
+
+from client.backoff import ReconnectBackoff
+
+
+def test_delays_grow_jittered_and_capped():
+    backoff = ReconnectBackoff(base=1, cap=60, rng=random.Random(4).random)
+    delays = [backoff.next() for _ in range(30)]
+    assert all(1 <= d <= 60 for d in delays)
+    assert max(delays[:3]) < 27 and max(delays) == 60
+    nodes = [ReconnectBackoff(base=1, cap=60, rng=random.Random(seed).random) for seed in range(100)]
+    assert len({round(n.next(), 3) for n in nodes}) > 90 # nodes dropped together do not retry together
+
+
+def test_reset_after_stable_connection_and_hints():
+    backoff = ReconnectBackoff(base=1, cap=60, stable_after=30, rng=lambda: 1.0)
+    assert [backoff.next() for _ in range(3)] == [3, 9, 27]
+    assert backoff.next(connected_for=10) == 60
+    assert backoff.next(connected_for=45) == 3
+    assert backoff.next(hint=7.5) == 9        # the backoff is longer than the hint
+    backoff = ReconnectBackoff(base=1, cap=60, rng=lambda: 0.0)
+    assert backoff.next(hint=7.5) == 7.5 and backoff.previous == 7.5
+    assert backoff.next(hint=3600) == 60
@@ -0,0 +1,30 @@
+'''Testing the batching stage of the node'''
+
+import threading
+import time
+
+from client.batching import PacketBatcher
+from client.network.packets import PacketLogEntry
+
+
+def test_flush_on_size():
+    batches = []
+    batcher = PacketBatcher(batches.append, max_packets=10, max_delay=60)
+    for i in range(25): batcher.add(PacketLogEntry('file', '/var/log/syslog', f'line {i}'))
+    assert [len(b) for b in batches] == [10, 10]
+    batcher.stop()
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert [p.log for b in batches for p in b] == [f'line {i}' for i in range(25)]
+
+
+def test_flush_on_delay():
+    flushed = threading.Event()
+    batches = []
+    batcher = PacketBatcher(lambda b: (batches.append(b), flushed.set()), max_packets=100, max_delay=0.05)
+    start = time.monotonic()
+    batcher.add(PacketLogEntry('journal', 'systemd-logind', 'a'))
+    batcher.add(PacketLogEntry('journal', 'systemd-logind', 'b'))
+    assert flushed.wait(1)
+    assert time.monotonic() - start >= 0.05
+    assert [[p.log for p in b] for b in batches] == [['a', 'b']]
+    batcher.stop()
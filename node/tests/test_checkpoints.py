@@ -0,0 +1,86 @@
+'''Testing the read checkpoints of the log collectors'''
+
+import json
+import os
+
+from client.checkpoints import CheckpointStore
+from client.collectors import FileFollower, journal_entry
+from client.network.packets import PacketBatch, PacketHardwareState, PacketLogEntry
+
+
+def log(i: int, name: str = 'sshd') -> PacketLogEntry:
+    return PacketLogEntry('journal', name, f'line {i}', key=f'cursor-{i}')
+
+
+def test_committed_only_once_confirmed(tmp_path):
+    path = tmp_path / 'checkpoints.json'
+    store = CheckpointStore(str(path))
+    sent = [PacketBatch([log(0), log(1, 'cron')]), log(2), PacketHardwareState('cpu_usage', 1.0)]
+    for pck in sent: store.track(pck)
+    assert store.get('journal', 'sshd') is None and not path.exists() # sent, not acknowledged yet
+    store.confirmed(sent[:1])
+    assert store.get('journal', 'sshd') == 'cursor-0' and store.get('journal', 'cron') == 'cursor-1'
+    store.confirmed(sent[1:])
+    store.commit([PacketLogEntry('file', '/var/log/syslog', 'line', key='12:40')]) # stored in the outbox
+    assert json.loads(path.read_text()) == {'journal:sshd': 'cursor-2', 'journal:cron': 'cursor-1', 'file:/var/log/syslog': '12:40'}
+    assert CheckpointStore(str(path)).get('file', '/var/log/syslog') == '12:40' # after a restart
+
+
+def test_journal_entry():
+    line = json.dumps({'__CURSOR': 's=6c3b;i=1a2f', '__REALTIME_TIMESTAMP': '1700000000250000', 'SYSLOG_IDENTIFIER': 'sshd', '_PID': '812', 'MESSAGE': 'Accepted publickey'})
+    assert journal_entry(line.encode()) == ('sshd[812]: Accepted publickey\n', 's=6c3b;i=1a2f', 1700000000.25)
+    line = json.dumps({'__CURSOR': 's=6c3b;i=1a30', '__REALTIME_TIMESTAMP': '1700000001000000', '_COMM': 'kernel', 'MESSAGE': list(b'bad \xff byte')})
+    assert journal_entry(line.encode()) == ('kernel: bad � byte\n', 's=6c3b;i=1a30', 1700000001.0)
+
+
+def test_file_follower_resumes_from_checkpoint(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b'old\n')
+    follower = FileFollower(str(path))
+    assert follower.poll() == [] # only the new lines without a checkpoint
+    with open(path, 'ab') as f: f.write(b'one\ntwo\npar')
+    lines = follower.poll()
+    assert [line for line, _ in lines] == ['one\n', 'two\n']
+    follower.close() # stopped, the partial line is read again
+
+    with open(path, 'ab') as f: f.write(b'tial\nthree\n')
+    follower = FileFollower(str(path), lines[0][1])
+    resumed = follower.poll()
+    assert [line for line, _ in resumed] == ['two\n', 'partial\n', 'three\n']
+    assert resumed[0] == lines[1] # same key, the server drops it
+    follower.close()
+
+
+def test_file_follower_rotation_and_truncation(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b'one\n')
+    follower = FileFollower(str(path))
+    with open(path, 'ab') as f: f.write(b'two\n')
+    assert [line for line, _ in follower.poll()] == ['two\n']
+
+    os.rename(path, tmp_path / 'app.log.1')
+    path.write_bytes(b'three\n')
+    assert [line for line, _ in follower.poll()] == ['three\n'] # new file read from its start
+    path.write_bytes(b'four\n') # truncated
+    lines = follower.poll()
+    assert lines == [('four\n', f'{os.stat(path).st_ino}:{follower.generation}:5')]
+    follower.close()
+
+    os.rename(path, tmp_path / 'app.log.2') # rotated while stopped
+    path.write_bytes(b'five\n')
+    follower = FileFollower(str(path), lines[0][1])
+    assert [line for line, _ in follower.poll()] == ['five\n']
+    follower.close()
+
+
+def test_file_follower_same_size_rewrite(tmp_path):
+    path = tmp_path / 'app.log'
+    path.write_bytes(b'old\n')
+    follower = FileFollower(str(path))
+    with open(path, 'ab') as f: f.write(b'one\n')
+    [(_, first)] = follower.poll()
+    with open(path, 'wb') as f: f.write(b'two\nsix\n') # copytruncate then new lines, same size
+    lines = follower.poll()
+    assert [line for line, _ in lines] == ['two\n', 'six\n']
+    assert first.endswith(':8') and lines[1][1].endswith(':8') and lines[1][1] != first # same offset, another key
+    follower.close()
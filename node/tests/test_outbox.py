@@ -0,0 +1,81 @@
+'''Testing the disk outbox of the node'''
+
+import threading
+import time
+
+from client.outbox import Outbox, OutboxConfig, flatten
+from client.network.packets import PacketBatch, PacketHardwareState, PacketLogEntry
+
+
+def log(i: int) -> PacketLogEntry:
+    return PacketLogEntry('journal', 'sshd', f'line {i}')
+
+
+class Link:
+    '''Send queue stand-in: ready when online and everything queued was taken'''
+    def __init__(self) -> None:
+        self.online = False
+        self.queued: list[list] = []
+        self.sent: list = []
+        self.event = threading.Event()
+
+    def send(self, packets: list) -> None:
+        self.queued.append(packets)
+        self.event.set()
+
+    def ready(self) -> bool:
+        if self.queued: self.sent += self.queued.pop(0) # taken by the send thread
+        return self.online and not self.queued
+
+
+def wait_for(condition, timeout: float = 2.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline: return False
+        time.sleep(0.01)
+    return True
+
+
+def test_drain_after_reconnect(tmp_path):
+    link = Link()
+    outbox = Outbox(OutboxConfig(str(tmp_path), drain_batch=4, drain_rate=0), link.send, link.ready)
+    assert outbox.put([log(i) for i in range(10)]) == 10
+    time.sleep(0.2)
+    assert link.queued == [] # offline
+    link.online = True
+    assert wait_for(lambda: not outbox.pending())
+    assert [p.log for p in link.sent] == [f'line {i}' for i in range(10)]
+    assert outbox.info()['drained'] == 10
+    outbox.stop()
+
+
+def test_uncommitted_batch_sent_again_after_restart(tmp_path):
+    link = Link()
+    link.online = True
+    link.ready = lambda: link.online and not link.queued # nothing is ever taken
+    outbox = Outbox(OutboxConfig(str(tmp_path), drain_batch=4, drain_rate=0), link.send, link.ready)
+    outbox.put([log(i) for i in range(6)])
+    assert link.event.wait(1)
+    outbox.stop() # crash before the batch left the send queue
+
+    link = Link()
+    link.online = True
+    outbox = Outbox(OutboxConfig(str(tmp_path), drain_batch=4, drain_rate=0), link.send, link.ready)
+    assert wait_for(lambda: not outbox.pending())
+    assert [p.log for p in link.sent] == [f'line {i}' for i in range(6)]
+    outbox.stop()
+
+
+def test_oldest_evicted_when_full(tmp_path):
+    link = Link()
+    outbox = Outbox(OutboxConfig(str(tmp_path), max_bytes=4096, segment_bytes=1024), link.send, link.ready)
+    outbox.put([log(i) for i in range(500)])
+    assert outbox.spool.size_bytes <= 4096 and outbox.info()['evicted'] > 0
+    records, _ = outbox.spool.read(1000)
+    assert records and len(records) < 500
+    outbox.stop()
+
+
+def test_flatten():
+    packets = [PacketBatch([log(0), log(1)]), PacketHardwareState('cpu_usage', 1.0)]
+    assert [type(p) for p in flatten(packets)] == [PacketLogEntry, PacketLogEntry, PacketHardwareState]
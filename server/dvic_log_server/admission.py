@@ -0,0 +1,122 @@
+'''Admission control at the server edge: concurrent handshakes and inbound rate of every node'''
+
+import random
+from dataclasses import dataclass
+from time import monotonic, time
+
+import dvic_log_server.api as api
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import Packet, PacketBatch, PacketRetryAfter, RetryReason
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info, warning
+
+@dataclass
+class AdmissionConfig:
+    max_handshakes: int = 32                 # websocket handshakes verified at once, the others (and the preauths) are told to retry
+    retry_after: float = 5.0                 # delay given to the refused peers, spread over [retry_after, 2 * retry_after]
+    packets_per_second: float = 500.0        # sustained inbound packets of a node (sub-packets of a batch count), 0 for no limit
+    packet_burst: float = 5000.0
+    bytes_per_second: float = 2_000_000.0    # sustained inbound bytes of a node, 0 for no limit
+    byte_burst: float = 8_000_000.0
+
+class TokenBucket:
+    '''Token bucket that can go in debt: a take always succeeds and returns the time needed to pay the debt back'''
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, burst: float, now: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, amount: float, now: float) -> float:
+        """Take tokens
+
+        Returns
+        -------
+        float
+            Seconds before the bucket is positive again, 0 if it still is
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate) - amount
+        self.stamp = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+@singleton
+class AdmissionController:
+    '''Bounds the handshakes in progress and the inbound rate of every node.
+    A handshake over `max_handshakes` (or a preauth while the bound is reached) is refused with a retry delay:
+    HTTP 429 with Retry-After, a PacketRetryAfter and close code 1013 on the websocket. The frames of a node over
+    its packet or byte rate are still handled, but the next frame is only read once the bucket is paid back
+    (TCP backpressure), and the node gets a PacketRetryAfter telling it to slow down.
+    Buckets are kept per uid, across the reconnections of the node. Every method runs on the event loop thread
+    but `busy` (preauth handler).
+
+        ----- Parameters -----
+        config : AdmissionConfig = None
+            Read from the `admission` section of the server config by default
+    '''
+    def __init__(self, config: AdmissionConfig = None) -> None:
+        if config is None:
+            cfg = api.ConnectionManager().config
+            config = AdmissionConfig(**(cfg.admission or {})) if cfg is not None else AdmissionConfig()
+        self.config = config
+        self.handshakes = 0 # in progress
+        self.buckets: dict[str, tuple[TokenBucket, TokenBucket]] = {} # uid -> (packets, bytes)
+        self.notified: dict[str, float] = {} # uid -> last PacketRetryAfter sent for its rate
+        self.throttled: dict[str, dict] = {} # uid -> counters
+        self.stats = {'handshakes_refused': 0, 'preauths_refused': 0, 'frames_delayed': 0}
+        info(f'[ADMISSION] {config.max_handshakes} concurrent handshakes, {config.packets_per_second:g} packets/s and {config.bytes_per_second:g} bytes/s per node')
+
+    def retry_delay(self) -> float:
+        '''Delay given to a refused peer, jittered so the refused peers do not come back together'''
+        return self.config.retry_after * (1 + random.random())
+
+    def busy(self) -> float:
+        '''Called on preauth, returns the delay the peer has to wait, 0 if it can go on'''
+        if self.handshakes < self.config.max_handshakes: return 0.0
+        self.stats['preauths_refused'] += 1
+        return self.retry_delay()
+
+    def enter_handshake(self) -> float:
+        '''Returns the delay the peer has to wait, 0 if the handshake can go on (call exit_handshake once verified)'''
+        if self.handshakes >= self.config.max_handshakes:
+            self.stats['handshakes_refused'] += 1
+            return self.retry_delay()
+        self.handshakes += 1
+        return 0.0
+
+    def exit_handshake(self) -> None:
+        self.handshakes -= 1
+
+    def inbound(self, connection: AConnection, pck: Packet, size: int) -> float:
+        """Account a frame received from a node
+
+        Returns
+        -------
+        float
+            Seconds to wait before reading the next frame of the node, 0 if it is within its rates
+        """
+        cfg, uid, now = self.config, connection.uid, monotonic()
+        buckets = self.buckets.get(uid)
+        if buckets is None:
+            buckets = self.buckets[uid] = (TokenBucket(cfg.packets_per_second, cfg.packet_burst, now) if cfg.packets_per_second > 0 else None,
+                                           TokenBucket(cfg.bytes_per_second, cfg.byte_burst, now) if cfg.bytes_per_second > 0 else None)
+        packets, data = buckets
+        delay = max(packets.take(len(pck.packets) if isinstance(pck, PacketBatch) else 1, now) if packets is not None else 0.0,
+                    data.take(size, now) if data is not None else 0.0)
+        if delay <= 0: return 0.0
+        self.stats['frames_delayed'] += 1
+        counters = self.throttled.setdefault(uid, {'frames_delayed': 0, 'seconds_delayed': 0.0, 'last': None})
+        counters['frames_delayed'] += 1
+        counters['seconds_delayed'] += delay
+        counters['last'] = time()
+        if now - self.notified.get(uid, -cfg.retry_after) >= cfg.retry_after: # once per retry_after while throttled
+            self.notified[uid] = now
+            warning(f'[{uid}] Over its inbound rate, reading paused for {delay:.2f}s')
+            connection.send_packet(PacketRetryAfter(delay, RetryReason.RATE))
+        return delay
+
+    def info(self) -> dict:
+        '''Counters, with the throttled nodes by decreasing delay'''
+        throttled = sorted(self.throttled.items(), key=lambda kv: kv[1]['seconds_delayed'], reverse=True)
+        return {'handshakes': self.handshakes, **self.stats, 'throttled': dict(throttled)}
@@ -1,19 +1,25 @@
 '''API module for the DVIC log and monitor server.'''
 
 import traceback
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Header, HTTPException, Query, Response
+from fastapi.responses import StreamingResponse
 
 import asyncio
+import math
 import os
 import json
 from pathlib import Path
+from time import time
 from dataclasses import dataclass
+from typing import Union
 
 from dvic_log_server.meta import AConnection
-from dvic_log_server.network.packets import Packet, PacketNodeAdditionRequest, decode as decode_packet
+from dvic_log_server.network.packets import Packet, PacketNodeAdditionRequest, PacketRetryAfter, RetryReason, decode as decode_packet, select_subprotocol, SUBPROTOCOL_BINARY
+from dvic_log_server.network.replay import replay_config_from_dict
 from dvic_log_server.utils.wrappers import singleton
 from dvic_log_server.utils.crypto import CryptClient, CryptPhonebook
 from dvic_log_server.interactive_sessions import ScriptInteractiveSession
+from dvic_log_server.node_state import NodeStateRegistry
 
 from dvic_log_server.logs import info, warning, error, debug
 
@@ -23,12 +29,23 @@ app = FastAPI()
 class ServerConfig():
     server_private_key_path: str  #? not using double auth, so server private key is not used at the moment. Would be a nice to have
     keys_save_path: str = "./keys"
+    outbound_queues: dict = None # per connection outbound queue classes, see network.queues.queue_config_from_dict
+    ingest: dict = None # database ingest pipeline settings, see ingest.IngestConfig
+    database: dict = None # database backend, see database_drivers.DatabaseConfig
+    history: dict = None # in-memory metric history, see history.HistoryConfig
+    rollups: dict = None # hardware metric rollups, see rollups.RollupConfig
+    query_cache: dict = None # cache of the stored document queries, see queries.QueryCacheConfig
+    liveness: dict = None # heartbeats and eviction of the silent connections, see liveness.LivenessConfig
+    handshake: dict = None # verification of the connection tokens, see handshake.HandshakeConfig
+    admission: dict = None # concurrent handshakes and inbound rate per node, see admission.AdmissionConfig
+    replay: dict = None # sequenced sessions resumed across reconnections, see network.replay.ReplayConfig
 
 @singleton
 class ConnectionManager(CryptPhonebook):
     def __init__(self):
         self.config = None
         self.connections: dict[str, AConnection] = {}
+        self.detached: dict[str, tuple[AConnection, float]] = {} # uid -> (disconnected connection with a session, time), see network.replay
         self.log_path = os.path.dirname(os.path.realpath(__file__))
         #remove the 'dvic_log_server' part of the path
         self.log_path = self.log_path[:self.log_path.rfind('/')]
@@ -39,6 +56,8 @@ class ConnectionManager(CryptPhonebook):
             warning(f'The API is configured to IGNORE cryptographic client authentication. DO NOT do this in a production setting.')
     
     def __setitem__(self, uid: str, connection: AConnection) -> None:    
+        self._prune_detached()
+        detached = self.detached.pop(uid, None) if connection is not None else None
         if uid in self.connections:
             if connection is not None:
                 debug(f'[{uid}] Replacing connection')
@@ -48,11 +67,32 @@ class ConnectionManager(CryptPhonebook):
             else:
                 if not self.connections[uid].is_disconnected(): 
                     return # don't replace connection with None if the connection was replaced before the disconnection #! is_disconnected_ is borked
+        elif detached is not None:
+            debug(f'[{uid}] Resuming the session of the previous connection')
+            connection.inherit(detached[0])
 
+        from dvic_log_server.presence import PresenceHub
+        from dvic_log_server.liveness import LivenessTracker
+        if uid in self.connections: LivenessTracker().untrack(self.connections[uid])
         if connection is None:
-            del self.connections[uid]
+            previous = self.connections.pop(uid, None)
+            if previous is None: return # already gone if evicted
+            PresenceHub().disconnected(uid)
+            if getattr(previous, 'session', None) is not None: self.detached[uid] = (previous, time()) # resumed by the next connection
+            else: NodeStateRegistry().remove(uid) # gone for good
             return
         self.connections[uid] = connection
+        LivenessTracker().track(connection)
+        PresenceHub().connected(uid, connection)
+
+    def _prune_detached(self):
+        '''Forget the sessions, and the last state, of the nodes that did not reconnect within the resume window'''
+        if not self.detached: return
+        cfg = replay_config_from_dict(self.config.replay if self.config is not None else None)
+        limit = time() - cfg.resume_window
+        for uid in [uid for uid, (_, t) in self.detached.items() if t < limit]:
+            del self.detached[uid]
+            NodeStateRegistry().remove(uid)
 
     def load_config(self):
         if not os.path.isfile("config.json"):
@@ -66,6 +106,11 @@ class ConnectionManager(CryptPhonebook):
             traceback.print_exc()
             error('Failed to load server config')
 
+    def database_config(self):
+        '''Returns the DatabaseConfig of the `database` section of the config'''
+        from dvic_log_server.database_drivers import DatabaseConfig
+        return DatabaseConfig(**((self.config.database if self.config is not None else None) or {}))
+
     def get_public_key(self, uid: str) -> str:
         pkp = Path(self.config.keys_save_path, uid)
         if not pkp.exists(): return None
@@ -132,53 +177,146 @@ def get_salt(uid):
     if cm.get_public_key(uid) is None:
         warning(f"[AUTH] Rejected preauth for {uid} (no such UID)")
         return {'message': 'UID unknown'}
+    from dvic_log_server.admission import AdmissionController
+    delay = AdmissionController().busy()
+    if delay: raise HTTPException(status_code=429, detail='Too many connections in progress', headers={'Retry-After': str(math.ceil(delay))})
     
     salt = CryptClient.get_salt()
     cm.set_client_salt(uid, salt)
     info(f'[AUTH] Preauth for {uid}: {salt}')
     return {"preauth_key": salt}
 
+
+def _state_response(uid: Union[str, None], if_none_match: Union[str, None]) -> Response:
+    '''JSON state of a node (of the fleet if uid is None), 304 if the client already has this version'''
+    registry = NodeStateRegistry()
+    etag = registry.etag(uid)
+    if etag is None: raise HTTPException(status_code=404, detail=f'No state for node {uid}')
+    if if_none_match is not None and (if_none_match.strip() == '*' or etag in (t.strip().removeprefix('W/') for t in if_none_match.split(','))):
+        return Response(status_code=304, headers={'ETag': etag})
+    content, etag = registry.snapshot(uid)
+    if content is None: raise HTTPException(status_code=404, detail=f'No state for node {uid}')
+    return Response(content=content, media_type='application/json', headers={'ETag': etag, 'Cache-Control': 'no-cache'})
+
+@app.get('/nodes/state')
+def get_nodes_state(if_none_match: Union[str, None] = Header(default=None)):
+    '''Latest hardware state of every node: {uid: {kind: {"data": ..., "timestamp": ...}}}'''
+    return _state_response(None, if_none_match)
+
+@app.get('/nodes/{uid}/state')
+def get_node_state(uid: str, if_none_match: Union[str, None] = Header(default=None)):
+    '''Latest hardware state of one node: {kind: {"data": ..., "timestamp": ...}}'''
+    return _state_response(uid, if_none_match)
+
+@app.get('/nodes/{uid}/history')
+def get_node_metrics(uid: str):
+    '''Metrics with a history for one node'''
+    from dvic_log_server.history import MetricHistory
+    return {'node': uid, 'metrics': MetricHistory().metrics(uid)}
+
+@app.get('/nodes/{uid}/history/{metric}')
+def get_node_history(uid: str, metric: str, start: float = None, end: float = None,
+                     points: int = Query(default=500, ge=3, le=10_000), method: str = Query(default='lttb', pattern='^(lttb|minmax)$')):
+    '''Samples of a metric of a node in [start, end] (seconds since epoch), downsampled to at most `points` samples'''
+    from dvic_log_server.history import MetricHistory
+    try: timestamps, values = MetricHistory().query(uid, metric, start, end, points, method)
+    except KeyError: raise HTTPException(status_code=404, detail=f'No history for {metric} of node {uid}')
+    return {'node': uid, 'metric': metric, 'method': method, 'timestamps': timestamps.tolist(), 'values': values.tolist()}
+
+def _query_args(node: Union[list[str], None], kind: Union[list[str], None], name: Union[list[str], None],
+                start: Union[float, None], end: Union[float, None], text: Union[str, None], fields: Union[str, None]) -> tuple[dict, list[str]]:
+    filters = {'nodes': node, 'kinds': kind, 'names': name, 'start': start, 'end': end, 'text': text}
+    return filters, [f for f in fields.split(',') if f] if fields else None
+
+@app.get('/query/{index}')
+def query_documents(index: str, node: list[str] = Query(default=None), kind: list[str] = Query(default=None), name: list[str] = Query(default=None),
+                    start: float = None, end: float = None, text: str = None, fields: str = None, size: int = Query(default=100, ge=1, le=1000),
+                    cursor: str = None, order: str = Query(default='asc', pattern='^(asc|desc)$')):
+    '''One page of the documents of a family (`machine_logs`, `machine_hardware_state`, ...) matching the filters.
+    `fields` is a comma separated list of the returned fields, pass `next_cursor` as `cursor` to get the next page'''
+    from dvic_log_server.queries import QueryCache
+    filters, fields = _query_args(node, kind, name, start, end, text, fields)
+    try: hits, next_cursor = QueryCache().page(index, filters, fields, size, cursor, order == 'desc')
+    except KeyError: raise HTTPException(status_code=404, detail=f'No such index {index}')
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    return {'index': index, 'hits': hits, 'next_cursor': next_cursor}
+
+@app.get('/query_cache/stats')
+def get_query_cache_stats():
+    '''Hit, miss, eviction and invalidation counters of the query cache, with its size in entries and bytes'''
+    from dvic_log_server.queries import QueryCache
+    return QueryCache().info()
+
+@app.get('/query/{index}/export')
+def export_documents(index: str, node: list[str] = Query(default=None), kind: list[str] = Query(default=None), name: list[str] = Query(default=None),
+                     start: float = None, end: float = None, text: str = None, fields: str = None, cursor: str = None,
+                     order: str = Query(default='asc', pattern='^(asc|desc)$')):
+    '''Every document matching the filters as newline-delimited JSON, streamed page by page'''
+    from dvic_log_server.indices import FAMILIES
+    from dvic_log_server.queries import QueryCache, decode_cursor
+    if index not in FAMILIES: raise HTTPException(status_code=404, detail=f'No such index {index}')
+    try: decode_cursor(cursor)
+    except ValueError as e: raise HTTPException(status_code=400, detail=str(e))
+    filters, fields = _query_args(node, kind, name, start, end, text, fields)
+    pages = QueryCache().iter_pages(index, filters, fields, cursor=cursor, descending=order == 'desc')
+    return StreamingResponse((''.join(json.dumps(h) + '\n' for h in hits) for hits in pages), media_type='application/x-ndjson')
+
+@app.get('/admission/stats')
+def get_admission_stats():
+    '''Handshakes in progress, refused handshakes and preauths, and the nodes throttled for their inbound rate'''
+    from dvic_log_server.admission import AdmissionController
+    return AdmissionController().info()
+
+async def _send_packet(websocket: WebSocket, subprotocol: str, pck: Packet) -> None:
+    '''Send a packet on a websocket that has no Connection'''
+    if subprotocol == SUBPROTOCOL_BINARY: await websocket.send_bytes(pck.encode_binary())
+    else: await websocket.send_text(pck.encode())
     
 @app.websocket("/ws/{token}")
 async def websocket_endpoint(websocket: WebSocket, token: str):
+    from dvic_log_server.handshake import HandshakeVerifier
+    from dvic_log_server.admission import AdmissionController
     cm = ConnectionManager()
-    cry = CryptClient(private_key = cm.config.server_private_key_path)
-    uid, packet_ok = cry.verify_initial_packet(token, cm)
+    admission = AdmissionController()
+    subprotocol = select_subprotocol(websocket.scope.get('subprotocols', []))
+    delay = admission.enter_handshake()
+    if delay:
+        await websocket.accept(subprotocol=subprotocol)
+        if subprotocol is None: await websocket.send_text(f'Server busy, retry in {delay:.0f} seconds.')
+        else: await _send_packet(websocket, subprotocol, PacketRetryAfter(delay, RetryReason.HANDSHAKE))
+        await websocket.close(code=1013) # try again later
+        return
+    try: uid, packet_ok = await HandshakeVerifier().verify(token, cm) # off the event loop
+    finally: admission.exit_handshake()
 
-    await websocket.accept()
+    await websocket.accept(subprotocol=subprotocol)
     if not packet_ok or False: #FIXME testing
         warning(f'[CONNECTION] ({uid}) ({websocket.client.host}) Connection token rejected')
-        await websocket.send_text(f'Connection token rejected.')
-        await websocket.close()
+        if subprotocol is None: await websocket.send_text(f'Connection token rejected.') # peers with a codec only read packets
+        await websocket.close(code=1008) # policy violation
         return
 
     from dvic_log_server.connection import Connection # needed for init but cannot import before or cycle dependencies
-    conn = Connection(websocket, uid)
+    conn = Connection(websocket, uid, binary = subprotocol == SUBPROTOCOL_BINARY, resumable = subprotocol is not None)
     ConnectionManager()[uid] = conn 
-
-    async def send_packets():
-        while True:
-            try:
-                await asyncio.sleep(1/120)
-                if conn.is_disconnected(): return
-                pck = conn.next_packet()
-                if pck is None: continue
-                await websocket.send_text(pck.encode())
-                
-            except WebSocketDisconnect: break
-            except asyncio.CancelledError: break
-            except: traceback.print_exc()
-        # print(f"[{uid}] Send loop closing")
+    ticket = HandshakeVerifier().ticket_for(uid, cm) if subprotocol is not None else None # older nodes negotiate no subprotocol
+    if ticket is not None: conn.send_packet(ticket)
 
     loop = asyncio.get_running_loop()
+    send: asyncio.Task = None
     try:
-        info(f"[{uid}] Accepted connection from {websocket.client.host}")
+        if conn.session is not None: await conn.send_frame(conn.session.offer()) # first frame, the writer waits for the answer
+        info(f"[{uid}] Accepted connection from {websocket.client.host} ({'binary' if conn.binary else 'json'} codec)")
 
         # rect = loop.create_task(receive_packets())
-        send: asyncio.Task = loop.create_task(send_packets())
+        send = loop.create_task(conn.writer())
         while True:
             try:
-                conn.receive_packet(decode_packet(await websocket.receive_text()))
+                frame = await conn.receive_frame()
+                pck = decode_packet(frame)
+                conn.receive_packet(pck)
+                delay = admission.inbound(conn, pck, len(frame))
+                if delay: await asyncio.sleep(delay) # over its rate, stop reading the node for a while
             except WebSocketDisconnect: raise
             except: 
                 if conn.is_disconnected(): break
@@ -188,7 +326,13 @@ async def websocket_endpoint(websocket: WebSocket, token: str):
 
     except WebSocketDisconnect:
         error(f'[{uid}] Err: disconnected')
-    conn.in_use = False #FIXME put in a method
-    send.cancel()
-    ConnectionManager()[uid] = None
-    warning(f"[{uid}] Connection Closed")
+    finally: # also when the peer dropped during the resumption offer
+        conn.in_use = False #FIXME put in a method
+        if send is not None: send.cancel()
+        from dvic_log_server.log_tail import LogTailHub
+        from dvic_log_server.presence import PresenceHub
+        LogTailHub().unsubscribe(conn)
+        PresenceHub().unsubscribe(conn)
+        ConnectionManager()[uid] = None
+        if ticket is not None: HandshakeVerifier().tickets.closed(uid, ticket.ticket)
+        warning(f"[{uid}] Connection Closed")
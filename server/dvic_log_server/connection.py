@@ -1,12 +1,24 @@
-from fastapi import WebSocket
+from fastapi import WebSocket, WebSocketDisconnect
 
 import asyncio
+import threading
 from dvic_log_server.network.packets import *
+from dvic_log_server.network.queues import PriorityPacketQueue, queue_config_from_dict
+from dvic_log_server.network.replay import ResumableSession, replay_config_from_dict
 from dvic_log_server.api import ConnectionManager
-from multiprocessing import Queue
 from dvic_log_server.logs import info, warning, error, debug
-from dvic_log_server.database_drivers import ElasticConnector
+from dvic_log_server.history import MetricHistory
+from dvic_log_server.indices import LOGS, HARDWARE_STATES
+from dvic_log_server.liveness import LivenessTracker
+from dvic_log_server.log_tail import LogTailHub
+from dvic_log_server.ingest import IngestPipeline
+from dvic_log_server.database_drivers import IDEMPOTENCY_KEY
+from dvic_log_server.metrics import flatten_metrics
 from dvic_log_server.meta import AConnection
+from dvic_log_server.node_state import NodeStateRegistry
+from dvic_log_server.presence import PresenceHub, node_entry, last_seen_bucket, LAST_SEEN_BUCKET
+from dvic_log_server.queries import QueryCache
+from dvic_log_server.rollups import RollupEngine
 from dvic_log_server.interactive_sessions import InteractiveSession, ScriptInteractiveSession, SSHScriptInteractiveSession
 
 from time import time
@@ -14,98 +26,233 @@ from starlette.websockets import WebSocketState
 
 from dvic_log_server.logs import info, warning, error, debug
 
-elk_host = 'localhost'
-elk_port = 9200
+WRITER_DRAIN_SIZE = 64 # packets dequeued at once by the writer
 
 
 class Connection(AConnection):
-    def __init__(self, ws: WebSocket, uid: str) -> None:
+    def __init__(self, ws: WebSocket, uid: str, binary: bool = False, resumable: bool = False) -> None:
         self.ws = ws
         self.uid = uid
-        self.send_queue: Queue = Queue()
+        self.binary = binary # binary codec negotiated during the handshake, JSON otherwise
+        # sequenced session kept across the reconnections of the node (see network.replay), None once unsequenced
+        self.session = ResumableSession(replay_config_from_dict(ConnectionManager().config.replay)) if resumable else None
+        self.resumed = asyncio.Event() # set once the peer answered the resumption offer, or will not
+        self.successor: Connection = None # connection that inherited this one
+        self.loop = asyncio.get_running_loop() # connections are created by the ws endpoint, on the event loop
+        self.loop_thread = threading.get_ident()
+        self.wakeup = asyncio.Event() # set when packets are queued for the writer
+        self.send_queue = PriorityPacketQueue(queue_config_from_dict(ConnectionManager().config.outbound_queues), on_put=self._wake_writer)
         self.in_use = True
         self.last_seen = time()
+        self.last_seen_bucket = last_seen_bucket(self.last_seen) # last bucket reported to the presence subscribers
+        self.stale = False # a liveness probe went unanswered, see liveness.LivenessTracker
 
     def inherit(self, connection):
         """Inherit previous connection that was reset
-        The method will replace and maintain state where the previous connection was unbiased
+        The session (numbering and packets the node did not acknowledge), the queued packets and the interactive sessions
+        of the previous connection move to this one. The node tells what it received when it answers the resumption
+        offer, only the missing packets are sent again
 
         Parameters
         ----------
         connection : Connection
-            The previous, disconnected, Connection object
+            The previous, closed, Connection object
         """
-        pass
+        connection.successor = self
+        if self.session is not None and connection.session is not None: self.session = connection.session
+        connection.session = None
+        self.send_queue.requeue(connection.send_queue.drain())
+        InteractiveSession.rebind(connection, self)
 
     def is_disconnected(self) -> bool:
         return self.ws.application_state != WebSocketState.CONNECTED or not self.in_use
 
+    def _in_loop_thread(self) -> bool:
+        return threading.get_ident() == self.loop_thread
+
+    def _wake_writer(self):
+        if self._in_loop_thread(): self.wakeup.set()
+        else: self.loop.call_soon_threadsafe(self.wakeup.set)
+
     def send_packet(self, pck: Packet):
-        self.send_queue.put(pck)
+        """Queue a packet for the writer. Safe to call from any thread (e.g. interactive session hooks)
+        The event loop never blocks: packets of a full BLOCK class are rejected there, other threads wait for room"""
+        self.send_queue.put(pck, block=not self._in_loop_thread())
+
+    @property
+    def dropped(self) -> dict[str, int]:
+        """Number of outbound packets dropped by the queue overflow policies, per class"""
+        return self.send_queue.dropped
+
+    def _requeue(self, packets: list[Packet]):
+        """Put back packets that could not be sent, in the queue of the connection that replaced this one if any"""
+        (self.successor or self).send_queue.requeue(packets)
 
-    def next_packet(self) -> Packet:
-        try: return self.send_queue.get(block=False)
-        except: return None
+    async def writer(self):
+        """Send loop of the connection
+        Sleeps until packets are queued, then sends everything that is queued, highest priority first.
+        Also wakes up to acknowledge the end of a burst of the node (see ResumableSession.flush_ack).
+        The packets dequeued but not sent when the connection drops are put back in the queue"""
+        if self.session is not None and not await self._resume(): return
+        while not self.is_disconnected():
+            try: await asyncio.wait_for(self.wakeup.wait(), self.session.ack_due() if self.session is not None else None)
+            except asyncio.TimeoutError: pass
+            self.wakeup.clear()
+            if self.session is not None and (ack := self.session.flush_ack()) is not None: self.send_queue.put(ack)
+            while packets := self.send_queue.drain(WRITER_DRAIN_SIZE): # small chunks so urgent packets can overtake bulk ones
+                for i, pck in enumerate(packets):
+                    try: await self.send_frame(pck)
+                    except (Exception, asyncio.CancelledError) as e:
+                        if isinstance(e, (WebSocketDisconnect, asyncio.CancelledError)) or self.is_disconnected():
+                            self._requeue(packets[i:])
+                            if isinstance(e, asyncio.CancelledError): raise
+                            return
+                        error(f"[{self.uid}] Failed to send packet {pck.identifier}")
+                        traceback.print_exc()
+
+    async def _resume(self) -> bool:
+        """Hold the outbound packets until the node answered the resumption offer, then send what it did not receive
+
+        Returns
+        -------
+        bool
+            False if the connection dropped meanwhile
+        """
+        try: await asyncio.wait_for(self.resumed.wait(), self.session.config.resume_timeout)
+        except asyncio.TimeoutError:
+            if self.is_disconnected(): return False
+            self._unsequenced('no answer to the resumption offer')
+        if self.session is None: return True
+        start, replayed = self.session.resume()
+        try:
+            await self.send_frame(start)
+            for pck in replayed: await self.send_frame(pck, replayed=True)
+        except Exception: # kept in the replay buffer for the next connection
+            if not self.is_disconnected(): traceback.print_exc()
+            return False
+        if replayed: info(f'[{self.uid}] Resumed the session, {len(replayed)} packets sent again')
+        return True
+
+    def _unsequenced(self, reason: str):
+        debug(f'[{self.uid}] Unsequenced connection: {reason}')
+        self.session.stop()
+        self.session = None
+        self.resumed.set()
+
+    async def send_frame(self, pck: Packet, replayed: bool = False):
+        """Send a packet on the websocket with the negotiated codec
+        Once sent, a packet of a sequenced session is kept until the node acknowledges it"""
+        frame = pck.encode_binary() if self.binary else pck.encode()
+        if self.binary: await self.ws.send_bytes(frame)
+        else: await self.ws.send_text(frame)
+        if self.session is not None and not replayed: self.session.sent_packet(pck, len(frame))
+
+    async def receive_frame(self) -> Union[str, bytes]:
+        """Wait for the next frame on the websocket
+
+        Returns
+        -------
+        Union[str, bytes]
+            The text (JSON) or binary frame content
+
+        Raises
+        ------
+        WebSocketDisconnect
+            The peer disconnected
+        """
+        message = await self.ws.receive()
+        if message['type'] == 'websocket.disconnect': raise WebSocketDisconnect(message.get('code', 1000))
+        return message['bytes'] if message.get('bytes') is not None else message['text']
 
     def _protocol_error(self, msg: str):
         error(f'Protocol error: {msg}')
         self.close()
 
     def receive_packet(self, pck: Packet):
-        if pck is None: self._protocol_error("Packet cannot be decoded")
+        if pck is None: return self._protocol_error("Packet cannot be decoded")
         self.last_seen = time()
-        fct = getattr(self, f'_handle_{pck.identifier}')
-        if fct is None: self._protocol_error(f'no such packet {pck.identifier}')
-        try: fct(pck)
+        if self.last_seen >= self.last_seen_bucket + LAST_SEEN_BUCKET:
+            self.last_seen_bucket = last_seen_bucket(self.last_seen)
+            PresenceHub().changed(self.uid, last_seen=self.last_seen_bucket)
+        if self.session is not None:
+            if not self.resumed.is_set():
+                if not isinstance(pck, PacketResume): self._unsequenced('the peer did not answer the resumption offer') # older node, cli
+            elif (ack := self.session.received_packet(pck)) is not None: self.send_packet(ack)
+            elif self.session.unacked == 1: self._wake_writer() # arms the timer of the next ack
+        self._dispatch(pck)
+
+    def _dispatch(self, pck: Packet):
+        fct = self.HANDLERS.get(pck.identifier)
+        if fct is None: return self._protocol_error(f'no such packet {pck.identifier}')
+        try: fct(self, pck)
         except:
             error(f"Failed to handle packet {pck.identifier}")
             traceback.print_exc()
     
     def close(self):
         self.in_use = False
-        asyncio.run_coroutine_threadsafe(self.ws.close(), asyncio.get_event_loop())
+        self._wake_writer() # lets the writer see the connection is closed
+        if self._in_loop_thread(): self.loop.create_task(self.ws.close())
+        else: asyncio.run_coroutine_threadsafe(self.ws.close(), self.loop)
 
     # handlers
     #################! REMOVE THIS ##################
     def _handle_machine_log(self, pck : PacketMachineLog): # TODO : Im changing this to log_entry
         '''Handle a machine log packet'''
-        elk = ElasticConnector(elk_host,elk_port,index='machine_logs')
-        dict_to_store = {'node': self.uid, 
-                         'type': pck.identifier, 
-                         'kind': pck.kind, 
-                         'name' : pck.name, 
-                         'log' : pck.log, 
-                         'timestamp': time()}
-        elk.insert(dict_to_store)
-        elk.close()
+        self._store_log(pck)
     
     #################! REMOVE THIS ##################
 
+    def _store_log(self, pck: Union[PacketLogEntry, PacketMachineLog]):
+        LogTailHub().publish(self.uid, pck)
+        timestamp = getattr(pck, 'timestamp', None) # time of the entry on the node, the same for the copies sent again
+        document = {
+                'node': self.uid, 
+                'type': pck.identifier, 
+                'kind': pck.kind, 
+                'name' : pck.name, 
+                'log' : pck.log, 
+                'timestamp': timestamp if isinstance(timestamp, (int, float)) else time()
+            }
+        if getattr(pck, 'key', None) is not None: document[IDEMPOTENCY_KEY] = pck.key # backfilled entries are stored once
+        IngestPipeline().submit(LOGS.name, document)
+
     def _handle_hardware_state(self, pck: PacketHardwareState):
         '''Handle a hardware state packet'''
-        elk = ElasticConnector(elk_host,elk_port,index='machine_hardware_state')
-        # info(f'Log to store : {pck.log} and type {type(pck.log)}')
-        elk.insert({
+        now = time()
+        NodeStateRegistry().update(self.uid, pck.kind, pck.data, now)
+        MetricHistory().add(self.uid, pck.kind, pck.data, now)
+        RollupEngine().add(self.uid, pck.kind, pck.data, now)
+        IngestPipeline().submit(HARDWARE_STATES.name, {
                 'node': self.uid, 
                 'type': pck.identifier, 
                 'kind': pck.kind, 
                 'data' : json.dumps(pck.data), 
-                'timestamp': time()    
+                **flatten_metrics(pck.data),
+                'timestamp': now
             })
-        elk.close()
 
     def _handle_node_status(self, pck: PacketNodeStatus):
         from dvic_log_server.api import ConnectionManager #! fix this mess haiyaa
         if pck.action is not None:
             if pck.action == NodeStatusAction.LIST_NODES:
-                connections = {
-                    k: {
-                        'status': "connected" if v is not None and not v.is_disconnected() else "disconnected",
-                        'last_seen': v.last_seen
-                       } 
-                    for k, v in ConnectionManager().connections.items()
-                }
+                connections = {k: node_entry(v) for k, v in ConnectionManager().connections.items()}
                 self.send_packet(PacketNodeStatus(node_status=connections))
+            elif pck.action == NodeStatusAction.SUBSCRIBE: PresenceHub().subscribe(self, ConnectionManager().connections)
+            elif pck.action == NodeStatusAction.UNSUBSCRIBE: PresenceHub().unsubscribe(self)
+
+    def _handle_heartbeat(self, pck: PacketHeartbeat):
+        '''Answer to a liveness probe, receiving it already refreshed last_seen'''
+        LivenessTracker().answered(self)
+
+    def _handle_resume(self, pck: PacketResume):
+        '''Answer of the node to the resumption offer, the writer sends the missing packets'''
+        if self.session is None or self.resumed.is_set() or pck.next_seq is None: return self._protocol_error('unexpected resume')
+        if lost := self.session.peer_resumed(pck): warning(f'[{self.uid}] {lost} packets of the node were lost before its reconnection')
+        self.resumed.set()
+
+    def _handle_ack(self, pck: PacketAck):
+        if self.session is not None: self.session.acked(pck)
 
     def _handle_interactive_session(self, pck: PacketInteractiveSession):
         InteractiveSession.handle_packet(self, pck)
@@ -125,15 +272,31 @@ class Connection(AConnection):
 
     def _handle_log_entry(self, pck: PacketLogEntry):
         '''Handle a log entry packet'''
-        elk = ElasticConnector(elk_host,elk_port,index='machine_logs')
-        dict_to_store = {'node': self.uid, 
-                         'type': pck.identifier, 
-                         'kind': pck.kind, 
-                         'name' : pck.name, 
-                         'log' : pck.log, 
-                         'timestamp': time()}
-        elk.insert(dict_to_store)
+        self._store_log(pck)
+    
+    def _handle_log_subscription(self, pck: PacketLogSubscription):
+        '''Handle a live log tail (un)subscription'''
+        if pck.action == LogSubscriptionAction.SUBSCRIBE: LogTailHub().subscribe(self, pck)
+        elif pck.action == LogSubscriptionAction.UNSUBSCRIBE: LogTailHub().unsubscribe(self, pck.subscription_id)
+
+    def _handle_query(self, pck: PacketQuery):
+        '''Answer one page of a stored document query, the database is queried off the event loop'''
+        self.loop.run_in_executor(None, self._answer_query, pck)
+
+    def _answer_query(self, pck: PacketQuery):
+        try:
+            hits, next_cursor = QueryCache().page(pck.index, pck.filters, pck.fields, pck.size or 100, pck.cursor, bool(pck.descending))
+            self.send_packet(PacketQuery(pck.request_id, pck.index, hits=hits, next_cursor=next_cursor))
+        except Exception as e:
+            msg = f'No such index {pck.index}' if isinstance(e, KeyError) else str(e)
+            if not isinstance(e, (KeyError, ValueError)): warning(f'[{self.uid}] Query {pck.request_id} failed ({type(e).__name__}: {e})')
+            self.send_packet(PacketQuery(pck.request_id, pck.index, error=msg))
     
+    def _handle_batch(self, pck: PacketBatch):
+        '''Handle a batch packet: every sub-packet goes through the regular handlers, in order'''
+        for p in pck.packets:
+            self._dispatch(p)
+
     def _handle_node_addition_request(self, pck: PacketNodeAdditionRequest):
         cm = ConnectionManager()
         #? TODO create connection addition with retry and timeout 
@@ -164,6 +327,8 @@ class Connection(AConnection):
         '''Handle a demo process state packet'''
         raise NotImplementedError()
 
+Connection.HANDLERS = handler_table(Connection)
+
 class MachineConnection(Connection): #? usefull
     def __init__(self, ws: WebSocket) -> None:
         super().__init__(ws)
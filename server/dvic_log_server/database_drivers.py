@@ -1,32 +1,171 @@
 '''Driver for database connections'''
 
+import json
+import re
+import sqlite3
+import threading
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from time import time
+from typing import Any, Callable, Union
 from elasticsearch import Elasticsearch
 
-# In development
+from dvic_log_server.indices import FAMILIES
+
+BACKEND_ELASTICSEARCH = 'elasticsearch'
+BACKEND_SQLITE = 'sqlite'
+IDEMPOTENCY_KEY = 'idempotency_key' # documents carrying it are written at most once, under their doc_id
+
+@dataclass
+class DatabaseConfig:
+    '''`database` section of the server config'''
+    backend: str = BACKEND_ELASTICSEARCH # BACKEND_ELASTICSEARCH or BACKEND_SQLITE
+    host: str = 'localhost'              # Elasticsearch host
+    port: int = 9200                     # Elasticsearch port
+    path: str = 'dvic_logs.db'           # SQLite database file
+    partition_period: str = 'day'        # period of the Elasticsearch partitions, see indices.PERIOD_FORMATS
+    retention_days: Union[float, dict] = None # documents older than this are dropped: days for every family or {family: days}, kept forever by default
+
 class DatabaseConnector(ABC):
+    '''Interface of the database backends.
+    A connector is a cheap handle on a long-lived client shared through a ConnectorPool: instantiate one where needed
+    and `close()` it to give the client back to the pool.
+
+    Args:
+        host (str): Host of the database
+        port (int): Port of the database
+        index (str): Index (or table) the connector works on
+    '''
     def __init__(self, host: str, port: int, index: str = None):
         self.host = host
         self.port = port
-        self.index = index    
+        self.index = index
+
+    @abstractmethod
+    def test_connection(self) -> bool: ...
+
+    @abstractmethod
+    def insert(self, data: dict) -> str: ...
+
+    @abstractmethod
+    def bulk(self, documents: list[tuple[str, dict]]) -> list[int]:
+        '''Inserts (index, document) pairs in one request and returns the status of each document (HTTP codes)'''
+
+    @abstractmethod
+    def get_by_id(self, id: str) -> dict: ...
+
+    @abstractmethod
+    def search(self, query: dict, size: int = 10) -> dict:
+        '''Returns the documents matching an Elasticsearch query, as an Elasticsearch search response'''
+
+    @abstractmethod
+    def search_page(self, query: dict, size: int, after: list = None, fields: list[str] = None, descending: bool = False) -> tuple[list[dict], Union[list, None]]:
+        '''Returns one page of the documents matching a query, sorted by timestamp with a unique tie-breaker,
+        and the sort values of its last document to pass as `after` for the next page (None on the last page).
+        `fields` restricts the returned document fields, every field by default.'''
+
+    @abstractmethod
+    def get_all(self) -> dict: ...
+
+    @abstractmethod
+    def delete_by_id(self, id: str) -> None: ...
+
+    @abstractmethod
+    def delete_all(self) -> None: ...
+
+    @abstractmethod
+    def delete_index(self) -> None: ...
+
+    @abstractmethod
+    def drop_before(self, index: str, timestamp: float) -> None:
+        '''Deletes the documents of an index older than timestamp (seconds since epoch)'''
+
+    @abstractmethod
+    def close(self) -> None: ...
+
+    def get_index_name(self) -> str:
+        '''Returns the name of the index'''
+        return self.index
+
+    def push_log(self, log: dict) -> None:
+        '''Pushes log to database'''
+        self.insert(log)
+
+
+class ConnectorPool:
+    '''Process-wide pool of database clients keyed by host:port, with the set of indices known to exist.
+
+    Args:
+        factory (Callable): Creates a client from (host, port)
+        check (Callable): Called on a newly created client, False if the database cannot be reached
+    '''
+    def __init__(self, factory: Callable[[str, int], Any], check: Callable[[Any], bool] = None):
+        self.factory = factory
+        self.check = check
+        self.clients: dict[str, Any] = {}
+        self.users: dict[str, int] = {}
+        self.known_indices: dict[str, set[str]] = {}
+        self.lock = threading.Lock()
+
+    def acquire(self, host: str, port: int) -> Any:
+        '''Returns the client of host:port, created (and checked) on first use'''
+        key = f'{host}:{port}'
+        with self.lock:
+            if key not in self.clients:
+                client = self.factory(host, port)
+                if self.check is not None and not self.check(client):
+                    client.close()
+                    raise ConnectionError('Could not connect to database')
+                self.clients[key] = client
+                self.users[key] = 0
+                self.known_indices[key] = set()
+            self.users[key] += 1
+            return self.clients[key]
+
+    def release(self, host: str, port: int) -> None:
+        '''Gives a client back to the pool, the connection stays open for the next connector'''
+        key = f'{host}:{port}'
+        with self.lock:
+            if key in self.users: self.users[key] = max(0, self.users[key] - 1)
+
+    def is_known_index(self, host: str, port: int, index: str) -> bool:
+        with self.lock:
+            return index in self.known_indices.get(f'{host}:{port}', ())
+
+    def add_known_index(self, host: str, port: int, index: str) -> None:
+        with self.lock:
+            self.known_indices.setdefault(f'{host}:{port}', set()).add(index)
+
+    def forget_index(self, host: str, port: int, index: str) -> None:
+        with self.lock:
+            self.known_indices.get(f'{host}:{port}', set()).discard(index)
+
+    def close_all(self) -> None:
+        '''Closes every pooled client'''
+        with self.lock:
+            for client in self.clients.values(): client.close()
+            self.clients.clear(); self.users.clear(); self.known_indices.clear()
+
+
+ELASTIC_POOL = ConnectorPool(lambda host, port: Elasticsearch(f'http://{host}:{port}'), lambda es: es.ping())
 
 
-class ElasticConnector:
-    '''Driver for ElasticSearch database
+class ElasticConnector(DatabaseConnector):
+    '''Driver for ElasticSearch database.
+    The families of indices.FAMILIES are time-partitioned: their name is an alias over the partitions, documents
+    written to it go to the partition of their timestamp, created from the index template of the family.
     
     Args:
         host (str): Host of the database
         port (int): Port of the database
-        index (str): Index of the database
+        index (str): Index (or family alias) of the database
+        partition_period (str): Period of the partitions, see indices.PERIOD_FORMATS
     '''
 
-    def __init__(self, host: str, port: int, index: str):
-        self.host = host
-        self.port = port
-        self.index = index
-        self.es = Elasticsearch(f'http://{self.host}:{self.port}')
-        if not self.test_connection():
-            raise ConnectionError('Could not connect to database')
+    def __init__(self, host: str, port: int, index: str, partition_period: str = 'day'):
+        super().__init__(host, port, index)
+        self.partition_period = partition_period
+        self.es: Elasticsearch = ELASTIC_POOL.acquire(self.host, self.port)
         if self.index is not None:
             self._create_index(self.index)
     
@@ -34,54 +173,310 @@ class ElasticConnector:
         return self.es.ping()
     
     def _create_index(self, index = None) -> None:
-        '''Creates index if it does not exist'''
+        '''Creates index (or the template of a family) if it does not exist, the cluster is only asked once per index per process'''
         self.index = index
-        if not self.es.indices.exists(index=self.index):
-            self.es.indices.create(index=self.index)
+        self._ensure_index(index)
+
+    def _ensure_index(self, index: str) -> None:
+        if ELASTIC_POOL.is_known_index(self.host, self.port, index): return
+        if index in FAMILIES:
+            self.es.indices.put_index_template(name=index, **FAMILIES[index].template())
+        elif not self.es.indices.exists(index=index):
+            self.es.indices.create(index=index)
+        ELASTIC_POOL.add_known_index(self.host, self.port, index)
+
+    def _route(self, index: str, document: dict) -> str:
+        '''Returns the index a document is written to: the partition of its timestamp for the families'''
+        if index not in FAMILIES: return index
+        self._ensure_index(index)
+        return FAMILIES[index].partition(document.get('timestamp') or time(), self.partition_period)
     
     def insert(self, data: dict) -> str:
         '''Inserts data into database and returns the id of the inserted data'''
-        return str(self.es.index(index=self.index, document=data))
+        return str(self.es.index(index=self._route(self.index, data), document=data))
+
+    def bulk(self, documents: list[tuple[str, dict]]) -> list[int]:
+        '''Inserts (index, document) pairs with the bulk API and returns the status of each document (409 for a duplicate)'''
+        if not documents: return []
+        operations = []
+        for index, document in documents:
+            if IDEMPOTENCY_KEY in document: # the copies keep the timestamp of the entry on the node, hence its partition
+                operations.append({'create': {'_index': self._route(index, document), '_id': document['doc_id']}}) # 409 if already written
+            else: operations.append({'index': {'_index': self._route(index, document)}})
+            operations.append(document)
+        res = self.es.bulk(operations=operations)
+        if not res['errors']: return [201] * len(documents)
+        return [next(iter(item.values()))['status'] for item in res['items']]
 
     def get_by_id(self, id: str) -> dict:
         '''Returns data from database by id'''
-        return self.es.get(index=self.index, id=id)
+        if self.index not in FAMILIES: return self.es.get(index=self.index, id=id)
+        hits = self.es.search(index=self.index, query={'ids': {'values': [id]}})['hits']['hits'] # GET cannot span an alias
+        if not hits: return {'_index': self.index, '_id': id, 'found': False}
+        return {**hits[0], 'found': True}
 
-    def search(self, query: dict) -> dict:
+    def search(self, query: dict, size: int = 10) -> dict:
         '''Returns data from database by query'''
-        return self.es.search(index=self.index, query=query)
+        return self.es.search(index=self.index, query=query, size=size)
+
+    def search_page(self, query: dict, size: int, after: list = None, fields: list[str] = None, descending: bool = False) -> tuple[list[dict], Union[list, None]]:
+        '''Returns one page of documents with search_after on (timestamp, doc_id), stable while documents are written'''
+        order = 'desc' if descending else 'asc'
+        res = self.es.search(
+            index=self.index, query=query, size=size, search_after=after, track_total_hits=False,
+            sort=[{'timestamp': order}, {'doc_id': order}],
+            source=fields if fields else True,
+        )
+        hits = res['hits']['hits']
+        return [h.get('_source', {}) for h in hits], (hits[-1]['sort'] if len(hits) == size else None)
     
     def delete_by_id(self, id: str) -> None:
         '''Deletes data from database by id'''
-        self.es.delete(index=self.index, id=id)
+        if self.index in FAMILIES: self.es.delete_by_query(index=self.index, query={'ids': {'values': [id]}})
+        else: self.es.delete(index=self.index, id=id)
     
     def update(self, id: str, data: dict) -> None:
         '''Updates data in database by id'''
         self.es.update(index=self.index, id=id, body=data)
     
     def delete_index(self) -> None:
-        '''Deletes index from database'''
-        self.es.indices.delete(index=self.index)
+        '''Deletes index from database, every partition and the template for a family'''
+        if self.index in FAMILIES:
+            self.es.indices.delete(index=FAMILIES[self.index].pattern)
+            self.es.indices.delete_index_template(name=self.index)
+        else: self.es.indices.delete(index=self.index)
+        ELASTIC_POOL.forget_index(self.host, self.port, self.index)
     
     def get_all(self) -> dict:
         '''Returns all data from database'''
         return self.es.search(index=self.index, size=100, query={'match_all': {}})
     
     def delete_all(self) -> None:
-        '''Deletes all data from database'''
-        self.es.delete_by_query(index=self.index, query={'match_all': {}})
-    
-    def get_index_name(self) -> str:
-        '''Returns the name of the index'''
-        return self.index
-    
-    def push_log(self, log: dict) -> None:
-        '''Pushes log to database'''
-        self.insert(log)
+        '''Deletes all data from database, drops the partitions of a family'''
+        if self.index in FAMILIES: self.es.indices.delete(index=FAMILIES[self.index].pattern)
+        else: self.es.delete_by_query(index=self.index, query={'match_all': {}})
+
+    def drop_before(self, index: str, timestamp: float) -> None:
+        '''Deletes the documents older than timestamp: drops the partitions that ended before it for a family'''
+        if index not in FAMILIES:
+            self.es.delete_by_query(index=index, query={'range': {'timestamp': {'lt': timestamp}}})
+            return
+        family = FAMILIES[index]
+        expired = [i for i in self.es.indices.get(index=family.pattern) if (family.partition_end(i, self.partition_period) or timestamp) < timestamp]
+        if expired: self.es.indices.delete(index=','.join(expired))
     
     def close(self) -> None:
-        '''Closes connection to database'''
-        self.es.close()
+        '''Gives the client back to the pool, the connection to the database stays open'''
+        ELASTIC_POOL.release(self.host, self.port)
+
+
+class SQLiteDatabase:
+    '''SQLite connection shared by the connectors of one database file, the lock serializes its users'''
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL') # WAL stays consistent, only the last transactions can be lost on power failure
+        self.lock = threading.Lock()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+SQLITE_POOL = ConnectorPool(lambda path, _: SQLiteDatabase(path))
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_COLUMNS = ('node', 'type', 'kind', 'name', 'timestamp') # document fields stored in their own column
+_RANGE_OPERATORS = {'gt': '>', 'gte': '>=', 'lt': '<', 'lte': '<='}
+
+def _escape_like(value: Any) -> str:
+    return re.sub(r'([%_\\])', r'\\\1', str(value))
+
+
+class SQLiteConnector(DatabaseConnector):
+    '''Driver for an embedded SQLite database, for setups without the ELK stack.
+    Every index is a table holding the JSON documents, with the common fields copied to indexed columns.
+    The families of indices.FAMILIES are not partitioned, retention deletes rows by timestamp.
+    `search` understands the subset of the Elasticsearch query DSL used by the server:
+    match_all, term, terms, match (substring), prefix, range and bool (must, filter, must_not, should).
+
+    Args:
+        path (str): Path of the database file
+        index (str): Index (table) of the database
+    '''
+
+    def __init__(self, path: str, index: str):
+        super().__init__(path, None, index)
+        self.db: SQLiteDatabase = SQLITE_POOL.acquire(self.host, self.port)
+        if self.index is not None:
+            self._create_index(self.index)
+
+    def test_connection(self) -> bool:
+        with self.db.lock:
+            return self.db.conn.execute('SELECT 1').fetchone() == (1,)
+
+    def _create_index(self, index: str) -> None:
+        '''Creates the table of the index and its indices if they do not exist'''
+        if not _IDENTIFIER.match(index): raise ValueError(f'Invalid index name {index}')
+        if SQLITE_POOL.is_known_index(self.host, self.port, index): return
+        with self.db.lock:
+            self.db.conn.executescript(f'''
+                CREATE TABLE IF NOT EXISTS "{index}" (
+                    id INTEGER PRIMARY KEY, node TEXT, type TEXT, kind TEXT, name TEXT, timestamp REAL, doc TEXT NOT NULL, dedup_key TEXT
+                );
+                CREATE INDEX IF NOT EXISTS "{index}_node_timestamp" ON "{index}" (node, timestamp);
+                CREATE INDEX IF NOT EXISTS "{index}_node_kind" ON "{index}" (node, kind);
+                CREATE INDEX IF NOT EXISTS "{index}_timestamp" ON "{index}" (timestamp);
+            ''')
+            if 'dedup_key' not in {c[1] for c in self.db.conn.execute(f'PRAGMA table_info("{index}")')}: # table of an older version
+                self.db.conn.execute(f'ALTER TABLE "{index}" ADD COLUMN dedup_key TEXT')
+            self.db.conn.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{index}_dedup_key" ON "{index}" (dedup_key)') # NULLs never conflict
+        SQLITE_POOL.add_known_index(self.host, self.port, index)
+
+    @staticmethod
+    def _row(document: dict) -> tuple:
+        return (*(document.get(c) for c in _COLUMNS), json.dumps(document), document.get('doc_id') if IDEMPOTENCY_KEY in document else None)
+
+    @staticmethod
+    def _insert_statement(index: str) -> str:
+        return f'INSERT OR IGNORE INTO "{index}" ({", ".join(_COLUMNS)}, doc, dedup_key) VALUES ({", ".join("?" * (len(_COLUMNS) + 2))})'
+
+    @staticmethod
+    def _hit(index: str, row: tuple) -> dict:
+        return {'_index': index, '_id': str(row[0]), '_source': json.loads(row[1])}
+
+    def insert(self, data: dict) -> str:
+        '''Inserts data into database and returns the id of the inserted data'''
+        row = self._row(data)
+        with self.db.lock:
+            cur = self.db.conn.execute(self._insert_statement(self.index), row)
+            if cur.rowcount == 0: # duplicate
+                return str(self.db.conn.execute(f'SELECT id FROM "{self.index}" WHERE dedup_key = ?', (row[-1],)).fetchone()[0])
+        return str(cur.lastrowid)
+
+    def bulk(self, documents: list[tuple[str, dict]]) -> list[int]:
+        '''Inserts (index, document) pairs in one transaction, one prepared statement per index.
+        Documents with an idempotency key are inserted one by one to report their duplicates (409)'''
+        by_index: dict[str, list[tuple]] = {}
+        keyed: list[tuple[int, str, tuple]] = [] # (position, index, row)
+        for i, (index, document) in enumerate(documents):
+            row = self._row(document)
+            if row[-1] is not None: keyed.append((i, index, row))
+            else: by_index.setdefault(index, []).append(row)
+        for index in {index for index, _ in documents}: self._create_index(index)
+        statuses = [201] * len(documents)
+        with self.db.lock:
+            self.db.conn.execute('BEGIN')
+            try:
+                for index, rows in by_index.items():
+                    self.db.conn.executemany(self._insert_statement(index), rows)
+                for i, index, row in keyed:
+                    if self.db.conn.execute(self._insert_statement(index), row).rowcount == 0: statuses[i] = 409
+                self.db.conn.execute('COMMIT')
+            except:
+                self.db.conn.execute('ROLLBACK')
+                raise
+        return statuses
+
+    def get_by_id(self, id: str) -> dict:
+        '''Returns data from database by id'''
+        with self.db.lock:
+            row = self.db.conn.execute(f'SELECT id, doc FROM "{self.index}" WHERE id = ?', (int(id),)).fetchone()
+        if row is None: return {'_index': self.index, '_id': str(id), 'found': False}
+        return {**self._hit(self.index, row), 'found': True}
+
+    def _field(self, field: str) -> str:
+        field = field.removesuffix('.keyword')
+        if field in _COLUMNS: return field
+        if field == '_id': return 'id'
+        if not all(_IDENTIFIER.match(p) for p in field.split('.')): raise ValueError(f'Invalid field {field}')
+        return f"json_extract(doc, '$.{field}')"
+
+    def _compile(self, query: dict) -> tuple[str, list]:
+        '''Translates an Elasticsearch query to a WHERE clause and its parameters'''
+        (kind, body), = query.items()
+        if kind == 'match_all': return '1', []
+        if kind == 'bool':
+            clauses, params = [], []
+            for occur in ('must', 'filter', 'must_not', 'should'):
+                subs = body.get(occur, [])
+                if not subs: continue
+                compiled = [self._compile(q) for q in (subs if isinstance(subs, list) else [subs])]
+                params += [p for _, ps in compiled for p in ps]
+                if occur == 'must_not': clauses += [f'NOT ({c})' for c, _ in compiled]
+                elif occur == 'should': clauses.append(' OR '.join(f'({c})' for c, _ in compiled))
+                else: clauses += [f'({c})' for c, _ in compiled]
+            return ' AND '.join(f'({c})' for c in clauses) or '1', params
+        (field, value), = body.items()
+        column = self._field(field)
+        if kind == 'range':
+            ops = [(_RANGE_OPERATORS[op], v) for op, v in value.items() if op in _RANGE_OPERATORS]
+            return ' AND '.join(f'{column} {op} ?' for op, _ in ops) or '1', [v for _, v in ops]
+        if kind == 'terms': return f'{column} IN ({", ".join("?" * len(value))})', list(value)
+        if isinstance(value, dict): value = value.get('value', value.get('query'))
+        if kind == 'term': return f'{column} = ?', [value]
+        if kind in ('match', 'match_phrase'): return f"{column} LIKE '%' || ? || '%' ESCAPE '\\'", [_escape_like(value)]
+        if kind == 'prefix': return f"{column} LIKE ? || '%' ESCAPE '\\'", [_escape_like(value)]
+        raise ValueError(f'Unsupported query {kind}')
+
+    def search(self, query: dict, size: int = 10) -> dict:
+        '''Returns data from database by query'''
+        where, params = self._compile(query)
+        with self.db.lock:
+            total = self.db.conn.execute(f'SELECT COUNT(*) FROM "{self.index}" WHERE {where}', params).fetchone()[0]
+            rows = self.db.conn.execute(f'SELECT id, doc FROM "{self.index}" WHERE {where} ORDER BY id LIMIT ?', (*params, size)).fetchall()
+        return {'hits': {'total': {'value': total, 'relation': 'eq'}, 'hits': [self._hit(self.index, r) for r in rows]}}
+
+    def search_page(self, query: dict, size: int, after: list = None, fields: list[str] = None, descending: bool = False) -> tuple[list[dict], Union[list, None]]:
+        '''Returns one page of documents by keyset pagination on (timestamp, id), served by the timestamp index'''
+        where, params = self._compile(query)
+        op, order = ('<', 'DESC') if descending else ('>', 'ASC')
+        if after is not None:
+            where = f'({where}) AND (timestamp, id) {op} (?, ?)'
+            params = [*params, *after]
+        with self.db.lock:
+            rows = self.db.conn.execute(
+                f'SELECT id, timestamp, doc FROM "{self.index}" WHERE {where} ORDER BY timestamp {order}, id {order} LIMIT ?', (*params, size)
+            ).fetchall()
+        docs = [json.loads(r[2]) for r in rows]
+        if fields: docs = [{f: d[f] for f in fields if f in d} for d in docs]
+        return docs, ([rows[-1][1], rows[-1][0]] if len(rows) == size else None)
+
+    def delete_by_id(self, id: str) -> None:
+        '''Deletes data from database by id'''
+        with self.db.lock:
+            self.db.conn.execute(f'DELETE FROM "{self.index}" WHERE id = ?', (int(id),))
+
+    def delete_index(self) -> None:
+        '''Deletes index from database'''
+        with self.db.lock:
+            self.db.conn.execute(f'DROP TABLE IF EXISTS "{self.index}"')
+        SQLITE_POOL.forget_index(self.host, self.port, self.index)
+
+    def get_all(self) -> dict:
+        '''Returns all data from database'''
+        return self.search({'match_all': {}}, size=100)
+
+    def delete_all(self) -> None:
+        '''Deletes all data from database'''
+        with self.db.lock:
+            self.db.conn.execute(f'DELETE FROM "{self.index}"')
+
+    def drop_before(self, index: str, timestamp: float) -> None:
+        '''Deletes the documents older than timestamp'''
+        self._create_index(index)
+        with self.db.lock:
+            self.db.conn.execute(f'DELETE FROM "{index}" WHERE timestamp < ?', (timestamp,))
+
+    def close(self) -> None:
+        '''Gives the connection back to the pool'''
+        SQLITE_POOL.release(self.host, self.port)
+
+
+def open_connector(config: DatabaseConfig, index: str = None) -> DatabaseConnector:
+    '''Returns a connector on the backend selected by the `database` section of the server config'''
+    if config.backend == BACKEND_ELASTICSEARCH: return ElasticConnector(config.host, config.port, index, config.partition_period)
+    if config.backend == BACKEND_SQLITE: return SQLiteConnector(config.path, index)
+    raise ValueError(f'Unknown database backend {config.backend}')
 
 
 #################### TESTS ####################
@@ -0,0 +1,165 @@
+'''Verification of the connection tokens off the event loop'''
+
+import asyncio
+import hashlib
+import hmac
+import multiprocessing
+import os
+import secrets
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+from time import time
+from typing import Union
+
+import dvic_log_server.api as api
+from dvic_log_server.network.packets import PacketSessionTicket
+from dvic_log_server.utils.crypto import CryptPhonebook, split_initial_token, verify_with_cached_key
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info, error
+
+@dataclass
+class HandshakeConfig:
+    workers: int = None        # verifier processes, one per CPU by default, 0 verifies on the event loop
+    max_concurrent: int = None # signatures verified at once, 2 per worker by default, the other handshakes wait their turn
+    ticket_lifetime: float = 300.0 # seconds a resumption ticket stays valid after its connection closed, 0 disables them
+
+TICKET_PREFIX = '~' # tokens of craft_initial_token start with the uid
+
+class TicketStore:
+    '''Single-use resumption tickets `~{uid}.{nonce}.{hmac}`, authenticated with a key drawn at startup.
+    A node holds at most one ticket: issuing a new one revokes the previous one, redeeming it removes it.
+    A ticket is valid while the connection it was issued on is open and `lifetime` seconds after it closed,
+    so a node that notices a drop before the server can still resume. Tickets do not survive a restart.
+
+        ----- Parameters -----
+        lifetime : float
+            Validity in seconds after the connection closed
+        key : bytes = None
+            HMAC key, random by default
+    '''
+    def __init__(self, lifetime: float, key: bytes = None) -> None:
+        self.lifetime = lifetime
+        self.key = key or secrets.token_bytes(32)
+        self.tickets: dict[str, list] = {} # uid -> [nonce, expiry or None while its connection is open]
+
+    def _mac(self, uid: str, nonce: str) -> str:
+        return hmac.new(self.key, f'{uid}.{nonce}'.encode(), hashlib.sha256).hexdigest()
+
+    def issue(self, uid: str) -> str:
+        nonce = secrets.token_hex(16)
+        self.tickets[uid] = [nonce, None]
+        return f'{TICKET_PREFIX}{uid}.{nonce}.{self._mac(uid, nonce)}'
+
+    def closed(self, uid: str, ticket: str, now: float = None) -> None:
+        '''The connection the ticket was issued on closed, the lifetime of the ticket starts'''
+        entry = self.tickets.get(uid)
+        if entry is not None and ticket.rsplit('.', 2)[1] == entry[0]: entry[1] = (time() if now is None else now) + self.lifetime
+
+    def redeem(self, token: str, now: float = None) -> tuple[str, bool]:
+        """Check and consume a ticket, constant-time comparisons only
+
+        Returns
+        -------
+        tuple[str, bool]
+            The uid of the node and whether the ticket is valid
+        """
+        try: uid, nonce, mac = token[len(TICKET_PREFIX):].rsplit('.', 2)
+        except ValueError: return token[len(TICKET_PREFIX):], False
+        if not hmac.compare_digest(mac.encode(), self._mac(uid, nonce).encode()): return uid, False
+        entry = self.tickets.get(uid)
+        if entry is None or not hmac.compare_digest(entry[0].encode(), nonce.encode()): return uid, False # used or revoked
+        del self.tickets[uid]
+        return uid, entry[1] is None or entry[1] >= (time() if now is None else now)
+
+class PublicKeyCache:
+    '''PEM of the node public keys stored in a directory (one file per uid), read again when the mtime of the file changes
+
+        ----- Parameters -----
+        directory : Union[str, Path]
+            The `keys_save_path` of the server config
+    '''
+    def __init__(self, directory: Union[str, Path]) -> None:
+        self.directory = Path(directory)
+        self.keys: dict[str, tuple[int, str]] = {} # uid -> (mtime in ns, PEM)
+
+    def get(self, uid: str) -> Union[tuple[int, str], None]:
+        '''Returns the (version, PEM) of the key of uid, None if the node is unknown'''
+        if not uid or Path(uid).name != uid: return None # uid comes from the token
+        path = self.directory / uid
+        try: mtime = path.stat().st_mtime_ns
+        except OSError:
+            self.keys.pop(uid, None)
+            return None
+        cached = self.keys.get(uid)
+        if cached is None or cached[0] != mtime:
+            cached = self.keys[uid] = (mtime, path.read_text())
+        return cached
+
+@singleton
+class HandshakeVerifier:
+    '''Checks the initial tokens of the websocket connections. The ECDSA verification (tens of milliseconds in pure Python)
+    runs in a process pool, at most `max_concurrent` at once, so a reconnect storm does not stall the other connections.
+    Public keys are only read when their file changes, and parsed once per version in every worker.
+
+        ----- Parameters -----
+        config : HandshakeConfig = None
+            Read from the `handshake` section of the server config by default
+        keys_path : str = None
+            Directory of the node public keys, `keys_save_path` of the server config by default
+    '''
+    def __init__(self, config: HandshakeConfig = None, keys_path: str = None) -> None:
+        cfg = api.ConnectionManager().config if config is None or keys_path is None else None
+        if config is None: config = HandshakeConfig(**(cfg.handshake or {}))
+        if keys_path is None: keys_path = cfg.keys_save_path
+        self.config = config
+        self.workers = (os.cpu_count() or 1) if config.workers is None else config.workers
+        self.pool: ProcessPoolExecutor = self._new_pool() if self.workers > 0 else None
+        self.semaphore = asyncio.Semaphore(config.max_concurrent or 2 * max(self.workers, 1))
+        self.keys = PublicKeyCache(keys_path)
+        self.tickets = TicketStore(config.ticket_lifetime) if config.ticket_lifetime > 0 else None
+        self.stats = {'accepted': 0, 'rejected': 0, 'resumed': 0}
+        info(f'[AUTH] Verifying handshakes in {self.workers or "no"} worker processes')
+
+    async def verify(self, token: str, phone_book: CryptPhonebook) -> tuple[str, bool]:
+        """Check the token of a connection, a resumption ticket or a signed token (see CryptClient.verify_initial_packet)
+
+        Returns
+        -------
+        tuple[str, bool]
+            The uid of the node and whether the token is valid
+        """
+        if token.startswith(TICKET_PREFIX) and phone_book.is_secure_auth_enabled():
+            uid, ok = self.tickets.redeem(token) if self.tickets is not None else (token[len(TICKET_PREFIX):].rsplit('.', 2)[0], False)
+            self.stats['resumed' if ok else 'rejected'] += 1
+            return uid, ok
+        uid, plaintext, salt, signature = split_initial_token(token)
+        if not phone_book.is_secure_auth_enabled(): return uid, True
+        try: expected = phone_book.get_client_salt(uid)
+        except KeyError: expected = None # no preauth
+        key = self.keys.get(uid)
+        ok = key is not None and salt == expected and await self._verify(uid, key, plaintext, signature)
+        self.stats['accepted' if ok else 'rejected'] += 1
+        return uid, ok
+
+    async def _verify(self, uid: str, key: tuple[int, str], plaintext: str, signature: str) -> bool:
+        async with self.semaphore:
+            if self.pool is None: return verify_with_cached_key(uid, *key, plaintext, signature)
+            try: return await asyncio.get_running_loop().run_in_executor(self.pool, verify_with_cached_key, uid, *key, plaintext, signature)
+            except BrokenProcessPool:
+                error(f'[AUTH] Verifier pool died, restarting it ({uid} rejected)')
+                self.pool = self._new_pool()
+                return False
+
+    def _new_pool(self) -> ProcessPoolExecutor:
+        # spawned, forked workers would inherit the listening socket of the server and keep it bound once orphaned
+        return ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def ticket_for(self, uid: str, phone_book: CryptPhonebook) -> Union[PacketSessionTicket, None]:
+        '''Resumption ticket of a connection just accepted, None if tickets are disabled'''
+        if self.tickets is None or not phone_book.is_secure_auth_enabled(): return None
+        return PacketSessionTicket(self.tickets.issue(uid), self.tickets.lifetime)
+
+    def close(self) -> None:
+        if self.pool is not None: self.pool.shutdown(cancel_futures=True)
@@ -0,0 +1,219 @@
+'''In-memory history of the numeric hardware metrics, for the charts of the dashboard'''
+
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any
+
+import numpy as np
+
+import dvic_log_server.api as api
+from dvic_log_server.metrics import metric_samples
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info, warning
+
+DOWNSAMPLE_LTTB = 'lttb'
+DOWNSAMPLE_MINMAX = 'minmax'
+
+@dataclass
+class HistoryConfig:
+    capacity: int = 60_480       # samples kept per series, a week of 10 second samples
+    max_series: int = 5_000      # 500 nodes with 10 series each (cpu, 4 memory fields, temperature zones)
+    max_bytes: int = 4 * 2**30   # memory bound of the full rings, capacity is reduced to fit max_series in it
+    stale_after: float = 3600.0  # once max_series is reached, a new series only replaces a series idle for this long
+
+SAMPLE_BYTES = np.dtype(np.float64).itemsize + np.dtype(np.float32).itemsize
+
+class RingSeries:
+    '''Fixed-size ring of (timestamp, value) samples in two NumPy columns.
+    Samples are appended in time order, the oldest ones are overwritten once the ring is full.
+
+        ----- Parameters -----
+        capacity : int
+            Number of samples kept
+    '''
+    __slots__ = ('timestamps', 'values', 'head', 'count')
+
+    def __init__(self, capacity: int) -> None:
+        self.timestamps = np.empty(capacity, dtype=np.float64) # pages are only touched as the ring fills up
+        self.values = np.empty(capacity, dtype=np.float32)
+        self.head = 0  # next write position
+        self.count = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.timestamps)
+
+    @property
+    def last(self) -> float:
+        '''Timestamp of the latest sample'''
+        return float(self.timestamps[self.head - 1]) if self.count else float('-inf')
+
+    def append(self, timestamp: float, value: float) -> None:
+        self.timestamps[self.head] = timestamp
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def extend(self, timestamps: np.ndarray, values: np.ndarray) -> None:
+        '''Append many samples at once'''
+        timestamps, values = timestamps[-self.capacity:], values[-self.capacity:]
+        n = len(timestamps)
+        first = min(n, self.capacity - self.head)
+        self.timestamps[self.head:self.head + first], self.values[self.head:self.head + first] = timestamps[:first], values[:first]
+        self.timestamps[:n - first], self.values[:n - first] = timestamps[first:], values[first:]
+        self.head = (self.head + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+
+    def _segments(self) -> list[slice]:
+        '''The filled part of the ring as at most two slices, oldest first'''
+        start = (self.head - self.count) % self.capacity
+        if start + self.count <= self.capacity: return [slice(start, start + self.count)]
+        return [slice(start, self.capacity), slice(0, self.head)]
+
+    def range(self, start: float = None, end: float = None) -> tuple[np.ndarray, np.ndarray]:
+        '''Returns copies of the timestamps and values of the samples in [start, end], in time order'''
+        ts, vs = [], []
+        for seg in self._segments():
+            t = self.timestamps[seg]
+            lo = 0 if start is None else np.searchsorted(t, start, 'left')
+            hi = len(t) if end is None else np.searchsorted(t, end, 'right')
+            if lo < hi:
+                ts.append(t[lo:hi])
+                vs.append(self.values[seg][lo:hi])
+        if not ts: return np.empty(0, np.float64), np.empty(0, np.float32)
+        return np.concatenate(ts), np.concatenate(vs)
+
+
+def _minmax_indices(values: np.ndarray, points: int) -> np.ndarray:
+    n, buckets = len(values), max(1, points // 2)
+    size = -(-n // buckets)
+    padded = np.full(buckets * size, np.nan, dtype=np.float64)
+    padded[:n] = values
+    padded = padded.reshape(buckets, size)
+    full = ~np.all(np.isnan(padded), axis=1) # the last buckets may be padding only
+    padded = padded[full]
+    offsets = np.arange(buckets)[full] * size
+    lo, hi = offsets + np.nanargmin(padded, axis=1), offsets + np.nanargmax(padded, axis=1)
+    return np.unique(np.stack([lo, hi], axis=1).ravel()) # sorted, a flat bucket gives one point
+
+
+def downsample_minmax(timestamps: np.ndarray, values: np.ndarray, points: int) -> tuple[np.ndarray, np.ndarray]:
+    '''Keeps the min and the max of points/2 buckets of equal sample count, in time order'''
+    if len(values) <= points: return timestamps, values
+    idx = _minmax_indices(values, points)
+    return timestamps[idx], values[idx]
+
+
+def _lttb(x: list[float], y: list[float], points: int) -> list[int]:
+    n = len(x)
+    bucket = (n - 2) / (points - 2)
+    idx = [0]
+    a = 0
+    for i in range(points - 2):
+        lo, hi = int(i * bucket) + 1, int((i + 1) * bucket) + 1
+        nhi = min(int((i + 2) * bucket) + 1, n)
+        avg_x, avg_y = sum(x[hi:nhi]) / (nhi - hi), sum(y[hi:nhi]) / (nhi - hi)
+        xa, ya = x[a], y[a]
+        best, a = -1.0, lo
+        for j in range(lo, hi):
+            area = abs((xa - avg_x) * (y[j] - ya) - (xa - x[j]) * (avg_y - ya))
+            if area > best: best, a = area, j
+        idx.append(a)
+    idx.append(n - 1)
+    return idx
+
+
+def downsample_lttb(timestamps: np.ndarray, values: np.ndarray, points: int) -> tuple[np.ndarray, np.ndarray]:
+    '''Largest-Triangle-Three-Buckets: keeps the first and last samples and, in each of points-2 buckets,
+    the sample forming the largest triangle with the previous kept sample and the average of the next bucket.
+    Long series are first reduced to their min and max samples over 4 * points buckets (MinMaxLTTB),
+    which keeps the LTTB selection while only scanning a few candidates per bucket.'''
+    if len(values) <= points or points < 3: return timestamps, values
+    if len(values) > 4 * points:
+        keep = np.union1d(_minmax_indices(values, 4 * points), [0, len(values) - 1])
+        timestamps, values = timestamps[keep], values[keep]
+    x = (timestamps - timestamps[0]).tolist() # offsets keep the precision of the areas
+    idx = _lttb(x, values.tolist(), points)
+    return timestamps[idx], values[idx]
+
+DOWNSAMPLERS = {DOWNSAMPLE_LTTB: downsample_lttb, DOWNSAMPLE_MINMAX: downsample_minmax}
+
+
+@singleton
+class MetricHistory:
+    '''Recent samples of every numeric metric of every node, fed by the hardware state handler.
+    A series is named after the state kind (`cpu_usage`) or kind and field for dict states (`memory_usage.used`),
+    see metrics.metric_samples.
+
+        ----- Parameters -----
+        config : HistoryConfig = None
+            Read from the `history` section of the server config by default
+    '''
+    def __init__(self, config: HistoryConfig = None) -> None:
+        if config is None:
+            cfg = api.ConnectionManager().config
+            config = HistoryConfig(**(cfg.history or {})) if cfg is not None else HistoryConfig()
+        self.config = config
+        self.max_series = config.max_series
+        self.capacity = max(1, min(config.capacity, config.max_bytes // (config.max_series * SAMPLE_BYTES)))
+        self.series: OrderedDict[tuple[str, str], RingSeries] = OrderedDict() # (node, metric), least recently updated first
+        self.lock = threading.Lock()
+        self.evicted = 0 # idle series replaced by new ones
+        self.refused = 0 # samples of new series dropped while every series was updated recently
+        if self.capacity < config.capacity: warning(f'[HISTORY] {config.max_series} series of {config.capacity} samples do not fit in max_bytes, keeping {self.capacity} samples per series')
+        info(f'[HISTORY] Keeping {self.capacity} samples for up to {self.max_series} series')
+
+    def add(self, uid: str, kind: str, data: Any, timestamp: float) -> None:
+        '''Record the numeric fields of a hardware state'''
+        with self.lock:
+            for metric, value in metric_samples(kind, data):
+                series = self.series.get((uid, metric))
+                if series is None:
+                    if len(self.series) >= self.max_series:
+                        oldest = next(iter(self.series.values()))
+                        if oldest.last > timestamp - self.config.stale_after: # full of live series, they keep their history
+                            self.refused += 1
+                            continue
+                        self.series.popitem(last=False)
+                        self.evicted += 1
+                    series = self.series[(uid, metric)] = RingSeries(self.capacity)
+                else: self.series.move_to_end((uid, metric))
+                series.append(timestamp, value)
+
+    def metrics(self, uid: str) -> list[str]:
+        '''Returns the series recorded for a node'''
+        with self.lock:
+            return sorted(m for n, m in self.series if n == uid)
+
+    def query(self, uid: str, metric: str, start: float = None, end: float = None, points: int = 500, method: str = DOWNSAMPLE_LTTB) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the samples of a series in a time range, downsampled
+
+        Parameters
+        ----------
+        uid : str
+            The node
+        metric : str
+            The series, e.g. `cpu_usage` or `temperature.acpitz`
+        start, end : float, optional
+            Bounds of the range (seconds since epoch), by default the whole history
+        points : int, optional
+            Max number of samples returned, by default 500
+        method : str, optional
+            DOWNSAMPLE_LTTB (shape of the curve) or DOWNSAMPLE_MINMAX (keeps the peaks), by default DOWNSAMPLE_LTTB
+
+        Returns
+        -------
+        tuple[np.ndarray, np.ndarray]
+            Timestamps and values
+
+        Raises
+        ------
+        KeyError
+            No such series
+        """
+        downsample = DOWNSAMPLERS[method]
+        with self.lock:
+            series = self.series[(uid, metric)]
+            timestamps, values = series.range(start, end) # copies, downsampled outside the lock
+        return downsample(timestamps, values, points)
@@ -0,0 +1,95 @@
+'''Time-partitioned indices of the logs and hardware states.
+
+Every family of documents is stored in one index per period (e.g. `machine_logs-2023.05.17`), created on first write
+from an index template that holds the explicit mappings and adds the partition to an alias named after the family.
+Writes and queries address the family alias, the drivers route each document to the partition of its timestamp
+and retention drops whole partitions.
+'''
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Union
+
+PERIOD_FORMATS = {
+    'hour': '%Y.%m.%d.%H',
+    'day': '%Y.%m.%d',
+    'month': '%Y.%m',
+}
+
+_KEYWORD = {'type': 'keyword'}
+_TIMESTAMP = {'type': 'date', 'format': 'epoch_second'}
+
+@dataclass(frozen=True)
+class IndexFamily:
+    name: str       # alias of the family, also the prefix of its partitions
+    mappings: dict  # explicit mappings of the partitions
+    period: str = None # period of the partitions, the one of the database config if None
+
+    @property
+    def pattern(self) -> str:
+        return f'{self.name}-*'
+
+    def partition(self, timestamp: float, period: str = 'day') -> str:
+        '''Returns the name of the partition holding a document of this timestamp (seconds since epoch, UTC)'''
+        period = self.period or period
+        return f'{self.name}-{datetime.fromtimestamp(timestamp, timezone.utc).strftime(PERIOD_FORMATS[period])}'
+
+    def partition_end(self, index: str, period: str = 'day') -> Union[float, None]:
+        '''Returns the timestamp at which a partition stops receiving documents, None if `index` is not a partition'''
+        if not index.startswith(f'{self.name}-'): return None
+        period = self.period or period
+        try: start = datetime.strptime(index[len(self.name) + 1:], PERIOD_FORMATS[period]).replace(tzinfo=timezone.utc)
+        except ValueError: return None
+        if period == 'month': end = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        else: end = start + timedelta(**{f'{period}s': 1})
+        return end.timestamp()
+
+    def template(self) -> dict:
+        '''Returns the body of the index template of the family'''
+        return {
+            'index_patterns': [self.pattern],
+            'template': {'mappings': self.mappings, 'aliases': {self.name: {}}},
+            'priority': 100,
+        }
+
+
+LOGS = IndexFamily('machine_logs', {
+    'dynamic': False,
+    'properties': {
+        'node': _KEYWORD, 'doc_id': _KEYWORD, 'type': _KEYWORD, 'kind': _KEYWORD, 'name': _KEYWORD,
+        'log': {'type': 'text'},
+        'timestamp': _TIMESTAMP,
+    },
+})
+
+HARDWARE_STATES = IndexFamily('machine_hardware_state', {
+    'dynamic': False,
+    'dynamic_templates': [{'metrics': {'path_match': 'metrics.*', 'mapping': {'type': 'double'}}}],
+    'properties': {
+        'node': _KEYWORD, 'doc_id': _KEYWORD, 'type': _KEYWORD, 'kind': _KEYWORD,
+        'value': {'type': 'double'},  # numeric states (cpu_usage)
+        'metrics': {'type': 'object', 'dynamic': True}, # dict states (temperature, memory_usage), see metrics.flatten_metrics
+        'text': _KEYWORD,             # string states (machine_name, ip)
+        'data': {'type': 'keyword', 'index': False, 'doc_values': False}, # raw JSON of the state, stored only
+        'timestamp': _TIMESTAMP,
+    },
+})
+
+FAMILIES: dict[str, IndexFamily] = {f.name: f for f in (LOGS, HARDWARE_STATES)}
+
+ROLLUP_MAPPINGS = {
+    'dynamic': False,
+    'properties': {
+        'node': _KEYWORD, 'doc_id': _KEYWORD, 'kind': _KEYWORD, 'metric': _KEYWORD, 'window': _KEYWORD,
+        'timestamp': _TIMESTAMP, # start of the window
+        'min': {'type': 'double'}, 'max': {'type': 'double'}, 'mean': {'type': 'double'}, 'last': {'type': 'double'},
+        'count': {'type': 'long'},
+    },
+}
+
+def rollup_family(window: str) -> IndexFamily:
+    '''Returns (and registers in FAMILIES) the family of the hardware state rollups of a window, e.g. `1m`.
+    Rollups are small, they are partitioned by month.'''
+    name = f'machine_hardware_rollup_{window}'
+    if name not in FAMILIES: FAMILIES[name] = IndexFamily(name, ROLLUP_MAPPINGS, 'month')
+    return FAMILIES[name]
@@ -0,0 +1,276 @@
+'''Asynchronous bulk ingest of the documents produced by the connection handlers'''
+
+import hashlib
+import json
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, asdict
+from pathlib import Path
+
+import dvic_log_server.api as api
+from dvic_log_server.database_drivers import DatabaseConnector, DatabaseConfig, IDEMPOTENCY_KEY, open_connector
+from dvic_log_server.indices import FAMILIES
+from dvic_log_server.queries import invalidate_writes
+from dvic_log_server.utils.spool import Spool, EVICT_OLDEST
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info, warning, error
+
+RETRY_STATUSES = {429, 500, 502, 503, 504} # bulk item statuses worth retrying
+MAX_PROBE_INTERVAL = 30 # max seconds between two replay attempts while the database is down
+REPLAY_CHUNKS = 10 # bulk requests replayed from the spool before the worker looks at new documents
+RETENTION_INTERVAL = 3600 # seconds between two retention passes
+
+def idempotent_id(index: str, document: dict) -> str:
+    '''doc_id of a document read from a node source: an entry sent twice gets the same id'''
+    source = json.dumps([index, document.get('node'), document.get('kind'), document.get('name'), document[IDEMPOTENCY_KEY]])
+    return hashlib.sha1(source.encode()).hexdigest()
+
+@dataclass
+class IngestConfig:
+    flush_size: int = 500         # flush when this many documents are pending
+    flush_interval: float = 1.0   # or when the oldest pending document waited this many seconds
+    max_pending: int = 100_000    # bound of the pending documents, the oldest ones are dropped beyond
+    max_retries: int = 5          # attempts of a bulk request before its documents are spooled (or dropped)
+    retry_backoff: float = 0.5    # first retry delay in seconds, doubled on each attempt
+    spool_path: str = 'spool'     # disk spool used while the database is saturated or down, None to disable
+    spool_threshold: int = 10_000 # pending documents above which the database is considered saturated
+    spool_max_bytes: int = 2**30
+    spool_segment_bytes: int = 16 * 2**20
+    spool_eviction: str = EVICT_OLDEST # behaviour once spool_max_bytes is reached, see utils.spool
+    max_replay_attempts: int = 10 # replays of a document still refused before it goes to the dead letter spool (spool_path/dead_letter)
+
+@singleton
+class IngestPipeline:
+    '''Shared ingest pipeline between the handlers and the database.
+    Handlers `submit` documents without blocking, a background worker sends them with the bulk API
+    on size or time thresholds, routing each document to its own index.
+
+    While the database is down or saturated, the worker spills the documents to a disk spool and replays it
+    in order once the database answers again. New documents go through the spool as long as it is not drained.
+
+        ----- Parameters -----
+        config : IngestConfig = None
+            Pipeline configuration, read from the `ingest` section of the server config by default
+        database : DatabaseConfig = None
+            Database the documents go to, read from the `database` section of the server config by default
+    '''
+    def __init__(self, config: IngestConfig = None, database: DatabaseConfig = None) -> None:
+        cfg = api.ConnectionManager().config if config is None or database is None else None
+        if config is None: config = IngestConfig(**(cfg.ingest or {})) if cfg is not None else IngestConfig()
+        if database is None: database = DatabaseConfig(**(cfg.database or {})) if cfg is not None else DatabaseConfig()
+        self.config = config
+        self.database = database
+        self.pending: deque[tuple[str, dict]] = deque()
+        self.condition = threading.Condition()
+        self.connector: DatabaseConnector = None
+        self.spool: Spool = None
+        self.dead_letters: Spool = None # documents the database kept refusing, kept for inspection
+        if self.config.spool_path is not None:
+            self.spool = Spool(self.config.spool_path, self.config.spool_segment_bytes, self.config.spool_max_bytes, self.config.spool_eviction)
+            self.dead_letters = Spool(Path(self.config.spool_path) / 'dead_letter', self.config.spool_segment_bytes, self.config.spool_max_bytes, self.config.spool_eviction)
+        self.stats = {'submitted': 0, 'indexed': 0, 'dropped': 0, 'retries': 0, 'bulk_requests': 0, 'spooled': 0, 'replayed': 0, 'duplicates': 0, 'dead_lettered': 0}
+        self.in_flight = 0 # documents taken by the worker and not yet acknowledged
+        self.flush_requested = False
+        self.backend_up = True
+        self.next_probe = 0 # monotonic time of the next replay attempt while the database is down
+        self.probe_interval = self.config.retry_backoff
+        self.next_retention = 0 # monotonic time of the next retention pass
+        self.running = True
+        self.thread = threading.Thread(target=self._thread_target, daemon=True)
+        self.thread.start()
+        info(f'[INGEST] Pipeline started ({asdict(self.config)}, {asdict(self.database)})')
+
+    def submit(self, index: str, document: dict) -> None:
+        """Queue a document for the bulk worker, never blocks
+
+        Parameters
+        ----------
+        index : str
+            The index (or alias) the document goes to
+        document : dict
+            The document, given a unique `doc_id` (tie-breaker of the paginated queries) if it has none.
+            A document with an IDEMPOTENCY_KEY gets an id derived from its source instead, written at most once
+        """
+        if IDEMPOTENCY_KEY in document and 'doc_id' not in document: document['doc_id'] = idempotent_id(index, document)
+        else: document.setdefault('doc_id', uuid.uuid4().hex)
+        with self.condition:
+            if len(self.pending) >= self.config.max_pending:
+                self.pending.popleft()
+                self.stats['dropped'] += 1
+            self.pending.append((index, document))
+            self.stats['submitted'] += 1
+            if len(self.pending) >= self.config.flush_size: self.condition.notify()
+
+    def flush(self, timeout: float = None) -> bool:
+        """Wait for the pending documents to be sent or spooled
+
+        Parameters
+        ----------
+        timeout : float, optional
+            Max wait, by default None (forever)
+
+        Returns
+        -------
+        bool
+            True if every pending document was handled
+        """
+        with self.condition:
+            self.flush_requested = True
+            self.condition.notify_all()
+            return self.condition.wait_for(lambda: not self.pending and not self.in_flight, timeout)
+
+    def stop(self) -> None:
+        self.flush(self.config.flush_interval * 2)
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(self.config.flush_interval * 2)
+        if self.spool is not None:
+            self.spool.close()
+            self.dead_letters.close()
+
+    def _take(self, everything: bool = False) -> list[tuple[str, dict]]:
+        n = len(self.pending) if everything else min(len(self.pending), self.config.flush_size)
+        self.in_flight = n
+        batch = [self.pending.popleft() for _ in range(n)]
+        self.flush_requested = self.flush_requested and bool(self.pending)
+        return batch
+
+    def _spooling(self) -> bool:
+        '''Whether the pending documents go to the spool: database down or saturated, or spool not drained yet'''
+        if self.spool is None: return False
+        return not self.backend_up or len(self.pending) > self.config.spool_threshold or not self.spool.is_empty()
+
+    def _replay_ready(self) -> bool:
+        return self.spool is not None and not self.spool.is_empty() and time.monotonic() >= self.next_probe
+
+    def _thread_target(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: not self.running or self.flush_requested or len(self.pending) >= self.config.flush_size or self._replay_ready(),
+                    self.config.flush_interval
+                )
+                if not self.running: return
+                spooling = self._spooling()
+                batch = self._take(everything=spooling)
+            if spooling:
+                self._spill(batch)
+                self._replay()
+            elif batch:
+                self._send(batch)
+            self._retention()
+            with self.condition:
+                self.in_flight = 0
+                self.condition.notify_all()
+
+    def _get_connector(self) -> DatabaseConnector:
+        if self.connector is None:
+            self.connector = open_connector(self.database)
+        return self.connector
+
+    def _reset_connector(self) -> None:
+        if self.connector is not None: self.connector.close()
+        self.connector = None # new connector on the next attempt
+
+    def _bulk(self, batch: list[tuple[str, dict]]) -> list[tuple[str, dict]]:
+        """Send one bulk request
+
+        Returns
+        -------
+        list[tuple[str, dict]]
+            The documents to retry
+        """
+        statuses = self._get_connector().bulk(batch)
+        self.stats['bulk_requests'] += 1
+        retry, oldest = [], {}
+        for (index, document), status in zip(batch, statuses):
+            if status < 300:
+                self.stats['indexed'] += 1
+                timestamp = document.get('timestamp')
+                if timestamp is not None and timestamp < oldest.get(index, timestamp + 1): oldest[index] = timestamp
+            elif status == 409: self.stats['duplicates'] += 1 # already written (backfill, replay)
+            elif status in RETRY_STATUSES: retry.append((index, document))
+            else:
+                self.stats['dropped'] += 1
+                error(f'[INGEST] Document rejected by {index} (status {status})')
+        for index, timestamp in oldest.items(): invalidate_writes(index, timestamp) # late documents land in cached buckets
+        return retry
+
+    def _send(self, batch: list[tuple[str, dict]]) -> None:
+        backoff = self.config.retry_backoff
+        for attempt in range(self.config.max_retries):
+            try: batch = self._bulk(batch)
+            except Exception as e:
+                warning(f'[INGEST] Bulk request failed ({type(e).__name__}: {e})')
+                self._reset_connector()
+            if not batch: return
+            if attempt + 1 == self.config.max_retries: break
+            self.stats['retries'] += 1
+            time.sleep(backoff)
+            backoff *= 2
+        if self.spool is not None:
+            warning(f'[INGEST] Spooling {len(batch)} documents to {self.config.spool_path} after {self.config.max_retries} attempts')
+            self._backend_down()
+            self._spill(batch)
+            return
+        error(f'[INGEST] Dropping {len(batch)} documents after {self.config.max_retries} attempts')
+        self.stats['dropped'] += len(batch)
+
+    def _retention(self) -> None:
+        '''Drops the documents older than the configured retention, at most once per RETENTION_INTERVAL'''
+        retention = self.database.retention_days
+        if retention is None or time.monotonic() < self.next_retention or not self.backend_up: return
+        self.next_retention = time.monotonic() + RETENTION_INTERVAL
+        for index in list(FAMILIES):
+            days = retention.get(index) if isinstance(retention, dict) else retention
+            if days is None: continue
+            try: self._get_connector().drop_before(index, time.time() - days * 86400)
+            except Exception as e:
+                warning(f'[INGEST] Retention of {index} failed ({type(e).__name__}: {e})')
+                self._reset_connector()
+
+    def _backend_down(self) -> None:
+        '''Schedule the next replay attempt, with a backoff doubled on every failed attempt'''
+        self.probe_interval = min(self.probe_interval * 2, MAX_PROBE_INTERVAL) if not self.backend_up else self.config.retry_backoff
+        self.backend_up = False
+        self.next_probe = time.monotonic() + self.probe_interval
+
+    def _spill(self, batch: list[tuple]) -> None:
+        '''Append (index, document) or (index, document, replay attempts) entries to the spool'''
+        if not batch: return
+        n = self.spool.append_many([json.dumps(doc).encode('utf-8') for doc in batch])
+        self.stats['spooled'] += n
+        self.stats['dropped'] += len(batch) - n # spool full with EVICT_NONE
+
+    def _replay(self) -> None:
+        '''Replay the spool in order, a few bulk requests at a time, while the database answers'''
+        for _ in range(REPLAY_CHUNKS):
+            if not self._replay_ready(): return
+            records, position = self.spool.read(self.config.flush_size)
+            entries = [json.loads(r) for r in records]
+            batch = [(e[0], e[1]) for e in entries]
+            attempts = {id(doc): (e[2] if len(e) > 2 else 0) for e, (_, doc) in zip(entries, batch)}
+            try: retry = self._bulk(batch) if batch else []
+            except Exception as e:
+                if self.backend_up: warning(f'[INGEST] Database unavailable ({type(e).__name__}: {e}), documents kept in the spool')
+                self._reset_connector()
+                self._backend_down()
+                return
+            if retry and len(retry) == len(batch): self._backend_down() # everything refused (saturated), back off before the next replay
+            else:
+                if not self.backend_up: info('[INGEST] Database is back, replaying the spool')
+                self.backend_up = True
+            again = [(index, doc, attempts[id(doc)] + 1) for index, doc in retry]
+            self._spill([e for e in again if e[2] < self.config.max_replay_attempts]) # retried after the rest of the spool
+            self._dead_letter([e for e in again if e[2] >= self.config.max_replay_attempts])
+            self.spool.commit(position)
+            self.stats['replayed'] += len(batch) - len(retry)
+
+    def _dead_letter(self, entries: list[tuple[str, dict, int]]) -> None:
+        if not entries: return
+        error(f'[INGEST] {len(entries)} documents still refused after {self.config.max_replay_attempts} replays, moved to {self.dead_letters.path}')
+        self.stats['dead_lettered'] += len(entries)
+        self.dead_letters.append_many([json.dumps(e).encode('utf-8') for e in entries])
@@ -96,6 +96,13 @@ class InteractiveSession:
         self.subscribers.remove(co)
 
 
+    @staticmethod
+    def rebind(old: AConnection, new: AConnection):
+        """Move the interactive sessions of a connection (as target machine or subscriber) to the connection that replaced it"""
+        for session in INTERACTIVE_SESSIONS.values():
+            if session.target_machine is old: session.target_machine = new
+            session.subscribers = [new if c is old else c for c in session.subscribers]
+
     @staticmethod
     def _init_interactive_session(session: "InteractiveSession"):
         global INTERACTIVE_SESSIONS
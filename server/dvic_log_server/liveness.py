@@ -0,0 +1,199 @@
+'''Liveness of the connections: heartbeats of the idle nodes, stale marking and eviction of the silent ones'''
+
+import asyncio
+import math
+from dataclasses import dataclass
+from time import time
+from typing import Any, Hashable
+
+import dvic_log_server.api as api
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import PacketHeartbeat
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info, warning
+
+class TimerWheel:
+    '''Hierarchical timing wheel: `levels` wheels of `slots` slots, a slot of level L spans slots**L ticks.
+    A timer is stored in the lowest level whose span covers its remaining ticks and moved down a level
+    (cascaded) when the wheel above reaches its slot: scheduling and cancelling are O(1), advancing costs
+    one slot per tick plus the cascaded timers, whatever the number of timers.
+
+        ----- Parameters -----
+        tick : float
+            Resolution in seconds
+        slots : int
+            Slots per level
+        levels : int
+            Number of levels, timers beyond tick * slots**levels seconds are cascaded on every turn of the top level
+        now : float
+            Current time
+    '''
+    def __init__(self, tick: float = 0.5, slots: int = 64, levels: int = 4, now: float = None) -> None:
+        self.tick = tick
+        self.slots = slots
+        self.wheels: list[list[dict[Hashable, tuple[int, Any]]]] = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.current = int((time() if now is None else now) // tick) # last tick processed
+        self.timers: dict[Hashable, tuple[int, int]] = {} # key -> (level, slot)
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.timers
+
+    def _place(self, key: Hashable, expiry: int, value: Any) -> None:
+        delta, span = expiry - self.current, 1
+        for level, wheel in enumerate(self.wheels):
+            if delta < span * self.slots or level == len(self.wheels) - 1: break
+            span *= self.slots
+        slot = expiry // span % self.slots
+        wheel[slot][key] = (expiry, value)
+        self.timers[key] = (level, slot)
+
+    def schedule(self, key: Hashable, deadline: float, value: Any = None) -> None:
+        '''Arm (or re-arm) the timer of a key, it expires on the first tick at or after deadline'''
+        self.cancel(key)
+        self._place(key, max(math.ceil(deadline / self.tick), self.current + 1), value)
+
+    def cancel(self, key: Hashable) -> None:
+        level_slot = self.timers.pop(key, None)
+        if level_slot is not None: del self.wheels[level_slot[0]][level_slot[1]][key]
+
+    def advance(self, now: float) -> list[tuple[Hashable, Any]]:
+        """Move the wheel to now
+
+        Returns
+        -------
+        list[tuple[Hashable, Any]]
+            (key, value) of the expired timers, in expiry order
+        """
+        target, expired = int(now // self.tick), []
+        while self.current < target:
+            self.current += 1
+            reached, span = [], self.slots
+            for level in range(1, len(self.wheels)): # upper levels whose slot starts at this tick
+                if self.current % span: break
+                reached.append((level, span))
+                span *= self.slots
+            for level, span in reversed(reached): # top down, a timer can cascade through several levels at once
+                slot = self.current // span % self.slots
+                timers, self.wheels[level][slot] = self.wheels[level][slot], {}
+                for key, (expiry, value) in timers.items(): self._place(key, expiry, value)
+            slot = self.current % self.slots
+            timers, self.wheels[0][slot] = self.wheels[0][slot], {}
+            for key, (expiry, value) in timers.items():
+                if expiry > self.current: # a lap ahead (top level overflow)
+                    self._place(key, expiry, value)
+                    continue
+                del self.timers[key]
+                expired.append((key, value))
+        return expired
+
+
+@dataclass
+class LivenessConfig:
+    idle_after: float = 10.0     # silence before the first heartbeat probe, nodes sending data are never probed
+    max_interval: float = 120.0  # the probe interval doubles up to this while an idle node only answers the probes
+    probe_timeout: float = 5.0   # wait for an answer before the node is marked stale
+    evict_after: float = 30.0    # stale time before the connection is closed and removed
+    tick: float = 0.5            # resolution of the timer wheel
+
+ACTIVE, PROBING, STALE = 'active', 'probing', 'stale'
+
+class Liveness:
+    '''Liveness state of one connection'''
+    __slots__ = ('connection', 'state', 'interval', 'probed_at', 'aware')
+
+    def __init__(self, connection: AConnection, interval: float) -> None:
+        self.connection = connection
+        self.state = ACTIVE
+        self.interval = interval # silence tolerated before the next probe
+        self.probed_at = 0.0
+        self.aware = False # the node answered a heartbeat once, older nodes ignore them and are never evicted
+
+@singleton
+class LivenessTracker:
+    '''Deadline of every connection in a TimerWheel, driven by a task of the event loop.
+    Packets only refresh `Connection.last_seen`: when the deadline of a connection expires, a connection that
+    received packets since is re-armed from its last_seen, a silent one gets a PacketHeartbeat probe. A probe left
+    unanswered marks the node stale (presence delta), a stale node still silent after `evict_after` is closed and removed.
+
+        ----- Parameters -----
+        config : LivenessConfig = None
+            Read from the `liveness` section of the server config by default
+    '''
+    def __init__(self, config: LivenessConfig = None) -> None:
+        if config is None:
+            cfg = api.ConnectionManager().config
+            config = LivenessConfig(**(cfg.liveness or {})) if cfg is not None else LivenessConfig()
+        self.config = config
+        self.wheel = TimerWheel(config.tick)
+        self.entries: dict[int, Liveness] = {} # id(connection) -> liveness
+        self.task: asyncio.Task = None
+        self.stats = {'probes': 0, 'stale': 0, 'evicted': 0}
+        info(f'[LIVENESS] Probing connections silent for {config.idle_after:g}s, evicting after {config.evict_after:g}s stale')
+
+    def track(self, connection: AConnection) -> None:
+        '''Follow a new connection, starts the wheel task on the running event loop'''
+        entry = self.entries[id(connection)] = Liveness(connection, self.config.idle_after)
+        self.wheel.schedule(id(connection), connection.last_seen + entry.interval)
+        if self.task is None or self.task.done():
+            try: self.task = asyncio.get_running_loop().create_task(self._run())
+            except RuntimeError: pass # no event loop (tests), the caller advances the wheel
+
+    def untrack(self, connection: AConnection) -> None:
+        self.entries.pop(id(connection), None)
+        self.wheel.cancel(id(connection))
+
+    def answered(self, connection: AConnection) -> None:
+        '''A heartbeat came back, the node understands them'''
+        entry = self.entries.get(id(connection))
+        if entry is not None: entry.aware = True
+
+    def advance(self, now: float = None) -> None:
+        '''Handle the deadlines expired at now'''
+        now = time() if now is None else now
+        for key, _ in self.wheel.advance(now):
+            entry = self.entries.get(key)
+            if entry is not None: self._expired(entry, now)
+
+    def _expired(self, entry: Liveness, now: float) -> None:
+        conn, key = entry.connection, id(entry.connection)
+        if conn.is_disconnected(): return self.untrack(conn)
+        if entry.state == ACTIVE:
+            if conn.last_seen + entry.interval > now: # packets since the deadline was set
+                return self.wheel.schedule(key, conn.last_seen + entry.interval)
+            return self._probe(entry, now, PROBING, now + self.config.probe_timeout)
+        if conn.last_seen > entry.probed_at: # alive again
+            if entry.state == STALE: self._set_stale(entry, False)
+            entry.state = ACTIVE
+            entry.interval = min(entry.interval * 2, self.config.max_interval) # idle node, probe it less often
+            return self.wheel.schedule(key, conn.last_seen + entry.interval)
+        if entry.state == PROBING:
+            self._set_stale(entry, True)
+            entry.interval = self.config.idle_after
+            return self._probe(entry, now, STALE, now + (self.config.evict_after if entry.aware else self.config.max_interval))
+        if not entry.aware: return self._probe(entry, now, STALE, now + self.config.max_interval)
+        warning(f'[{conn.uid}] No answer for {now - conn.last_seen:.0f}s, closing the connection')
+        self.stats['evicted'] += 1
+        self.untrack(conn)
+        conn.close()
+        if api.ConnectionManager().connections.get(conn.uid) is conn: api.ConnectionManager()[conn.uid] = None
+
+    def _probe(self, entry: Liveness, now: float, state: str, deadline: float) -> None:
+        entry.state, entry.probed_at = state, now
+        entry.connection.send_packet(PacketHeartbeat(now))
+        self.stats['probes'] += 1
+        self.wheel.schedule(id(entry.connection), deadline)
+
+    def _set_stale(self, entry: Liveness, stale: bool) -> None:
+        from dvic_log_server.presence import PresenceHub
+        entry.connection.stale = stale
+        if stale: self.stats['stale'] += 1
+        PresenceHub().changed(entry.connection.uid, status='stale' if stale else 'connected')
+
+    async def _run(self) -> None:
+        while self.entries:
+            await asyncio.sleep(self.config.tick)
+            try: self.advance()
+            except Exception as e: warning(f'[LIVENESS] Tick failed ({type(e).__name__}: {e})')
@@ -0,0 +1,109 @@
+'''Live log tail: forwards the received log entries to the subscribed connections'''
+
+import re
+import threading
+from typing import Union
+
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import PacketLogEntry, PacketLogSubscription, PacketMachineLog, LogSubscriptionAction
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info, warning
+
+SHED_AFTER_DROPS = 1024 # bulk packets a subscriber can lose to its full outbound queue before it is shed
+
+class Subscription:
+    '''Compiled filters of a PacketLogSubscription'''
+    __slots__ = ('id', 'connection', 'nodes', 'kinds', 'names', 'pattern', 'baseline')
+
+    def __init__(self, connection: AConnection, pck: PacketLogSubscription) -> None:
+        self.id = pck.subscription_id
+        self.connection = connection
+        self.nodes = frozenset(pck.nodes) if pck.nodes else None
+        self.kinds = frozenset(pck.kinds) if pck.kinds else None
+        self.names = frozenset(pck.names) if pck.names else None
+        self.pattern = re.compile(pck.regex) if pck.regex else None # re.error on invalid regex
+        self.baseline = connection.dropped['bulk'] # outbound drops before the subscription
+
+    def matches(self, pck: PacketLogEntry) -> bool:
+        return (self.kinds is None or pck.kind in self.kinds) \
+            and (self.names is None or pck.name in self.names) \
+            and (self.pattern is None or self.pattern.search(pck.log) is not None)
+
+@singleton
+class LogTailHub:
+    '''Registry of the log subscriptions, indexed by node so the cost of a log line only depends on the
+    subscriptions that can match its node. `publish` reads an immutable snapshot of the index, rebuilt on
+    every (un)subscription, and never blocks: subscribers are fed through their bulk outbound queue and
+    shed once they lost more than SHED_AFTER_DROPS entries to it.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.subscriptions: dict[tuple[int, str], Subscription] = {} # (id(connection), subscription id) -> subscription
+        self.by_node: dict[str, tuple[Subscription, ...]] = {}       # snapshot: node -> subscriptions filtering on it
+        self.any_node: tuple[Subscription, ...] = ()                 # snapshot: subscriptions without node filter
+        self.stats = {'forwarded': 0, 'shed': 0}
+
+    def _rebuild(self) -> None:
+        by_node: dict[str, list[Subscription]] = {}
+        for sub in self.subscriptions.values():
+            for node in sub.nodes or (): by_node.setdefault(node, []).append(sub)
+        self.by_node = {n: tuple(subs) for n, subs in by_node.items()}
+        self.any_node = tuple(s for s in self.subscriptions.values() if s.nodes is None)
+
+    def subscribe(self, connection: AConnection, pck: PacketLogSubscription) -> bool:
+        """Register (or replace) a subscription of a connection
+
+        Returns
+        -------
+        bool
+            False if the filters are invalid, the connection is notified
+        """
+        try: sub = Subscription(connection, pck)
+        except re.error as e:
+            warning(f'[{connection.uid}] Rejected log subscription {pck.subscription_id}: {e}')
+            connection.send_packet(PacketLogSubscription(LogSubscriptionAction.REJECTED, pck.subscription_id))
+            return False
+        with self.lock:
+            self.subscriptions[(id(connection), sub.id)] = sub
+            self._rebuild()
+        info(f'[{connection.uid}] Log subscription {sub.id} (nodes={pck.nodes}, kinds={pck.kinds}, names={pck.names}, regex={pck.regex})')
+        return True
+
+    def unsubscribe(self, connection: AConnection, subscription_id: str = None) -> None:
+        '''Remove a subscription of a connection, all of them if subscription_id is None'''
+        with self.lock:
+            keys = [k for k in self.subscriptions if k[0] == id(connection) and (subscription_id is None or k[1] == subscription_id)]
+            for k in keys: del self.subscriptions[k]
+            if keys: self._rebuild()
+
+    def publish(self, node: str, pck: Union[PacketLogEntry, PacketMachineLog]) -> int:
+        """Forward a log entry received from a node to the matching subscriptions
+
+        Returns
+        -------
+        int
+            Number of subscriptions the entry was sent to
+        """
+        candidates = self.by_node.get(node, ())
+        if self.any_node: candidates = candidates + self.any_node
+        if not candidates: return 0
+        forwarded, sent, shed = None, 0, []
+        for sub in candidates:
+            if not sub.matches(pck): continue
+            conn = sub.connection
+            if conn.is_disconnected() or conn.dropped['bulk'] - sub.baseline > SHED_AFTER_DROPS:
+                shed.append(sub)
+                continue
+            if forwarded is None: forwarded = PacketLogEntry(pck.kind, pck.name, pck.log, node)
+            conn.send_packet(forwarded)
+            sent += 1
+        self.stats['forwarded'] += sent
+        for sub in shed: self._shed(sub)
+        return sent
+
+    def _shed(self, sub: Subscription) -> None:
+        self.unsubscribe(sub.connection, sub.id)
+        self.stats['shed'] += 1
+        if sub.connection.is_disconnected(): return
+        warning(f'[{sub.connection.uid}] Log subscription {sub.id} shed, the subscriber does not keep up')
+        sub.connection.send_packet(PacketLogSubscription(LogSubscriptionAction.SHED, sub.id))
@@ -0,0 +1,56 @@
+'''Typed fields of the hardware state documents'''
+
+from typing import Any
+
+def flatten_metrics(data: Any) -> dict:
+    """Split the data of a hardware state packet in typed document fields
+
+    Parameters
+    ----------
+    data : Any
+        The `data` of a PacketHardwareState: a number (cpu_usage), a string (machine_name, ip)
+        or a dict of numbers (temperature per thermal zone, memory_usage)
+
+    Returns
+    -------
+    dict
+        `value` for a number, `text` for a string, `metrics` (flat dict of numbers, nested keys joined with '_') for a dict.
+        The non numeric leaves of a dict are ignored.
+
+    Examples
+    --------
+    >>> flatten_metrics({'total': 16303648, 'used': 41.2})
+    {'metrics': {'total': 16303648.0, 'used': 41.2}}
+    """
+    if isinstance(data, bool): return {}
+    if isinstance(data, (int, float)): return {'value': float(data)}
+    if isinstance(data, str): return {'text': data}
+    if not isinstance(data, dict): return {}
+    metrics = {}
+    def walk(d: dict, prefix: str):
+        for k, v in d.items():
+            key = f'{prefix}{k}'.replace('.', '_')
+            if isinstance(v, dict): walk(v, f'{key}_')
+            elif isinstance(v, (int, float)) and not isinstance(v, bool): metrics[key] = float(v)
+    walk(data, '')
+    return {'metrics': metrics} if metrics else {}
+
+
+def metric_samples(kind: str, data: Any) -> list[tuple[str, float]]:
+    """Numeric samples of a hardware state, named after the kind (`cpu_usage`) or kind and field for dict states (`memory_usage.used`)
+
+    Parameters
+    ----------
+    kind : str
+        The kind of the hardware state
+    data : Any
+        Its data, see flatten_metrics
+
+    Returns
+    -------
+    list[tuple[str, float]]
+        (metric, value) pairs, empty for non numeric states
+    """
+    fields = flatten_metrics(data)
+    if 'value' in fields: return [(kind, fields['value'])]
+    return [(f'{kind}.{k}', v) for k, v in fields.get('metrics', {}).items()]
@@ -1,24 +1,32 @@
 import json
-import sys
 import base64
+import struct
 import traceback
-from typing import Any, Union
-from enum import Enum
+from typing import Any, Callable, Union
+from enum import Enum, IntEnum
 from dataclasses import dataclass
 
 class NodeStatusAction(Enum):
     LIST_NODES = "list"
+    SUBSCRIBE = "subscribe"     # client -> server: snapshot then deltas of the node status
+    UNSUBSCRIBE = "unsubscribe" # client -> server
+    SNAPSHOT = "snapshot"       # server -> client: status of every node
+    DELTA = "delta"             # server -> client: changed fields of the nodes since the previous delta
+
+class PacketPriority(IntEnum):
+    """Outbound queue class of a packet, lower values are sent first"""
+    INTERACTIVE = 0 # interactive sessions and control packets
+    STATE = 1       # latest machine state
+    BULK = 2        # logs
     
-PACKET_ID_MATCHING = {
-    "hardware_state": "HardwareState",
-    "log_entry": "LogEntry",
-    "demo_proc_state": "DemoProcState",
-    "machine_log" : "MachineLog",
-    "interactive_session": "InteractiveSession",
-    "node_status": "NodeStatus",
-    "node_addition_request": "NodeAdditionRequest",
-    "script_interactive_session": "ScriptInteractiveSession"
-} # identifier -> str(class<Packet>)
+PACKET_REGISTRY: dict[str, type["Packet"]] = {}      # identifier -> class<Packet>, filled at class definition
+PACKET_TYPE_REGISTRY: dict[int, type["Packet"]] = {} # type byte used by the binary codec -> class<Packet>
+
+# Websocket subprotocols offered during the /ws/{token} handshake, by order of preference.
+# Peers that do not offer any subprotocol (old nodes and CLIs) stay on JSON text frames.
+SUBPROTOCOL_BINARY = "dvic.binary.v1"
+SUBPROTOCOL_JSON   = "dvic.json"
+SUBPROTOCOLS = [SUBPROTOCOL_BINARY, SUBPROTOCOL_JSON]
 
 @dataclass
 class NodeSelector: #TODO add selector 
@@ -29,10 +37,123 @@ class NodeSelector: #TODO add selector
     uids: list[str] = None 
     tags: list[str] = None
 
+def select_subprotocol(offered: list[str]) -> Union[str, None]:
+    """Pick the preferred subprotocol among the ones offered by the peer
+
+    Parameters
+    ----------
+    offered : list[str]
+        The subprotocols sent by the peer in the websocket handshake
+
+    Returns
+    -------
+    Union[str, None]
+        The selected subprotocol, None if the peer did not offer a known one (JSON)
+    """
+    for sp in SUBPROTOCOLS:
+        if sp in offered: return sp
+    return None
+
+# Binary codec
+# A frame is one type byte followed by the packet fields (Packet.WIRE_FIELDS order).
+# Every field is a tag byte followed by its payload, variable size payloads are prefixed with their u32 length.
+# Fields are only ever appended to WIRE_FIELDS: missing trailing fields (older peers) are decoded as None.
+_TAG_NONE, _TAG_STR, _TAG_BYTES, _TAG_INT, _TAG_FLOAT, _TAG_TRUE, _TAG_FALSE, _TAG_LIST, _TAG_DICT = range(9)
+_U8  = struct.Struct('!B')
+_U32 = struct.Struct('!I')
+_I64 = struct.Struct('!q')
+_F64 = struct.Struct('!d')
+
+def _pack_value(out: bytearray, v: Any) -> None:
+    if v is None:
+        out.append(_TAG_NONE)
+    elif isinstance(v, Enum):
+        _pack_value(out, v.value)
+    elif isinstance(v, str):
+        b = v.encode('utf-8')
+        out.append(_TAG_STR); out += _U32.pack(len(b)); out += b
+    elif isinstance(v, (bytes, bytearray, memoryview)):
+        out.append(_TAG_BYTES); out += _U32.pack(len(v)); out += v
+    elif isinstance(v, bool):
+        out.append(_TAG_TRUE if v else _TAG_FALSE)
+    elif isinstance(v, int):
+        out.append(_TAG_INT); out += _I64.pack(v)
+    elif isinstance(v, float):
+        out.append(_TAG_FLOAT); out += _F64.pack(v)
+    elif isinstance(v, (list, tuple)):
+        out.append(_TAG_LIST); out += _U32.pack(len(v))
+        for e in v: _pack_value(out, e)
+    elif isinstance(v, dict):
+        out.append(_TAG_DICT); out += _U32.pack(len(v))
+        for k, e in v.items():
+            _pack_value(out, str(k)); _pack_value(out, e)
+    else:
+        raise TypeError(f'Cannot encode value of type {type(v)} in binary packet')
+
+def _unpack_value(buf: memoryview, off: int) -> tuple[Any, int]:
+    tag = buf[off]; off += 1
+    if tag == _TAG_NONE: return None, off
+    if tag == _TAG_STR or tag == _TAG_BYTES:
+        (n,) = _U32.unpack_from(buf, off); off += 4
+        b = bytes(buf[off:off+n]); off += n
+        return (b.decode('utf-8') if tag == _TAG_STR else b), off
+    if tag == _TAG_INT:   return _I64.unpack_from(buf, off)[0], off + 8
+    if tag == _TAG_FLOAT: return _F64.unpack_from(buf, off)[0], off + 8
+    if tag == _TAG_TRUE:  return True, off
+    if tag == _TAG_FALSE: return False, off
+    if tag == _TAG_LIST:
+        (n,) = _U32.unpack_from(buf, off); off += 4
+        lst = []
+        for _ in range(n):
+            e, off = _unpack_value(buf, off)
+            lst.append(e)
+        return lst, off
+    if tag == _TAG_DICT:
+        (n,) = _U32.unpack_from(buf, off); off += 4
+        d = {}
+        for _ in range(n):
+            k, off = _unpack_value(buf, off)
+            d[k], off = _unpack_value(buf, off)
+        return d, off
+    raise ValueError(f'Unknown binary tag {tag}')
+
+def _as_str(v: Any) -> Union[str, None]:
+    if isinstance(v, bytes): return v.decode('utf-8')
+    return v
+
+def _as_bytes(v: Any) -> Union[bytes, None]:
+    if isinstance(v, str): return v.encode('utf-8')
+    return v
+
 class Packet:
+    __slots__ = ()
+    identifier: str = None
+    type_id: int = None
+    priority: PacketPriority = PacketPriority.INTERACTIVE
+    WIRE_FIELDS: tuple[tuple[str, Callable], ...] = () # (attribute, decode coercion) pairs for the binary codec
+
+    def __init_subclass__(cls, identifier: str = None, type_id: int = None, **kwargs) -> None:
+        """Register the packet class under its identifier and binary type byte
 
-    def __init__(self, identifier: str) -> None:
-        self.identifier = identifier
+        Raises
+        ------
+        TypeError
+            The identifier or the type byte is already used by another packet class
+        """
+        super().__init_subclass__(**kwargs)
+        if identifier is None: return # not sent over the wire
+        if identifier in PACKET_REGISTRY:
+            raise TypeError(f'Packet identifier "{identifier}" of {cls.__name__} collides with {PACKET_REGISTRY[identifier].__name__}')
+        if type_id is None or not 0 < type_id < 256:
+            raise TypeError(f'{cls.__name__} must have a type_id in [1, 255]')
+        if type_id in PACKET_TYPE_REGISTRY:
+            raise TypeError(f'Packet type_id {type_id} of {cls.__name__} collides with {PACKET_TYPE_REGISTRY[type_id].__name__}')
+        cls.identifier, cls.type_id = identifier, type_id
+        PACKET_REGISTRY[identifier] = cls
+        PACKET_TYPE_REGISTRY[type_id] = cls
+
+    def __init__(self) -> None:
+        pass
         
     def _encode_str(self, s: Union[str, bytes]) -> str:
         if type(s) is not bytes: s = str(s).encode('utf-8')
@@ -52,11 +173,57 @@ class Packet:
         encoded_dict = self._decode_str(d, to_str=False)
         return json.loads(encoded_dict)
 
+    def coalesce_key(self) -> Any:
+        """Key under which a queued packet is superseded by a newer one (latest-value-wins queues)
+
+        Returns
+        -------
+        Any
+            The key, None if the packet is never superseded
+        """
+        return None
+
     def encode(self) -> str:
         return json.dumps({
             'type': self.identifier,
             'data': self.get_data()
         })
+
+    def encode_binary(self) -> bytes:
+        """Encode the packet with the binary codec: type byte then length-prefixed raw fields, no base64
+
+        Returns
+        -------
+        bytes
+            The binary frame to send over ws
+        """
+        out = bytearray(_U8.pack(self.type_id))
+        for name, _ in self.WIRE_FIELDS:
+            _pack_value(out, getattr(self, name))
+        return bytes(out)
+
+    def set_wire_fields(self, buf: memoryview, off: int) -> int:
+        """set the data values of the class from a binary frame
+
+        Parameters
+        ----------
+        buf : memoryview
+            The binary frame
+        off : int
+            Offset of the first field in the frame
+
+        Returns
+        -------
+        int
+            Offset after the last field
+        """
+        for name, coerce in self.WIRE_FIELDS:
+            if off == len(buf):
+                setattr(self, name, None)
+                continue
+            v, off = _unpack_value(buf, off)
+            setattr(self, name, coerce(v) if coerce is not None and v is not None else v)
+        return off
     
     # def to_dict(self) -> dict : # ? Easier to call properties
     #     '''convert the packet to a dict to store in the database''' 
@@ -93,20 +260,26 @@ class Packet:
         raise NotImplementedError()
 
 
-class PacketFileTransfer(Packet):
+class PacketFileTransfer(Packet, identifier="file_transfer", type_id=9):
+    __slots__ = ()
     def __init__(self, path: str = None, content: bytes = None, mode: str = None, owner: str = None) -> None:
-        super().__init__("file_transfer")
+        super().__init__()
 
-class PacketNodeConfig(Packet):
+class PacketNodeConfig(Packet, identifier="node_config_update", type_id=10):
     """
     Change a config element in a node or pull the current config
     """
+    __slots__ = ()
+
     def __init__(self, mode: str = None, key: str = None, value: str = None) -> None:
-        super().__init__("node_config_update")
+        super().__init__()
+
+class PacketNodeAdditionRequest(Packet, identifier="node_addition_request", type_id=7):
+    __slots__ = ('ip', 'username', 'password', 'source_node_uid')
+    WIRE_FIELDS = (('ip', None), ('username', None), ('password', _as_str), ('source_node_uid', None))
 
-class PacketNodeAdditionRequest(Packet):
     def __init__(self, ip: str = None, username: str = None, password: str = None, source_node_uid: str = None) -> None:
-        super().__init__("node_addition_request")
+        super().__init__()
         self.ip = ip
         self.username = username
         self.password = password
@@ -126,9 +299,12 @@ class PacketNodeAdditionRequest(Packet):
         self.password = self._decode_str(data['password'])
         self.source_node_uid = data['source_node_uid']
 
-class PacketNodeAdditionManagement(Packet):
+class PacketNodeAdditionManagement(Packet, identifier="node_addition_management", type_id=11):
+    __slots__ = ('node_uid', 'state', 'message')
+    WIRE_FIELDS = (('node_uid', None), ('state', None), ('message', _as_str))
+
     def __init__(self, node_uid: str = None, state: str = None, message: str = None) -> None:
-        super().__init__("node_addition_management")
+        super().__init__()
         self.node_uid = node_uid
         self.state = state
         self.message = message
@@ -146,10 +322,13 @@ class PacketNodeAdditionManagement(Packet):
         self.message = self._decode_str(data['message'])
 
 
-class PacketNodeStatus(Packet):
-    # ? what is this packet for?
+class PacketNodeStatus(Packet, identifier="node_status", type_id=6):
+    '''Status of the nodes: {uid: {'status', 'last_seen', 'dropped'}}, listed on request or pushed to the subscribers'''
+    __slots__ = ('action', 'node_status')
+    WIRE_FIELDS = (('action', NodeStatusAction), ('node_status', None))
+
     def __init__(self, action: NodeStatusAction = None, node_status: dict[str, str] = None) -> None:
-        super().__init__("node_status")
+        super().__init__()
         self.action = action.value if action is not None else None
         self.node_status = node_status
 
@@ -163,16 +342,22 @@ class PacketNodeStatus(Packet):
         self.action = NodeStatusAction(data['action']) if data['action'] is not None else None
         self.node_status = data['node_status']
 
-class PacketHardwareState(Packet): #! I changed all the "log" to "data" ;)
+class PacketHardwareState(Packet, identifier="hardware_state", type_id=1): #! I changed all the "log" to "data" ;)
     '''Hardware state contains info about the temperature, memory usage, etc. of the machine'''
+    __slots__ = ('kind', 'data')
     DICT_KINDS = ['temperature', 'memory_usage' ] # FIXME : Dirty way to do this
+    WIRE_FIELDS = (('kind', None), ('data', None))
+    priority = PacketPriority.STATE
     def __init__(self, kind : str = None, data : str = None) -> None:
-        super().__init__("hardware_state")
+        super().__init__()
         self.kind = kind
         self.data  = data
 
+    def coalesce_key(self) -> Any:
+        return self.kind
 
-    def get_data(self,cls) -> dict:
+
+    def get_data(self) -> dict:
         data = self.data
         if self.kind in type(self).DICT_KINDS: data = self._encode_dict(data)
         else: data = self._encode_str(data)
@@ -181,41 +366,223 @@ class PacketHardwareState(Packet): #! I changed all the "log" to "data" ;)
     def set_data(self, data: dict) -> None:
         self.kind = data['kind']
         data = data['data']
-        if self.kind in type(self).DICT_KINDS: self.log = self._decode_dict(data)
-        else: self.log = self._decode_str(data)
+        if self.kind in type(self).DICT_KINDS: self.data = self._decode_dict(data)
+        else: self.data = self._decode_str(data)
     
 
-class PacketLogEntry(Packet):
+class PacketLogEntry(Packet, identifier="log_entry", type_id=2):
     '''Log entry contains the log from the demo process from the node and the machine log.
-    These logs are created and generated by the demo process itself, coded by the DVIC students'''
-    def __init__(self, kind: str = None, name: str = None, log: str = None) -> None:
-        super().__init__("machine_log")
+    These logs are created and generated by the demo process itself, coded by the DVIC students.
+    `node` is left empty by the nodes, the server sets it on the entries it forwards to log subscribers.
+    `key` is the position of the entry in its source (journal cursor, file inode:generation:offset), the server stores an entry
+    read twice (backfill after a restart) only once.
+    `timestamp` is the time of the entry on the node (journal realtime, file read time), kept by every copy sent again so the
+    server stores them in the same partition'''
+    __slots__ = ('kind', 'name', 'log', 'node', 'key', 'timestamp')
+    WIRE_FIELDS = (('kind', _as_str), ('name', _as_str), ('log', _as_str), ('node', None), ('key', None), ('timestamp', None))
+    priority = PacketPriority.BULK
+
+    def __init__(self, kind: str = None, name: str = None, log: str = None, node: str = None, key: str = None, timestamp: float = None) -> None:
+        super().__init__()
         self.kind = kind
         self.name = name
         self.log  = log
+        self.node = node
+        self.key  = key
+        self.timestamp = timestamp
 
     def get_data(self) -> dict:
-        return {'kind': self._encode_str(self.kind),
+        data = {'kind': self._encode_str(self.kind),
                 'name': self._encode_str(self.name), 
                 'log':  self._encode_str(self.log)
         }
+        if self.node is not None: data['node'] = self.node
+        if self.key is not None: data['key'] = self.key
+        if self.timestamp is not None: data['timestamp'] = self.timestamp
+        return data
     
     def set_data(self, data: dict) -> None:
         self.kind = self._decode_str(data['kind'])
         self.name = self._decode_str(data['name'])
         self.log  = self._decode_str(data['log'])
+        self.node = data.get('node')
+        self.key  = data.get('key')
+        self.timestamp = data.get('timestamp')
+
+class LogSubscriptionAction(Enum):
+    SUBSCRIBE = "subscribe"     # client -> server: start receiving the matching log entries
+    UNSUBSCRIBE = "unsubscribe" # client -> server
+    REJECTED = "rejected"       # server -> client: invalid filters
+    SHED = "shed"               # server -> client: the subscription was dropped, the client did not keep up
+
+class PacketLogSubscription(Packet, identifier="log_subscription", type_id=13):
+    '''Live log tail: the server forwards the PacketLogEntry matching every filter of the subscription.
+    Filters left to None match everything, `regex` is searched in the log line'''
+    __slots__ = ('action', 'subscription_id', 'nodes', 'kinds', 'names', 'regex')
+    WIRE_FIELDS = (('action', LogSubscriptionAction), ('subscription_id', None), ('nodes', None), ('kinds', None), ('names', None), ('regex', None))
+
+    def __init__(self, action: LogSubscriptionAction = None, subscription_id: str = None, nodes: list[str] = None,
+                 kinds: list[str] = None, names: list[str] = None, regex: str = None) -> None:
+        super().__init__()
+        self.action = action
+        self.subscription_id = subscription_id
+        self.nodes = nodes
+        self.kinds = kinds
+        self.names = names
+        self.regex = regex
+
+    def get_data(self) -> dict:
+        return {
+            'action': self.action.value if self.action is not None else None,
+            'subscription_id': self.subscription_id,
+            'nodes': self.nodes,
+            'kinds': self.kinds,
+            'names': self.names,
+            'regex': self.regex
+        }
+
+    def set_data(self, data: dict) -> None:
+        self.action = LogSubscriptionAction(data['action']) if data['action'] is not None else None
+        self.subscription_id = data['subscription_id']
+        self.nodes = data['nodes']
+        self.kinds = data['kinds']
+        self.names = data['names']
+        self.regex = data['regex']
+
+class PacketQuery(Packet, identifier="query", type_id=14):
+    '''Paginated query on the stored documents of a family (`machine_logs`, `machine_hardware_state`, ...).
+    The client sends the filters, the server answers with the same packet holding one page of `hits`
+    and the opaque `next_cursor` to send back for the next page (None on the last page), or an `error`.
+    `filters` keys: nodes, kinds, names (lists), start, end (seconds since epoch), text (searched in the log line)'''
+    __slots__ = ('request_id', 'index', 'filters', 'fields', 'size', 'cursor', 'descending', 'hits', 'next_cursor', 'error')
+    WIRE_FIELDS = (('request_id', None), ('index', None), ('filters', None), ('fields', None), ('size', None), ('cursor', None),
+                   ('descending', None), ('hits', None), ('next_cursor', None), ('error', None))
+
+    def __init__(self, request_id: str = None, index: str = None, filters: dict = None, fields: list[str] = None, size: int = None,
+                 cursor: str = None, descending: bool = None, hits: list[dict] = None, next_cursor: str = None, error: str = None) -> None:
+        super().__init__()
+        self.request_id = request_id
+        self.index = index
+        self.filters = filters
+        self.fields = fields
+        self.size = size
+        self.cursor = cursor
+        self.descending = descending
+        self.hits = hits
+        self.next_cursor = next_cursor
+        self.error = error
+
+    def get_data(self) -> dict:
+        return {s: getattr(self, s) for s in self.__slots__}
+
+    def set_data(self, data: dict) -> None:
+        for s in self.__slots__: setattr(self, s, data.get(s))
 
-class PacketDemoProcState(Packet):
+class PacketHeartbeat(Packet, identifier="heartbeat", type_id=15):
+    '''Liveness probe sent by the server to the connections that went silent, the peer sends it back as is'''
+    __slots__ = ('sent',)
+    WIRE_FIELDS = (('sent', None),)
+
+    def __init__(self, sent: float = None) -> None:
+        super().__init__()
+        self.sent = sent # server time of the probe
+
+    def get_data(self) -> dict:
+        return {'sent': self.sent}
+
+    def set_data(self, data: dict) -> None:
+        self.sent = data['sent']
+
+class PacketSessionTicket(Packet, identifier="session_ticket", type_id=16):
+    '''Resumption ticket sent by the server once a connection is accepted. The node connects once to `/ws/{ticket}`
+    instead of the preauth and signed token, at most `lifetime` seconds after the connection it was issued on closed'''
+    __slots__ = ('ticket', 'lifetime')
+    WIRE_FIELDS = (('ticket', None), ('lifetime', None))
+
+    def __init__(self, ticket: str = None, lifetime: float = None) -> None:
+        super().__init__()
+        self.ticket = ticket
+        self.lifetime = lifetime
+
+    def get_data(self) -> dict:
+        return {'ticket': self.ticket, 'lifetime': self.lifetime}
+
+    def set_data(self, data: dict) -> None:
+        self.ticket = data['ticket']
+        self.lifetime = data['lifetime']
+
+class RetryReason(Enum):
+    HANDSHAKE = "handshake" # too many connections in progress, reconnect after the delay
+    RATE = "rate"           # the node sends faster than its rate, slow down
+
+class PacketRetryAfter(Packet, identifier="retry_after", type_id=17):
+    '''Sent by the server to a refused connection (before closing it with code 1013) or to a node over its inbound rate'''
+    __slots__ = ('delay', 'reason')
+    WIRE_FIELDS = (('delay', None), ('reason', RetryReason))
+
+    def __init__(self, delay: float = None, reason: RetryReason = None) -> None:
+        super().__init__()
+        self.delay = delay # seconds
+        self.reason = reason
+
+    def get_data(self) -> dict:
+        return {'delay': self.delay, 'reason': self.reason.value if self.reason is not None else None}
+
+    def set_data(self, data: dict) -> None:
+        self.delay = data['delay']
+        self.reason = RetryReason(data['reason']) if data['reason'] is not None else None
+
+class PacketResume(Packet, identifier="resume", type_id=18):
+    '''Session resumption, see network.replay.ResumableSession. `received` is the sequence number of the last frame
+    received from the peer in the session, `next_seq` the one of the next frame sent (replayed frames first),
+    None in the offer the server sends as the first frame of a connection'''
+    __slots__ = ('session', 'received', 'next_seq')
+    WIRE_FIELDS = (('session', None), ('received', None), ('next_seq', None))
+
+    def __init__(self, session: str = None, received: int = None, next_seq: int = None) -> None:
+        super().__init__()
+        self.session = session # id of the session of the sender, a new one when its state was lost
+        self.received = received
+        self.next_seq = next_seq
+
+    def get_data(self) -> dict:
+        return {'session': self.session, 'received': self.received, 'next_seq': self.next_seq}
+
+    def set_data(self, data: dict) -> None:
+        self.session = data['session']
+        self.received = data['received']
+        self.next_seq = data['next_seq']
+
+class PacketAck(Packet, identifier="ack", type_id=19):
+    '''Acknowledges every frame of the session up to `received`, the peer forgets them'''
+    __slots__ = ('received',)
+    WIRE_FIELDS = (('received', None),)
+
+    def __init__(self, received: int = None) -> None:
+        super().__init__()
+        self.received = received
+
+    def get_data(self) -> dict:
+        return {'received': self.received}
+
+    def set_data(self, data: dict) -> None:
+        self.received = data['received']
+
+class PacketDemoProcState(Packet, identifier="demo_proc_state", type_id=3):
     '''Contains the state of the demo process on the node.
     Mainly IsAlive and IsRunning.'''
-    pass
+    __slots__ = ()
     
 #####################! REMOVE THIS CLASS !#####################
-class PacketMachineLog(Packet): # TODO : Changing to LogEntry
+class PacketMachineLog(Packet, identifier="machine_log", type_id=4): # TODO : Changing to LogEntry
     '''Machine log contains the log from the machine itself.
     These logs contains the journalctl logs from the machine and other logs from the machine itself'''
+    __slots__ = ('kind', 'name', 'log')
+    WIRE_FIELDS = (('kind', _as_str), ('name', _as_str), ('log', _as_str))
+    priority = PacketPriority.BULK
+
     def __init__(self, kind: str = None, name: str = None, log: str = None) -> None:
-        super().__init__("machine_log")
+        super().__init__()
         self.kind = kind
         self.name = name
         self.log  = log
@@ -234,12 +601,16 @@ class PacketMachineLog(Packet): # TODO : Changing to LogEntry
 #####################! REMOVE THIS CLASS !#####################
 
 class PacketShellCommandResponse(Packet):
+    __slots__ = ()
     pass
 
 
-class PacketInteractiveSession(Packet):
+class PacketInteractiveSession(Packet, identifier="interactive_session", type_id=5):
+    __slots__ = ('uuid', 'executable', 'value', 'return_value', 'target_machine', 'action')
+    WIRE_FIELDS = (('uuid', None), ('executable', None), ('value', _as_bytes), ('return_value', int), ('target_machine', None), ('action', None))
+
     def __init__(self, uuid: str = None, executable = None, value = None, return_value = None, target_machine = None, action = None) -> None:
-        super().__init__("interactive_session")
+        super().__init__()
         self.uuid: str = uuid
         self.executable: str = executable
         self.value: Union[str, bytes] = value
@@ -264,9 +635,12 @@ class PacketInteractiveSession(Packet):
         self.target_machine = data['target_machine'] if 'target_machine' in data else None
         self.action = data['action'] if 'action' in data else None
 
-class PacketScriptInteractiveSession(Packet):
+class PacketScriptInteractiveSession(Packet, identifier="script_interactive_session", type_id=8):
+    __slots__ = ('script', 'targets')
+    WIRE_FIELDS = (('script', _as_str), ('targets', None))
+
     def __init__(self, script: str = None, targets: list[str] = None) -> None:
-        super().__init__("script_interactive_session")
+        super().__init__()
         self.script = script
         self.targets = targets
 
@@ -281,13 +655,70 @@ class PacketScriptInteractiveSession(Packet):
         self.targets = data['targets']
         
 
-def decode(source: str) -> Packet:
-    """Decodes a Packet from a str representation
+class PacketBatch(Packet, identifier="batch", type_id=12):
+    '''Batch holds several packets of any kind sent as a single ws frame.
+    Nodes use it to ship log lines and hardware metrics in bulk, the receiver handles the sub-packets in order'''
+    __slots__ = ('packets',)
+    priority = PacketPriority.BULK
+
+    def __init__(self, packets: list[Packet] = None) -> None:
+        super().__init__()
+        self.packets: list[Packet] = packets if packets is not None else []
+
+    def get_data(self) -> dict:
+        return {'packets': [{'type': p.identifier, 'data': p.get_data()} for p in self.packets]}
+
+    def set_data(self, data: dict) -> None:
+        self.packets = []
+        for d in data['packets']:
+            pck: Packet = PACKET_REGISTRY[d['type']]()
+            pck.set_data(d['data'])
+            self.packets.append(pck)
+
+    def encode_binary(self) -> bytes:
+        out = bytearray(_U8.pack(self.type_id))
+        _pack_value(out, [p.encode_binary() for p in self.packets])
+        return bytes(out)
+
+    def set_wire_fields(self, buf: memoryview, off: int) -> int:
+        frames, off = _unpack_value(buf, off)
+        self.packets = [_decode_binary(f) for f in frames]
+        return off
+
+def handler_table(owner: type, prefix: str = '_handle_') -> dict[str, Callable]:
+    """Resolve once the packet handlers of a class, instead of a getattr per received packet
+
+    Parameters
+    ----------
+    owner : type
+        The class holding the handlers, named {prefix}{identifier}
+    prefix : str, optional
+        The prefix of the handler methods, by default '_handle_'
+
+    Returns
+    -------
+    dict[str, Callable]
+        identifier -> unbound handler, to call with (instance, packet)
+    """
+    return {
+        identifier: getattr(owner, f'{prefix}{identifier}')
+        for identifier in PACKET_REGISTRY if hasattr(owner, f'{prefix}{identifier}')
+    }
+
+def _decode_binary(source: bytes) -> Packet:
+    buf = memoryview(source)
+    pck: Packet = PACKET_TYPE_REGISTRY[buf[0]]()
+    off = pck.set_wire_fields(buf, 1)
+    if off != len(buf): raise ValueError(f'Trailing data in binary packet ({len(buf) - off} bytes)')
+    return pck
+
+def decode(source: Union[str, bytes]) -> Packet:
+    """Decodes a Packet from a str (JSON) or bytes (binary codec) representation
 
     Parameters
     ----------
-    source : str
-        The representation as received over ws
+    source : Union[str, bytes]
+        The representation as received over ws, a text or a binary frame
 
     Returns
     -------
@@ -295,8 +726,9 @@ def decode(source: str) -> Packet:
         The crafted packet from the representation
     """
     try:
+        if isinstance(source, (bytes, bytearray)): return _decode_binary(source)
         data = json.loads(source)
-        pck: Packet = getattr(sys.modules[__name__], f'Packet{PACKET_ID_MATCHING[data["type"]]}')()
+        pck: Packet = PACKET_REGISTRY[data["type"]]()
         pck.set_data(data = data['data'])
         return pck
     except:
@@ -309,4 +741,4 @@ if __name__ == "__main__":
     data = pck.encode()
     print(data)
     pck2 = decode(data)
-    print(pck2.to_dict())
+    print(pck2.get_data())
@@ -0,0 +1,170 @@
+'''Bounded outbound packet queues shared by the server connections and the node client'''
+
+import itertools
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Union
+
+from .packets import Packet, PacketPriority
+
+class OverflowPolicy(Enum):
+    BLOCK = "block"               # the producer waits for room (rejected if it cannot wait)
+    DROP_OLDEST = "drop_oldest"   # the oldest queued packet of the class is dropped
+    LATEST_VALUE = "latest_value" # a queued packet with the same coalesce key is replaced, drop oldest otherwise
+
+@dataclass
+class QueueClassConfig:
+    max_size: int
+    policy: OverflowPolicy
+
+DEFAULT_QUEUE_CONFIG = {
+    PacketPriority.INTERACTIVE: QueueClassConfig(4096, OverflowPolicy.BLOCK),
+    PacketPriority.STATE:       QueueClassConfig(256,  OverflowPolicy.LATEST_VALUE),
+    PacketPriority.BULK:        QueueClassConfig(8192, OverflowPolicy.DROP_OLDEST),
+}
+
+def queue_config_from_dict(config: dict) -> dict[PacketPriority, QueueClassConfig]:
+    """Parse the outbound queue section of a config file
+
+    Parameters
+    ----------
+    config : dict
+        class name -> {"max_size": int, "policy": "block" | "drop_oldest" | "latest_value"}, e.g.
+        `{"bulk": {"max_size": 1024, "policy": "drop_oldest"}}`. Missing classes and keys keep their default.
+
+    Returns
+    -------
+    dict[PacketPriority, QueueClassConfig]
+        The configuration of every queue class
+    """
+    res = dict(DEFAULT_QUEUE_CONFIG)
+    for name, cfg in (config or {}).items():
+        prio = PacketPriority[name.upper()]
+        res[prio] = QueueClassConfig(
+            int(cfg.get('max_size', res[prio].max_size)),
+            OverflowPolicy(cfg['policy']) if 'policy' in cfg else res[prio].policy
+        )
+    return res
+
+class PriorityPacketQueue:
+    '''Thread-safe bounded packet queue with one FIFO per PacketPriority.
+    Packets of a lower priority value are always dequeued first. Every class has its own size bound and overflow policy,
+    the packets lost to the policy are counted in `dropped`.
+
+        ----- Parameters -----
+        config : dict[PacketPriority, QueueClassConfig] = None
+            Per class configuration, DEFAULT_QUEUE_CONFIG for missing classes
+        on_put : Callable[[], None] = None
+            Called (outside the lock) every time a packet is queued, used to wake up async consumers
+    '''
+    def __init__(self, config: dict[PacketPriority, QueueClassConfig] = None, on_put: Callable[[], None] = None) -> None:
+        self.config = {**DEFAULT_QUEUE_CONFIG, **(config or {})}
+        self.queues: dict[PacketPriority, OrderedDict] = {p: OrderedDict() for p in PacketPriority}
+        self.dropped: dict[str, int] = {p.name.lower(): 0 for p in PacketPriority}
+        self.on_put = on_put
+        self.condition = threading.Condition()
+        self._keys = itertools.count() # unique keys of the packets that are not coalesced
+
+    def __len__(self) -> int:
+        with self.condition:
+            return sum(len(q) for q in self.queues.values())
+
+    def put(self, pck: Packet, block: bool = True, timeout: float = None) -> bool:
+        """Queue a packet according to the overflow policy of its class
+
+        Parameters
+        ----------
+        pck : Packet
+            The packet to queue
+        block : bool, optional
+            Whether the caller can wait for room in BLOCK classes, by default True
+        timeout : float, optional
+            Max wait in BLOCK classes, by default None (forever)
+
+        Returns
+        -------
+        bool
+            False if the packet was rejected
+        """
+        prio = pck.priority
+        cfg, q = self.config[prio], self.queues[prio]
+        with self.condition:
+            key = None
+            if cfg.policy == OverflowPolicy.LATEST_VALUE:
+                key = pck.coalesce_key()
+                if key is not None:
+                    key = (pck.identifier, key)
+                    if key in q:
+                        q[key] = pck # latest value wins, keeps the queue position
+                        self.dropped[prio.name.lower()] += 1
+                        return True
+            if len(q) >= cfg.max_size:
+                if cfg.policy == OverflowPolicy.BLOCK:
+                    if not block or not self.condition.wait_for(lambda: len(q) < cfg.max_size, timeout):
+                        self.dropped[prio.name.lower()] += 1
+                        return False
+                else:
+                    q.popitem(last=False)
+                    self.dropped[prio.name.lower()] += 1
+            q[key if key is not None else next(self._keys)] = pck
+            self.condition.notify_all()
+        if self.on_put is not None: self.on_put()
+        return True
+
+    def requeue(self, packets: list[Packet]) -> None:
+        """Put back dequeued packets that could not be sent, ahead of their class and in order.
+        The bounds are not applied (the packets were already queued), a coalesced packet is skipped if a newer value is queued"""
+        if not packets: return
+        with self.condition:
+            for pck in reversed(packets):
+                prio = pck.priority
+                q, key = self.queues[prio], None
+                if self.config[prio].policy == OverflowPolicy.LATEST_VALUE and (key := pck.coalesce_key()) is not None:
+                    key = (pck.identifier, key)
+                    if key in q:
+                        self.dropped[prio.name.lower()] += 1
+                        continue
+                if key is None: key = next(self._keys)
+                q[key] = pck
+                q.move_to_end(key, last=False)
+            self.condition.notify_all()
+        if self.on_put is not None: self.on_put()
+
+    def _pop(self) -> Union[Packet, None]:
+        for q in self.queues.values():
+            if q: return q.popitem(last=False)[1]
+        return None
+
+    def get(self, block: bool = True, timeout: float = None) -> Union[Packet, None]:
+        """Dequeue the next packet, by priority then FIFO
+
+        Parameters
+        ----------
+        block : bool, optional
+            Wait for a packet if the queue is empty, by default True
+        timeout : float, optional
+            Max wait, by default None (forever)
+
+        Returns
+        -------
+        Union[Packet, None]
+            The packet, None if the queue is empty
+        """
+        with self.condition:
+            if block: self.condition.wait_for(lambda: any(self.queues.values()), timeout)
+            pck = self._pop()
+            if pck is not None: self.condition.notify_all() # room for blocked producers
+            return pck
+
+    def drain(self, max_packets: int = None) -> list[Packet]:
+        """Dequeue up to max_packets packets without waiting, by priority then FIFO"""
+        packets = []
+        with self.condition:
+            while max_packets is None or len(packets) < max_packets:
+                pck = self._pop()
+                if pck is None: break
+                packets.append(pck)
+            if packets: self.condition.notify_all()
+        return packets
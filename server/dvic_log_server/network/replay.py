@@ -0,0 +1,182 @@
+'''Sequence numbers, acknowledgements and replay buffers of the sessions, shared by the server connections and the node client
+
+A session outlives the websocket connections of a node. Sequence numbers are implicit: the frames sent in a session are
+numbered from 1 in each direction, PacketResume and PacketAck frames excepted. When a node connects:
+
+1. the server sends an offer, PacketResume(session, received, None), as the first frame and holds its other frames
+2. the node answers PacketResume(session, received, next_seq), then sends its frames not received by the server, then new ones
+3. the server sends PacketResume(session, received, next_seq), then its frames not received by the node, then new ones
+
+Peers that never send an answer (older nodes, the cli) stay unsequenced. A peer seen with another session id lost its
+state (restart): nothing is replayed to it and its numbering is adopted.
+'''
+
+import threading
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Union
+
+from .packets import Packet, PacketResume, PacketAck
+
+SESSION_CONTROL = (PacketResume, PacketAck) # frames out of the numbering
+
+@dataclass
+class ReplayConfig:
+    max_packets: int = 1024        # sent packets kept until acknowledged, the oldest are dropped beyond
+    max_bytes: int = 4 * 2**20     # encoded size bound of the kept packets
+    ack_every: int = 32            # received frames between two PacketAck
+    ack_delay: float = 1.0         # or seconds since the last PacketAck, also flushed on a timer when no more frames come
+    resume_timeout: float = 10.0   # wait for the PacketResume of the peer before going on unsequenced
+    resume_window: float = 300.0   # (server) the session of a disconnected node is kept this long for its next connection
+
+class ReplayBuffer:
+    '''Sent packets not acknowledged by the peer yet, by sequence number. Bounded in packets and bytes:
+    once full the oldest packets are dropped and cannot be replayed anymore (counted in `dropped`)'''
+    def __init__(self, max_packets: int = 1024, max_bytes: int = 4 * 2**20) -> None:
+        self.max_packets = max_packets
+        self.max_bytes = max_bytes
+        self.packets: deque[tuple[int, Packet, int]] = deque() # (seq, packet, encoded size)
+        self.bytes = 0
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self.packets)
+
+    def append(self, seq: int, pck: Packet, size: int) -> None:
+        self.packets.append((seq, pck, size))
+        self.bytes += size
+        while len(self.packets) > self.max_packets or (self.bytes > self.max_bytes and len(self.packets) > 1):
+            self.bytes -= self.packets.popleft()[2]
+            self.dropped += 1
+
+    def ack(self, seq: int) -> list[Packet]:
+        '''Forget the packets up to seq, returns them'''
+        acked = []
+        while self.packets and self.packets[0][0] <= seq:
+            _, pck, size = self.packets.popleft()
+            self.bytes -= size
+            acked.append(pck)
+        return acked
+
+    def clear(self) -> None:
+        self.packets.clear()
+        self.bytes = 0
+
+class ResumableSession:
+    '''Numbering and replay buffer of one side of a session, see the module documentation.
+    `sent_packet` and `received_packet` only count once the resumption handshake of the current connection is done.
+    Thread-safe: the node sends and receives on two threads.
+
+        ----- Parameters -----
+        config : ReplayConfig = None
+        on_acked : Callable[[list[Packet]], None] = None
+            Called (outside the lock) with the sent packets once the peer acknowledged them
+    '''
+    def __init__(self, config: ReplayConfig = None, on_acked: Callable[[list[Packet]], None] = None) -> None:
+        self.config = config or ReplayConfig()
+        self.on_acked = on_acked
+        self.session = uuid.uuid4().hex
+        self.peer_session: str = None
+        self.sent = 0      # seq of the last frame sent
+        self.received = 0  # seq of the last frame received, None when the state of the peer was lost
+        self.unacked = 0   # frames received since the last PacketAck
+        self.acked_at = time.monotonic()
+        self.lost = 0      # frames of the peer it could not replay
+        self.counting_in = False
+        self.counting_out = False
+        self.replay = ReplayBuffer(self.config.max_packets, self.config.max_bytes)
+        self.lock = threading.Lock()
+
+    def offer(self) -> PacketResume:
+        '''First frame of a connection (server side), the counting stops until the peer answers'''
+        with self.lock:
+            self.counting_in = self.counting_out = False
+            return PacketResume(self.session, self.received)
+
+    def peer_resumed(self, pck: PacketResume) -> int:
+        """Apply the PacketResume of the peer: acknowledged packets are forgotten, the inbound numbering restarts at its next_seq
+
+        Returns
+        -------
+        int
+            Number of packets of the peer that will never be received (dropped from its full replay buffer)
+        """
+        acked = []
+        with self.lock:
+            if pck.session != self.peer_session:
+                self.replay.clear() # new peer state, nothing to replay
+                self.peer_session, self.received = pck.session, None # unknown until its next_seq
+            else: acked = self.replay.ack(pck.received or 0)
+            lost = 0
+            if pck.next_seq is not None: # not an offer
+                lost = max(0, pck.next_seq - 1 - self.received) if self.received is not None else 0
+                self.lost += lost
+                self.received, self.unacked, self.counting_in = pck.next_seq - 1, 0, True
+        self._acked(acked)
+        return lost
+
+    def resume(self) -> tuple[PacketResume, list[Packet]]:
+        """Answer to the PacketResume of the peer, counting starts after it
+
+        Returns
+        -------
+        tuple[PacketResume, list[Packet]]
+            The PacketResume to send, then the packets to send again (already numbered)
+        """
+        with self.lock:
+            self.counting_out = True
+            replayed = [p for _, p, _ in self.replay.packets]
+            first = self.replay.packets[0][0] if self.replay.packets else self.sent + 1
+            return PacketResume(self.session, self.received, first), replayed
+
+    def stop(self) -> None:
+        '''The connection is closed or unsequenced'''
+        with self.lock: self.counting_in = self.counting_out = False
+
+    def sent_packet(self, pck: Packet, size: int) -> Union[int, None]:
+        '''Number and keep a packet about to be sent, returns its seq (None if not counted)'''
+        if isinstance(pck, SESSION_CONTROL): return None
+        with self.lock:
+            if not self.counting_out: return None
+            self.sent += 1
+            self.replay.append(self.sent, pck, size)
+            return self.sent
+
+    def received_packet(self, pck: Packet) -> Union[PacketAck, None]:
+        '''Count a received packet, returns the PacketAck to send once every `ack_every` packets or `ack_delay` seconds'''
+        if isinstance(pck, SESSION_CONTROL): return None
+        with self.lock:
+            if not self.counting_in: return None
+            self.received += 1
+            self.unacked += 1
+            now = time.monotonic()
+            if self.unacked < self.config.ack_every and now - self.acked_at < self.config.ack_delay: return None
+            self.unacked, self.acked_at = 0, now
+            return PacketAck(self.received)
+
+    def ack_due(self) -> Union[float, None]:
+        '''Seconds before the received packets not acknowledged yet are due a PacketAck, None if there are none'''
+        with self.lock:
+            if not self.counting_in or not self.unacked: return None
+            return max(0.0, self.acked_at + self.config.ack_delay - time.monotonic())
+
+    def flush_ack(self) -> Union[PacketAck, None]:
+        '''PacketAck of the packets received at the end of a burst once `ack_delay` elapsed, None if not due yet'''
+        with self.lock:
+            now = time.monotonic()
+            if not self.counting_in or not self.unacked or now - self.acked_at < self.config.ack_delay: return None
+            self.unacked, self.acked_at = 0, now
+            return PacketAck(self.received)
+
+    def acked(self, pck: PacketAck) -> None:
+        with self.lock: acked = self.replay.ack(pck.received)
+        self._acked(acked)
+
+    def _acked(self, packets: list[Packet]) -> None:
+        if packets and self.on_acked is not None: self.on_acked(packets)
+
+def replay_config_from_dict(config: dict) -> ReplayConfig:
+    '''Parse the `replay` section of a config file, missing keys keep their default'''
+    return ReplayConfig(**(config or {}))
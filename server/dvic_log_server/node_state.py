@@ -0,0 +1,71 @@
+'''Live state of the nodes, kept in memory for the REST API'''
+
+import json
+import secrets
+import threading
+from typing import Any, Union
+
+from dvic_log_server.utils.wrappers import singleton
+
+@singleton
+class NodeStateRegistry:
+    '''Latest hardware state of every node, updated in place by the connection handlers.
+    Every change bumps a version, the JSON snapshots served by the API are built once per version
+    and their ETag is derived from it so polling clients get cheap 304s.
+    '''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.states: dict[str, dict[str, dict]] = {} # node uid -> kind -> {'data', 'timestamp'}
+        self.versions: dict[str, int] = {}           # node uid -> version of its state
+        self.version = 0                             # version of the whole fleet
+        self.generation = secrets.token_hex(4)       # ETags of a previous server run never match
+        self._snapshots: dict[Union[str, None], tuple[int, bytes]] = {} # node uid (None for the fleet) -> (version, JSON)
+
+    def update(self, uid: str, kind: str, data: Any, timestamp: float) -> None:
+        """Set the latest value of a metric of a node
+
+        Parameters
+        ----------
+        uid : str
+            The node
+        kind : str
+            The metric (cpu_usage, temperature, ...)
+        data : Any
+            Its value, as sent by the node
+        timestamp : float
+            Reception time
+        """
+        with self.lock:
+            self.states.setdefault(uid, {})[kind] = {'data': data, 'timestamp': timestamp}
+            self.version += 1
+            self.versions[uid] = self.version
+
+    def remove(self, uid: str) -> None:
+        with self.lock:
+            if self.states.pop(uid, None) is None: return
+            del self.versions[uid]
+            self._snapshots.pop(uid, None)
+            self.version += 1
+
+    def etag(self, uid: str = None) -> Union[str, None]:
+        '''Returns the ETag of the state of a node (of the fleet if uid is None), None if the node is unknown'''
+        with self.lock:
+            version = self.version if uid is None else self.versions.get(uid)
+        return None if version is None else f'"{self.generation}-{version}"'
+
+    def snapshot(self, uid: str = None) -> Union[tuple[bytes, str], tuple[None, None]]:
+        """Returns the JSON state of a node, or of the fleet (uid -> kind -> state) if uid is None
+
+        Returns
+        -------
+        Union[tuple[bytes, str], tuple[None, None]]
+            The JSON document and its ETag, (None, None) if the node is unknown
+        """
+        with self.lock:
+            version = self.version if uid is None else self.versions.get(uid)
+            if version is None: return None, None
+            cached = self._snapshots.get(uid)
+            if cached is None or cached[0] != version:
+                cached = (version, json.dumps(self.states if uid is None else self.states[uid]).encode())
+                self._snapshots[uid] = cached
+        return cached[1], f'"{self.generation}-{version}"'
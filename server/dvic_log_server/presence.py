@@ -0,0 +1,79 @@
+'''Presence events: pushes the connections and disconnections of the nodes to the subscribed clients'''
+
+import asyncio
+
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import PacketNodeStatus, NodeStatusAction
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info
+
+COALESCE_WINDOW = 0.5   # seconds the changes are gathered before a delta is sent
+LAST_SEEN_BUCKET = 30.0 # seconds, a delta is sent when the last_seen of a node enters a new bucket
+
+def node_entry(connection: AConnection) -> dict:
+    '''Status of a node as listed by PacketNodeStatus'''
+    return {
+        'status': 'disconnected' if connection is None or connection.is_disconnected() else 'stale' if getattr(connection, 'stale', False) else 'connected',
+        'last_seen': connection.last_seen if connection is not None else None,
+        'dropped': connection.dropped if connection is not None else None,
+    }
+
+def last_seen_bucket(timestamp: float) -> float:
+    return timestamp // LAST_SEEN_BUCKET * LAST_SEEN_BUCKET
+
+@singleton
+class PresenceHub:
+    '''Subscribers of the node status and the changes not sent to them yet.
+    Subscribing sends a snapshot of every connection, the ConnectionManager and the connections then report
+    the changes (connected, disconnected, last_seen bucket) and the hub sends them as one delta per COALESCE_WINDOW,
+    where later changes of a node override the earlier ones: a mass reconnect costs a few packets per subscriber.
+    Every method runs on the event loop thread, next to the websocket endpoint and the handlers.
+    '''
+    def __init__(self) -> None:
+        self.subscribers: dict[int, AConnection] = {} # id(connection) -> connection
+        self.pending: dict[str, dict] = {}            # uid -> changed fields since the last delta
+        self.scheduled = False
+        self.stats = {'changes': 0, 'deltas': 0}
+
+    def subscribe(self, connection: AConnection, connections: dict[str, AConnection]) -> None:
+        '''Send the snapshot of the connections, then the deltas'''
+        self.subscribers[id(connection)] = connection
+        connection.send_packet(PacketNodeStatus(NodeStatusAction.SNAPSHOT, {uid: node_entry(c) for uid, c in connections.items()}))
+        info(f'[{connection.uid}] Subscribed to the node status')
+
+    def unsubscribe(self, connection: AConnection) -> None:
+        self.subscribers.pop(id(connection), None)
+
+    def changed(self, uid: str, **fields) -> None:
+        '''Record a change of the status of a node, sent with the next delta'''
+        if not self.subscribers: return
+        self.pending.setdefault(uid, {}).update(fields)
+        self.stats['changes'] += 1
+        if self.scheduled: return
+        try: asyncio.get_running_loop().call_later(COALESCE_WINDOW, self.flush)
+        except RuntimeError: return # no event loop (tests), flushed by the caller
+        self.scheduled = True
+
+    def connected(self, uid: str, connection: AConnection) -> None:
+        self.changed(uid, status='connected', last_seen=last_seen_bucket(connection.last_seen))
+
+    def disconnected(self, uid: str) -> None:
+        self.changed(uid, status='disconnected')
+
+    def flush(self) -> int:
+        """Send the pending changes to every subscriber
+
+        Returns
+        -------
+        int
+            Number of nodes in the delta
+        """
+        self.scheduled = False
+        pending, self.pending = self.pending, {}
+        if not pending: return 0
+        delta = PacketNodeStatus(NodeStatusAction.DELTA, pending)
+        for key, conn in list(self.subscribers.items()):
+            if conn.is_disconnected(): del self.subscribers[key]
+            else: conn.send_packet(delta)
+        self.stats['deltas'] += 1
+        return len(pending)
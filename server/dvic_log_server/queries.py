@@ -0,0 +1,319 @@
+'''Paginated queries on the stored logs and hardware states.
+
+Pages are sorted by timestamp with a unique tie-breaker and chained by an opaque cursor holding the sort values
+of the last document of the previous page (search_after on Elasticsearch, keyset on SQLite): a page costs the
+same wherever it is in the result set and documents written while a client pages through do not shift the pages.
+
+QueryCache serves the same pages with the time buckets that stopped receiving documents kept in memory.
+'''
+
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterator, Union
+
+import dvic_log_server.api as api
+from dvic_log_server.database_drivers import DatabaseConfig, DatabaseConnector, open_connector
+from dvic_log_server.indices import FAMILIES
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info
+
+MAX_PAGE_SIZE = 1000
+
+def build_query(nodes: list[str] = None, kinds: list[str] = None, names: list[str] = None,
+                start: float = None, end: float = None, text: str = None) -> dict:
+    """Elasticsearch query of the documents matching every given filter
+
+    Parameters
+    ----------
+    nodes, kinds, names : list[str], optional
+        Accepted values of the field, any value by default
+    start, end : float, optional
+        Bounds (inclusive) of the timestamp, seconds since epoch
+    text : str, optional
+        Searched in the log line
+
+    Returns
+    -------
+    dict
+        A bool query, match_all without filter
+    """
+    filters = [{'terms': {f: v}} for f, v in (('node', nodes), ('kind', kinds), ('name', names)) if v]
+    bounds = {op: v for op, v in (('gte', start), ('lte', end)) if v is not None}
+    if bounds: filters.append({'range': {'timestamp': bounds}})
+    must = [{'match_phrase': {'log': text}}] if text else []
+    if not filters and not must: return {'match_all': {}}
+    return {'bool': {'filter': filters, 'must': must}}
+
+
+def encode_cursor(after: Union[list, None]) -> Union[str, None]:
+    '''Opaque cursor of a page from the sort values of the last document of the previous one'''
+    if after is None: return None
+    return base64.urlsafe_b64encode(json.dumps(after, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: Union[str, None]) -> Union[list, None]:
+    '''Position held by a cursor, ValueError if it was not made by encode_cursor'''
+    if not cursor: return None
+    try: after = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError): raise ValueError('Invalid cursor')
+    if not isinstance(after, list) or not after: raise ValueError('Invalid cursor')
+    return after
+
+
+def query_page(database: DatabaseConfig, index: str, filters: dict = None, fields: list[str] = None, size: int = 100,
+               cursor: str = None, descending: bool = False) -> tuple[list[dict], Union[str, None]]:
+    """Returns one page of the documents of a family matching the filters
+
+    Parameters
+    ----------
+    database : DatabaseConfig
+        The database to query
+    index : str
+        A family of indices.FAMILIES
+    filters : dict, optional
+        Keyword arguments of build_query, everything by default
+    fields : list[str], optional
+        Fields of the returned documents, every field by default
+    size : int, optional
+        Documents per page, at most MAX_PAGE_SIZE, by default 100
+    cursor : str, optional
+        `next_cursor` of the previous page, the first page by default
+    descending : bool, optional
+        Newest documents first, by default False
+
+    Returns
+    -------
+    tuple[list[dict], Union[str, None]]
+        The documents and the cursor of the next page, None on the last page
+
+    Raises
+    ------
+    KeyError
+        Unknown family
+    ValueError
+        Invalid cursor, filter or size
+    """
+    if index not in FAMILIES: raise KeyError(index)
+    if not 0 < size <= MAX_PAGE_SIZE: raise ValueError(f'Page size must be in [1, {MAX_PAGE_SIZE}]')
+    try: query = build_query(**(filters or {}))
+    except TypeError as e: raise ValueError(f'Invalid filters: {e}')
+    after = decode_cursor(cursor)
+    if after is not None and len(after) != 2: raise ValueError('Invalid cursor')
+    connector = open_connector(database, index)
+    try: hits, after = connector.search_page(query, size, after, fields, descending)
+    finally: connector.close()
+    return hits, encode_cursor(after)
+
+
+def iter_pages(database: DatabaseConfig, index: str, filters: dict = None, fields: list[str] = None, size: int = MAX_PAGE_SIZE,
+               cursor: str = None, descending: bool = False) -> Iterator[list[dict]]:
+    '''Yields the pages of query_page until the last one, only one page is held in memory at a time'''
+    while True:
+        hits, cursor = query_page(database, index, filters, fields, size, cursor, descending)
+        if hits: yield hits
+        if cursor is None: return
+
+
+@dataclass
+class QueryCacheConfig:
+    max_bytes: int = 64 * 2**20          # bound of the cached documents (JSON size), 0 disables the cache
+    bucket: float = 3600.0               # seconds, length of the cached time buckets
+    grace: float = 120.0                 # seconds after its end before a bucket is considered closed (node batching, ingest delay)
+    max_bucket_documents: int = 20_000   # buckets holding more matching documents are queried from the database every time
+
+ENTRY_OVERHEAD = 256 # bytes accounted per cache entry on top of its documents
+
+def _within(query: dict, lo: float = None, hi: float = None) -> dict:
+    '''Restricts a query of build_query to the timestamps in [lo, hi)'''
+    bounds = {op: v for op, v in (('gte', lo), ('lt', hi)) if v is not None}
+    if not bounds: return query
+    clause = {'range': {'timestamp': bounds}}
+    if 'bool' not in query: return {'bool': {'filter': [clause]}}
+    return {'bool': {**query['bool'], 'filter': query['bool']['filter'] + [clause]}}
+
+def _normalize(filters: dict) -> tuple:
+    '''Cache key of the filters other than the time range, the order and repetition of the values do not matter'''
+    return tuple(tuple(sorted(set(filters[k]))) if filters.get(k) else None for k in ('nodes', 'kinds', 'names')) + (filters.get('text') or None,)
+
+def _valid_state(state: list) -> bool:
+    number = lambda v: isinstance(v, (int, float)) and not isinstance(v, bool)
+    if state[0] == 'bucket': return len(state) == 3 and number(state[1]) and isinstance(state[2], int) and state[2] >= 0
+    return len(state) == 4 and all(v is None or number(v) for v in state[1:3]) and (state[3] is None or (isinstance(state[3], list) and len(state[3]) == 2))
+
+
+@singleton
+class QueryCache:
+    '''LRU cache of the query results, bounded in bytes, in front of the database.
+    A query is split in fixed time buckets: the documents of a bucket that ended more than `grace` seconds ago are fetched once,
+    kept under the key (index, normalized filters, bucket) and sliced for every page and time range falling in it, while the open
+    trailing buckets are always read from the database and merged after (or before, newest first) the cached ones.
+    The ingest pipeline reports late writes (spool replay, delayed nodes) with `invalidate`, which drops the buckets they land in.
+
+    Cursors of the cached pages hold the bucket and the offset in it, or the database cursor of the open part of the query:
+    they are only understood by the cache, query_page answers the plain database cursors.
+
+        ----- Parameters -----
+        config : QueryCacheConfig = None
+            Read from the `query_cache` section of the server config by default
+        database : DatabaseConfig = None
+            Read from the `database` section of the server config by default
+    '''
+    def __init__(self, config: QueryCacheConfig = None, database: DatabaseConfig = None) -> None:
+        cm = api.ConnectionManager() if config is None or database is None else None
+        if config is None: config = QueryCacheConfig(**(cm.config.query_cache or {})) if cm.config is not None else QueryCacheConfig()
+        if database is None: database = cm.database_config()
+        self.config = config
+        self.database = database
+        self.entries: OrderedDict[tuple, tuple[list[dict], int]] = OrderedDict() # (index, filters, bucket start) -> (documents, bytes), least recently used first
+        self.bytes = 0
+        self.generations: dict[str, int] = {} # index -> invalidations, a bucket fetched across an invalidation is not stored
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'uncacheable': 0}
+        info(f'[QUERY] Caching up to {config.max_bytes} bytes of {config.bucket:g}s query buckets')
+
+    def horizon(self) -> float:
+        '''Start of the first open bucket, the buckets before it are closed'''
+        return (time.time() - self.config.grace) // self.config.bucket * self.config.bucket
+
+    def info(self) -> dict:
+        '''Counters of the cache, to size it'''
+        with self.lock:
+            return {**self.stats, 'entries': len(self.entries), 'bytes': self.bytes, 'max_bytes': self.config.max_bytes}
+
+    def invalidate(self, index: str, timestamp: float) -> None:
+        '''Drop the cached buckets of an index a document of this timestamp was written to'''
+        if timestamp >= self.horizon(): return # open bucket, never cached
+        with self.lock:
+            self.generations[index] = self.generations.get(index, 0) + 1
+            stale = [k for k in self.entries if k[0] == index and k[2] <= timestamp < k[2] + self.config.bucket]
+            for k in stale: self.bytes -= self.entries.pop(k)[1]
+            self.stats['invalidations'] += len(stale)
+
+    def page(self, index: str, filters: dict = None, fields: list[str] = None, size: int = 100,
+             cursor: str = None, descending: bool = False) -> tuple[list[dict], Union[str, None]]:
+        '''Same as query_page, with the closed time buckets served from the cache'''
+        if index not in FAMILIES: raise KeyError(index)
+        if not 0 < size <= MAX_PAGE_SIZE: raise ValueError(f'Page size must be in [1, {MAX_PAGE_SIZE}]')
+        filters = {k: v for k, v in (filters or {}).items() if v is not None}
+        try: query = build_query(**filters)
+        except TypeError as e: raise ValueError(f'Invalid filters: {e}')
+        state = decode_cursor(cursor)
+        if self.config.max_bytes <= 0 or (state is not None and state[0] not in ('bucket', 'backend')):
+            return query_page(self.database, index, filters, fields, size, cursor, descending)
+        if state is not None and not _valid_state(state): raise ValueError('Invalid cursor')
+        connector = open_connector(self.database, index)
+        try: hits, state = self._page(connector, index, filters, query, fields, size, state, descending)
+        finally: connector.close()
+        return hits, encode_cursor(state)
+
+    def iter_pages(self, index: str, filters: dict = None, fields: list[str] = None, size: int = MAX_PAGE_SIZE,
+                   cursor: str = None, descending: bool = False) -> Iterator[list[dict]]:
+        '''Yields the pages of `page` until the last one'''
+        while True:
+            hits, cursor = self.page(index, filters, fields, size, cursor, descending)
+            if hits: yield hits
+            if cursor is None: return
+
+    def _page(self, connector: DatabaseConnector, index: str, filters: dict, query: dict, fields: list[str], size: int,
+              state: Union[list, None], descending: bool) -> tuple[list[dict], Union[list, None]]:
+        '''Walks the buckets from the cursor position until the page is full.
+        States: ['bucket', start, offset] in a closed bucket, ['backend', lo, hi, after] for the database over [lo, hi)'''
+        length, horizon = self.config.bucket, self.horizon()
+        start, end = filters.get('start'), filters.get('end')
+        def lower_bound() -> Union[float, None]: # start filter, or timestamp of the first matching document
+            if start is not None: return start
+            earliest, _ = connector.search_page(query, 1, fields=['timestamp'])
+            return earliest[0]['timestamp'] if earliest else None
+        if state is None:
+            if descending: state = ['bucket', end // length * length, 0] if end is not None and end < horizon else ['backend', horizon, None, None]
+            else:
+                lower = lower_bound()
+                if lower is None: return [], None
+                state = ['bucket', lower // length * length, 0]
+        hits, lower = [], start
+        while len(hits) < size:
+            if state[0] == 'backend':
+                _, lo, hi, after = state
+                docs, after = connector.search_page(_within(query, lo, hi), size - len(hits), after, fields, descending)
+                hits += docs
+                if after is not None: return hits, ['backend', lo, hi, after]
+                if not descending or lo is None: return hits, None
+                state = ['bucket', lo - length, 0] # open part exhausted, closed buckets next
+                continue
+            _, b, offset = state
+            if not descending:
+                if end is not None and b > end: return hits, None
+                if b >= horizon: state = ['backend', b, None, None]; continue
+            else:
+                if lower is None: lower = lower_bound()
+                if lower is None or b + length <= lower: return hits, None
+            docs = self._bucket(connector, index, filters, query, b)
+            if docs is None: # too large to cache, the rest of the query goes to the database
+                if offset: raise ValueError('Expired cursor')
+                state = ['backend', None, b + length, None] if descending else ['backend', b, None, None]
+                continue
+            if (start is not None and start > b) or (end is not None and end < b + length):
+                docs = [d for d in docs if (start is None or start <= d['timestamp']) and (end is None or d['timestamp'] <= end)]
+            following = b - length if descending else b + length
+            if not docs and (descending or following < horizon) and not self._cached(index, filters, following): # sparse results,
+                state = self._next_bucket(connector, query, b, horizon, descending) # skip the following empty buckets with one query
+                if state is None: return hits, None
+                continue
+            if descending: docs = docs[::-1]
+            taken = docs[offset:offset + size - len(hits)]
+            hits += [{f: d[f] for f in fields if f in d} for d in taken] if fields else taken
+            offset += len(taken)
+            state = ['bucket', b, offset] if offset < len(docs) else ['bucket', b - length if descending else b + length, 0]
+        return hits, state
+
+    def _cached(self, index: str, filters: dict, b: float) -> bool:
+        with self.lock:
+            return (index, _normalize(filters), b) in self.entries
+
+    def _next_bucket(self, connector: DatabaseConnector, query: dict, b: float, horizon: float, descending: bool) -> Union[list, None]:
+        '''State of the bucket of the next matching document after the empty bucket b (before it when descending), found with
+        one uncached query instead of a query per empty bucket. None if there is no such document'''
+        length = self.config.bucket
+        lo, hi = (None, b) if descending else (b + length, horizon)
+        found, _ = connector.search_page(_within(query, lo, hi), 1, fields=['timestamp'], descending=descending)
+        if found: return ['bucket', found[0]['timestamp'] // length * length, 0]
+        return None if descending else ['backend', horizon, None, None] # the open part may still match
+
+    def _bucket(self, connector: DatabaseConnector, index: str, filters: dict, query: dict, b: float) -> Union[list[dict], None]:
+        '''Every document of a closed bucket matching the filters in time order, None if there are more than max_bucket_documents'''
+        key = (index, _normalize(filters), b)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            self.stats['misses'] += 1
+            generation = self.generations.get(index, 0)
+        docs, after = [], None
+        while True:
+            page, after = connector.search_page(_within(query, b, b + self.config.bucket), MAX_PAGE_SIZE, after)
+            docs += page
+            if len(docs) > self.config.max_bucket_documents:
+                with self.lock: self.stats['uncacheable'] += 1
+                return None
+            if after is None: break
+        nbytes = len(json.dumps(docs)) + ENTRY_OVERHEAD
+        with self.lock:
+            if nbytes > self.config.max_bytes or self.generations.get(index, 0) != generation: return docs
+            self.entries[key] = (docs, nbytes)
+            self.bytes += nbytes
+            while self.bytes > self.config.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.stats['evictions'] += 1
+        return docs
+
+
+def invalidate_writes(index: str, timestamp: float) -> None:
+    '''Report a write of a document of this timestamp to the query cache, if the server uses one'''
+    if QueryCache._instance is not None: QueryCache().invalidate(index, timestamp)
@@ -0,0 +1,130 @@
+'''Streaming rollups of the numeric hardware metrics'''
+
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any
+
+import dvic_log_server.api as api
+from dvic_log_server.indices import rollup_family
+from dvic_log_server.ingest import IngestPipeline
+from dvic_log_server.metrics import metric_samples
+from dvic_log_server.utils.wrappers import singleton
+from dvic_log_server.logs import info, warning
+
+WINDOW_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+
+def parse_window(window: str) -> int:
+    '''Returns the length in seconds of a window name such as `30s`, `5m` or `1h`'''
+    try: return int(window[:-1]) * WINDOW_UNITS[window[-1]]
+    except (KeyError, ValueError): raise ValueError(f'Invalid rollup window {window}')
+
+@dataclass
+class RollupConfig:
+    windows: list = field(default_factory=lambda: ['1m', '5m', '1h'])
+    grace: float = 30.0          # seconds a window stays open after its end for late samples
+    flush_interval: float = 5.0  # seconds between two checks for closed windows
+
+class Bucket:
+    '''Running aggregates of the samples of one window'''
+    __slots__ = ('min', 'max', 'sum', 'count', 'last', 'last_timestamp')
+
+    def __init__(self, value: float, timestamp: float) -> None:
+        self.min = self.max = self.sum = self.last = value
+        self.count = 1
+        self.last_timestamp = timestamp
+
+    def add(self, value: float, timestamp: float) -> None:
+        if value < self.min: self.min = value
+        if value > self.max: self.max = value
+        self.sum += value
+        self.count += 1
+        if timestamp >= self.last_timestamp: self.last, self.last_timestamp = value, timestamp
+
+@singleton
+class RollupEngine:
+    '''Incremental min/max/mean/count/last of every metric of every node over fixed windows (1m, 5m, 1h by default).
+    Samples are aggregated as they arrive, a window is emitted to its rollup family (see indices.rollup_family)
+    through the ingest pipeline once it ended more than `grace` seconds ago. Samples arriving later are counted and dropped.
+
+        ----- Parameters -----
+        config : RollupConfig = None
+            Read from the `rollups` section of the server config by default
+        emit : Callable[[str, dict], None] = None
+            Receives (index, document) for every closed window, IngestPipeline().submit by default
+    '''
+    def __init__(self, config: RollupConfig = None, emit = None) -> None:
+        if config is None:
+            cfg = api.ConnectionManager().config
+            config = RollupConfig(**(cfg.rollups or {})) if cfg is not None else RollupConfig()
+        self.config = config
+        self.windows = {w: parse_window(w) for w in config.windows}
+        self.families = {w: rollup_family(w).name for w in config.windows}
+        self.emit = emit if emit is not None else lambda index, doc: IngestPipeline().submit(index, doc)
+        self.buckets: dict[tuple[str, str, str, str, float], Bucket] = {} # (node, kind, metric, window, start) -> aggregates
+        self.lock = threading.Lock()
+        self.stats = {'samples': 0, 'emitted': 0, 'late': 0}
+        self.running = True
+        self.condition = threading.Condition(self.lock)
+        self.thread = threading.Thread(target=self._thread_target, daemon=True)
+        self.thread.start()
+        info(f'[ROLLUP] Rolling up hardware metrics over {", ".join(self.windows)}')
+
+    def add(self, uid: str, kind: str, data: Any, timestamp: float) -> None:
+        '''Aggregate the numeric fields of a hardware state'''
+        samples = metric_samples(kind, data)
+        if not samples: return
+        now = time.time()
+        with self.lock:
+            for window, length in self.windows.items():
+                start = timestamp - timestamp % length
+                if start + length + self.config.grace <= now:
+                    self.stats['late'] += len(samples) # window already emitted
+                    continue
+                for metric, value in samples:
+                    key = (uid, kind, metric, window, start)
+                    bucket = self.buckets.get(key)
+                    if bucket is None: self.buckets[key] = Bucket(value, timestamp)
+                    else: bucket.add(value, timestamp)
+            self.stats['samples'] += len(samples)
+
+    def flush(self, force: bool = False) -> int:
+        """Emit the windows closed for more than the grace period
+
+        Parameters
+        ----------
+        force : bool, optional
+            Emit every open window, by default False
+
+        Returns
+        -------
+        int
+            Number of windows emitted
+        """
+        now = time.time()
+        with self.lock:
+            closed = [k for k in self.buckets if force or k[4] + self.windows[k[3]] + self.config.grace <= now]
+            buckets = [(k, self.buckets.pop(k)) for k in closed]
+        for (uid, kind, metric, window, start), b in buckets:
+            self.emit(self.families[window], {
+                'node': uid, 'kind': kind, 'metric': metric, 'window': window, 'timestamp': start,
+                'min': b.min, 'max': b.max, 'mean': b.sum / b.count, 'count': b.count, 'last': b.last,
+            })
+        self.stats['emitted'] += len(buckets)
+        return len(buckets)
+
+    def stop(self) -> None:
+        '''Emit every open window and stop the flush thread'''
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.thread.join(self.config.flush_interval)
+        self.flush(force=True)
+
+    def _thread_target(self) -> None:
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: not self.running, self.config.flush_interval)
+                if not self.running: return
+            try: self.flush()
+            except Exception as e: warning(f'[ROLLUP] Flush failed ({type(e).__name__}: {e})')
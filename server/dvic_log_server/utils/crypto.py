@@ -3,6 +3,7 @@ from typing import Union
 import random
 import string
 import base64
+import binascii
 import os
 from abc import ABC, abstractmethod
 
@@ -96,6 +97,23 @@ class CryptClient():
     def decode_b64_from_url(self, eb64: str):
         return eb64.replace('*', '+').replace('_', '/').replace('-', '=')
 
+
+def split_initial_token(token: str) -> tuple[str, str, str, str]:
+    '''Returns the uid, signed plaintext, salt and (standard base64) signature of a token of craft_initial_token'''
+    plaintext, signature = token[:CUTOFF], token[CUTOFF:]
+    return plaintext[:UUID_LEN], plaintext, plaintext[UUID_LEN:CUTOFF], signature.replace('*', '+').replace('_', '/').replace('-', '=')
+
+_VERIFYING_KEYS: dict[str, tuple[object, VerifyingKey]] = {} # uid -> (version, parsed key), per process
+
+def verify_with_cached_key(uid: str, version: object, pem: str, plaintext: str, signature: str) -> bool:
+    '''Checks a signature with the public key of uid, parsed once per version of the key (e.g. the mtime of its file)
+    in each process. Top-level so it can run in a process pool'''
+    cached = _VERIFYING_KEYS.get(uid)
+    if cached is None or cached[0] != version:
+        cached = _VERIFYING_KEYS[uid] = (version, VerifyingKey.from_pem(pem))
+    try: return cached[1].verify(base64.b64decode(signature), plaintext.encode())
+    except (ecdsa.keys.BadSignatureError, binascii.Error): return False
+
 if __name__ == '__main__':
     import uuid
     #! fixme: cannot crete salt on client side because of replay attacks
@@ -0,0 +1,224 @@
+'''Append-only, segmented and checksummed record spool on disk'''
+
+import json
+import os
+import struct
+import threading
+import zlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Union
+
+_HEADER = struct.Struct('!II') # record length, crc32 of the record
+SEGMENT_SUFFIX = '.seg'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+EVICT_OLDEST = 'oldest' # drop the oldest segments when the spool is full
+EVICT_NONE   = 'none'   # refuse new records when the spool is full
+
+@dataclass(frozen=True)
+class SpoolPosition:
+    segment: int
+    offset: int
+
+class Spool:
+    '''Disk-backed FIFO of records (bytes).
+    Records are appended to segment files, each prefixed by its length and crc32. Readers consume them in order
+    and `commit` their position to a checkpoint file, so a restart resumes where the last commit stopped.
+    Disk usage is capped by `max_bytes`: the oldest segments are evicted (or new records refused) beyond.
+
+        ----- Parameters -----
+        path : Union[str, Path]
+            Directory of the segments and checkpoint, created if needed
+        segment_bytes : int = 16 MiB
+            A new segment is started once the active one reaches this size
+        max_bytes : int = 1 GiB
+            Cap of the total size of the segments
+        eviction : str = EVICT_OLDEST
+            EVICT_OLDEST or EVICT_NONE
+        fsync : bool = False
+            fsync the active segment after every append
+    '''
+    def __init__(self, path: Union[str, Path], segment_bytes: int = 16 * 2**20, max_bytes: int = 2**30, eviction: str = EVICT_OLDEST, fsync: bool = False) -> None:
+        if eviction not in (EVICT_OLDEST, EVICT_NONE): raise ValueError(f'Invalid eviction policy {eviction}')
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self.fsync = fsync
+        self.lock = threading.RLock()
+        self.stats = {'appended': 0, 'evicted': 0, 'rejected': 0, 'corrupted': 0}
+
+        self.segments: dict[int, int] = {} # segment id -> size, ordered
+        for f in sorted(self.path.glob(f'*{SEGMENT_SUFFIX}')):
+            self.segments[int(f.stem)] = f.stat().st_size
+        self.position = self._load_checkpoint()
+        for sid in [s for s in self.segments if s < self.position.segment]: self._delete_segment(sid)
+        self.active_id = max(self.segments, default=self.position.segment)
+        if self.active_id not in self.segments: self.segments[self.active_id] = 0
+        self._truncate_torn_tail()
+        self.active = open(self._segment_path(self.active_id), 'ab')
+        if self.position.segment not in self.segments: # segments removed behind our back
+            self.position = SpoolPosition(min((s for s in self.segments if s > self.position.segment), default=self.active_id), 0)
+
+    def _truncate_torn_tail(self) -> None:
+        '''Cut the active segment after its last valid record: a crash during an append leaves a partial header or
+        payload, the records appended after the restart would otherwise sit behind it and never be read'''
+        path, valid = self._segment_path(self.active_id), 0
+        if not path.exists(): return
+        with open(path, 'rb') as fh:
+            while len(header := fh.read(_HEADER.size)) == _HEADER.size:
+                length, crc = _HEADER.unpack(header)
+                record = fh.read(length)
+                if len(record) < length or zlib.crc32(record) != crc: break
+                valid += _HEADER.size + length
+        if valid == self.segments[self.active_id]: return
+        self.stats['corrupted'] += 1
+        os.truncate(path, valid)
+        self.segments[self.active_id] = valid
+        if self.position.segment == self.active_id and self.position.offset > valid: self.position = SpoolPosition(self.active_id, valid)
+
+    def _segment_path(self, sid: int) -> Path:
+        return self.path / f'{sid:012d}{SEGMENT_SUFFIX}'
+
+    def _load_checkpoint(self) -> SpoolPosition:
+        cp = self.path / CHECKPOINT_FILE
+        if cp.exists():
+            try: return SpoolPosition(**json.loads(cp.read_text()))
+            except (ValueError, TypeError): self.stats['corrupted'] += 1
+        return SpoolPosition(min(self.segments, default=0), 0)
+
+    def _delete_segment(self, sid: int) -> None:
+        self._segment_path(sid).unlink(missing_ok=True)
+        del self.segments[sid]
+
+    @property
+    def size_bytes(self) -> int:
+        with self.lock:
+            return sum(self.segments.values())
+
+    def is_empty(self) -> bool:
+        with self.lock:
+            return self.position.segment == self.active_id and self.position.offset >= self.segments[self.active_id]
+
+    def _roll(self) -> None:
+        self.active.close()
+        self.active_id += 1
+        self.segments[self.active_id] = 0
+        self.active = open(self._segment_path(self.active_id), 'ab')
+
+    def _make_room(self, n: int) -> bool:
+        while self.size_bytes + n > self.max_bytes:
+            if self.eviction == EVICT_NONE or len(self.segments) == 1: return False
+            oldest = next(iter(self.segments))
+            self.stats['evicted'] += self._count_records(oldest, self.position.offset if self.position.segment == oldest else 0)
+            self._delete_segment(oldest)
+            if self.position.segment <= oldest: self.position = SpoolPosition(next(iter(self.segments)), 0)
+        return True
+
+    def append(self, record: bytes) -> bool:
+        """Append one record
+
+        Returns
+        -------
+        bool
+            False if the record was refused (spool full with EVICT_NONE)
+        """
+        return self.append_many([record]) == 1
+
+    def append_many(self, records: list[bytes]) -> int:
+        """Append records with one write
+
+        Returns
+        -------
+        int
+            Number of records appended (the first ones), the others were refused
+        """
+        with self.lock:
+            buf, n = bytearray(), 0
+            for record in records:
+                size = _HEADER.size + len(record)
+                if self.segments[self.active_id] + len(buf) + size > self.segment_bytes and (buf or self.segments[self.active_id]):
+                    self._write(buf)
+                    buf = bytearray()
+                    self._roll()
+                if not self._make_room(len(buf) + size):
+                    self.stats['rejected'] += len(records) - n
+                    break
+                buf += _HEADER.pack(len(record), zlib.crc32(record)); buf += record
+                n += 1
+            self._write(buf)
+            self.stats['appended'] += n
+            return n
+
+    def _write(self, buf: bytearray) -> None:
+        if not buf: return
+        self.active.write(buf)
+        self.active.flush()
+        if self.fsync: os.fsync(self.active.fileno())
+        self.segments[self.active_id] += len(buf)
+
+    def _count_records(self, sid: int, offset: int = 0) -> int:
+        n, pos = 0, SpoolPosition(sid, offset)
+        while True:
+            records, pos = self._read_segment(pos, 2**16)
+            if not records: return n
+            n += len(records)
+
+    def _read_segment(self, pos: SpoolPosition, max_records: int) -> tuple[list[bytes], SpoolPosition]:
+        records = []
+        with open(self._segment_path(pos.segment), 'rb') as fh:
+            fh.seek(pos.offset)
+            offset = pos.offset
+            while len(records) < max_records:
+                header = fh.read(_HEADER.size)
+                if len(header) < _HEADER.size: break
+                length, crc = _HEADER.unpack(header)
+                record = fh.read(length)
+                if len(record) < length: break # partial write, the active segment may still grow
+                if zlib.crc32(record) != crc:
+                    self.stats['corrupted'] += 1
+                    offset = self.segments[pos.segment] # the rest of the segment cannot be trusted
+                    break
+                records.append(record)
+                offset += _HEADER.size + length
+        return records, SpoolPosition(pos.segment, offset)
+
+    def read(self, max_records: int) -> tuple[list[bytes], SpoolPosition]:
+        """Read the next records after the committed position, without consuming them
+
+        Parameters
+        ----------
+        max_records : int
+            Max number of records returned
+
+        Returns
+        -------
+        tuple[list[bytes], SpoolPosition]
+            The records, in order, and the position to `commit` once they are handled
+        """
+        with self.lock:
+            records, pos = [], self.position
+            while len(records) < max_records:
+                chunk, pos = self._read_segment(pos, max_records - len(records))
+                records += chunk
+                if pos.offset < self.segments[pos.segment] and not chunk and pos.segment != self.active_id:
+                    pos = SpoolPosition(pos.segment, self.segments[pos.segment]) # truncated tail of a closed segment
+                if pos.offset < self.segments[pos.segment] or pos.segment == self.active_id: break
+                pos = SpoolPosition(next(s for s in self.segments if s > pos.segment), 0)
+            return records, pos
+
+    def commit(self, position: SpoolPosition) -> None:
+        """Persist the read position and delete the segments that are fully consumed"""
+        with self.lock:
+            if position.segment not in self.segments: return # evicted meanwhile
+            self.position = position
+            tmp = self.path / f'{CHECKPOINT_FILE}.tmp'
+            tmp.write_text(json.dumps({'segment': position.segment, 'offset': position.offset}))
+            os.replace(tmp, self.path / CHECKPOINT_FILE)
+            for sid in [s for s in self.segments if s < position.segment]: self._delete_segment(sid)
+
+    def close(self) -> None:
+        with self.lock:
+            self.active.close()
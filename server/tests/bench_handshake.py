@@ -0,0 +1,82 @@
+'''Handshake benchmark: a reconnect storm of every node at once, verified on the event loop, in the process pool,
+then resumed with session tickets
+
+Run from the server directory:
+
+    python -m tests.bench_handshake --nodes 200 --workers 4
+
+Reports the handshakes verified per second and the longest stall of the event loop
+(the delay of a coroutine ticking every millisecond next to the handshakes).
+'''
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+from ecdsa import SigningKey, NIST521p
+
+from dvic_log_server.handshake import HandshakeVerifier, HandshakeConfig
+from dvic_log_server.utils.crypto import CryptClient, CryptPhonebook
+
+class Phonebook(CryptPhonebook):
+    def __init__(self, keys: Path) -> None:
+        self.keys = keys
+        self.salts: dict[str, str] = {}
+    def is_secure_auth_enabled(self) -> bool: return True
+    def get_public_key(self, uid: str) -> str: return (self.keys / uid).read_text()
+    def get_client_salt(self, uid: str) -> str: return self.salts[uid]
+    def set_client_salt(self, uid: str, salt: str) -> None: self.salts[uid] = salt
+
+async def storm(verify, tokens: list[str]) -> tuple[float, float, int]:
+    '''Verify every token concurrently, returns the elapsed seconds, the longest loop stall and the accepted count'''
+    stall, done = 0.0, False
+    async def ticker():
+        nonlocal stall
+        while not done:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            stall = max(stall, time.perf_counter() - start - 0.001)
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    results = await asyncio.gather(*(verify(t) for t in tokens))
+    elapsed = time.perf_counter() - start
+    done = True
+    await tick
+    return elapsed, stall, sum(ok for _, ok in results)
+
+async def main(args) -> None:
+    with tempfile.TemporaryDirectory() as keys:
+        keys, tokens = Path(keys), []
+        book = Phonebook(keys)
+        for _ in range(args.nodes):
+            uid, salt, sk = str(uuid.uuid4()), CryptClient.get_salt(), SigningKey.generate(NIST521p)
+            (keys / uid).write_bytes(sk.get_verifying_key().to_pem())
+            book.set_client_salt(uid, salt)
+            tokens.append(CryptClient(private_key=sk.to_pem().decode()).craft_initial_token(uid, salt))
+
+        server = CryptClient(private_key=SigningKey.generate(NIST521p).to_pem().decode()) # as the endpoint did for every connection
+        async def inline(token): return server.verify_initial_packet(token, book)
+        elapsed, stall, ok = await storm(inline, tokens)
+        print(f'event loop  : {ok}/{len(tokens)} in {elapsed:.2f}s, {len(tokens) / elapsed:7.1f} handshakes/s, max stall {stall * 1000:8.1f} ms')
+
+        verifier = HandshakeVerifier.__wrapped__(HandshakeConfig(workers=args.workers), keys)
+        try:
+            for label in ('pool, cold', 'pool, warm'): # warm: keys already parsed by the workers
+                elapsed, stall, ok = await storm(lambda t: verifier.verify(t, book), tokens)
+                print(f'{label:12}: {ok}/{len(tokens)} in {elapsed:.2f}s, {len(tokens) / elapsed:7.1f} handshakes/s, max stall {stall * 1000:8.1f} ms')
+            tickets = [verifier.ticket_for(uid, book).ticket for uid in book.salts]
+            elapsed, stall, ok = await storm(lambda t: verifier.verify(t, book), tickets)
+            print(f'{"tickets":12}: {ok}/{len(tokens)} in {elapsed:.2f}s, {len(tokens) / elapsed:7.1f} handshakes/s, max stall {stall * 1000:8.1f} ms')
+        finally:
+            verifier.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    asyncio.run(main(parser.parse_args()))
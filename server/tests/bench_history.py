@@ -0,0 +1,42 @@
+'''Metric history benchmark: chart queries over a week of 10 second samples for 500 nodes
+
+Run from the server directory:
+
+    python -m tests.bench_history --nodes 500 --points 1000
+'''
+
+import argparse
+import time
+
+import numpy as np
+
+from dvic_log_server.history import MetricHistory, HistoryConfig, RingSeries, DOWNSAMPLERS
+
+WEEK = 7 * 24 * 3600
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=500)
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--interval', type=float, default=10, help='Seconds between two samples')
+    args = parser.parse_args()
+
+    capacity = int(WEEK / args.interval)
+    history = MetricHistory.__wrapped__(HistoryConfig(capacity=capacity, max_bytes=2**40))
+    now = time.time()
+    ts = now - WEEK + np.arange(capacity) * args.interval
+    start = time.perf_counter()
+    for n in range(args.nodes):
+        series = history.series[(f'node-{n}', 'cpu_usage')] = RingSeries(capacity)
+        series.extend(ts, (50 + 50 * np.sin(ts / 3600 + n)).astype(np.float32))
+    print(f'filled {args.nodes} series of {capacity} samples in {time.perf_counter() - start:.1f}s '
+          f'({args.nodes * capacity * (8 + 4) / 2**20:.0f} MiB)')
+
+    for method in DOWNSAMPLERS:
+        for label, begin in (('week', None), ('day', now - 86400)):
+            durations = []
+            for n in range(0, args.nodes, max(1, args.nodes // 50)):
+                start = time.perf_counter()
+                history.query(f'node-{n}', 'cpu_usage', begin, None, args.points, method)
+                durations.append(time.perf_counter() - start)
+            print(f'{method:7} {label:5} -> {args.points} points: median {np.median(durations) * 1000:6.2f} ms, max {max(durations) * 1000:6.2f} ms')
@@ -0,0 +1,161 @@
+'''Ingest benchmark against a local stand-in for the Elasticsearch HTTP API
+
+and against the embedded SQLite backend. Run from the server directory:
+
+    python -m tests.bench_ingest --docs 5000 --latency 1
+'''
+
+import argparse
+import json
+import tempfile
+from fnmatch import fnmatch
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from dvic_log_server.database_drivers import DatabaseConfig, ElasticConnector, SQLiteConnector, SQLITE_POOL, BACKEND_SQLITE
+from dvic_log_server.ingest import IngestPipeline, IngestConfig
+
+
+class StandInElasticServer:
+    '''Minimal HTTP server answering the Elasticsearch calls made by the drivers (ping, index, bulk, index listing and deletion,
+    searches are recorded and only find the documents written with an explicit id by an ids query)
+    Every request waits `latency` seconds to stand for the network and the cluster'''
+    def __init__(self, latency: float = 0.001) -> None:
+        self.latency = latency
+        self.documents = 0
+        self.requests = 0
+        self.indices: set[str] = set() # indices written to, removed on deletion
+        self.ids: set[tuple[str, str]] = set() # (index, _id) of the documents written with an explicit id
+        self.refused: set[str] = set() # `log` of the documents answered 429
+        self.searches: list[dict] = [] # bodies of the search requests
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args): pass
+
+            def _answer(self, status: int, body: dict = None):
+                payload = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('X-Elastic-Product', 'Elasticsearch')
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                if self.command != 'HEAD': self.wfile.write(payload)
+
+            def _handle(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                time.sleep(server.latency)
+                with server.lock: server.requests += 1
+                path = self.path.split('?')[0]
+                if path.endswith('/_bulk'):
+                    lines = [l for l in body.split(b'\n') if l.strip()]
+                    items = []
+                    with server.lock:
+                        for line, source in zip(lines[::2], lines[1::2]):
+                            (action, meta), = json.loads(line).items()
+                            server.indices.add(meta['_index'])
+                            if json.loads(source).get('log') in server.refused:
+                                items.append({action: {'status': 429}})
+                                continue
+                            if action == 'create' and (meta['_index'], meta['_id']) in server.ids:
+                                items.append({action: {'status': 409}})
+                                continue
+                            if '_id' in meta: server.ids.add((meta['_index'], meta['_id']))
+                            server.documents += 1
+                            items.append({action: {'status': 201}})
+                    return self._answer(200, {'took': 1, 'errors': any(i[a]['status'] != 201 for i in items for a in i), 'items': items})
+                if path.endswith('/_search'):
+                    search = json.loads(body or b'{}')
+                    alias, values = path[1:].split('/')[0], search.get('query', {}).get('ids', {}).get('values', [])
+                    with server.lock:
+                        server.searches.append(search)
+                        hits = [{'_index': i, '_id': id} for i, id in server.ids if id in values and (i == alias or i.startswith(f'{alias}-'))]
+                    return self._answer(200, {'took': 1, 'timed_out': False, 'hits': {'hits': hits}})
+                if '/_doc' in path:
+                    with server.lock:
+                        server.documents += 1
+                        server.indices.add(path.split('/')[1])
+                    return self._answer(201, {'_id': str(server.documents), 'result': 'created'})
+                if path == '/':
+                    return self._answer(200, {'version': {'number': '8.7.0'}, 'tagline': 'You Know, for Search'})
+                if not path.startswith('/_') and self.command in ('GET', 'DELETE'):
+                    patterns = path[1:].split(',')
+                    with server.lock:
+                        matched = {i for i in server.indices if any(fnmatch(i, p) for p in patterns)}
+                        if self.command == 'DELETE': server.indices -= matched
+                    return self._answer(200, {'acknowledged': True} if self.command == 'DELETE' else {i: {} for i in matched})
+                return self._answer(200, {'acknowledged': True})
+
+            do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = _handle
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def document(i: int) -> dict:
+    return {'node': '1d1f0545-2b60-488e-9419-d54b23bda47d', 'type': 'log_entry', 'kind': 'journal',
+            'name': 'systemd-logind', 'log': f'New session {i} of user dvic.', 'timestamp': time.time()}
+
+
+def bench_per_document(port: int, n: int) -> float:
+    '''Former handler path: one connector and one index request per document'''
+    start = time.perf_counter()
+    for i in range(n):
+        elk = ElasticConnector('127.0.0.1', port, index='machine_logs')
+        elk.insert(document(i))
+        elk.close()
+    return n / (time.perf_counter() - start)
+
+
+def bench_sqlite_per_document(path: str, n: int) -> float:
+    '''Same path as bench_per_document on the SQLite backend'''
+    start = time.perf_counter()
+    for i in range(n):
+        db = SQLiteConnector(path, index='machine_logs')
+        db.insert(document(i))
+        db.close()
+    return n / (time.perf_counter() - start)
+
+
+def bench_pipeline(database: DatabaseConfig, n: int) -> float:
+    pipeline = IngestPipeline.__wrapped__(IngestConfig(flush_interval=0.05, spool_path=None), database)
+    start = time.perf_counter()
+    for i in range(n): pipeline.submit('machine_logs', document(i))
+    pipeline.flush()
+    rate = n / (time.perf_counter() - start)
+    pipeline.stop()
+    return rate
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--docs', type=int, default=5000)
+    parser.add_argument('--latency', type=float, default=1, help='Stand-in server latency per request (ms)')
+    args = parser.parse_args()
+
+    server = StandInElasticServer(args.latency / 1000)
+    before = bench_per_document(server.port, min(args.docs, 200)) # slow path, a sample is enough
+    after = bench_pipeline(DatabaseConfig(host='127.0.0.1', port=server.port), args.docs)
+    print(f'elasticsearch per document insert: {before:10.0f} docs/s')
+    print(f'elasticsearch bulk pipeline:       {after:10.0f} docs/s ({after / before:.0f}x)')
+    server.close()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = str(Path(tmp, 'bench.db'))
+        before = bench_sqlite_per_document(path, args.docs)
+        after = bench_pipeline(DatabaseConfig(backend=BACKEND_SQLITE, path=path), args.docs)
+        SQLITE_POOL.close_all()
+    print(f'sqlite per document insert:        {before:10.0f} docs/s')
+    print(f'sqlite bulk pipeline:              {after:10.0f} docs/s ({after / before:.0f}x)')
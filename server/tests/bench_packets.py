@@ -0,0 +1,30 @@
+'''Packet codec benchmark: size and encode + decode throughput of the JSON and binary codecs on log lines
+
+Run from the server directory:
+
+    python -m tests.bench_packets --packets 20000
+'''
+
+import argparse
+import time
+
+from dvic_log_server.network.packets import PacketLogEntry, decode
+
+LINE = 'May 17 10:31:02 demo-node NetworkManager[812]: <info> [1684312262.1211] device (wlp2s0): state change: activated -> deactivating\n'
+
+def bench(encode, n: int) -> tuple[float, int]:
+    '''Returns the packets/s of n encode + decode round trips and the size of a frame'''
+    start = time.perf_counter()
+    for _ in range(n): decode(encode())
+    return n / (time.perf_counter() - start), len(encode())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--packets', type=int, default=20000)
+    args = parser.parse_args()
+
+    pck = PacketLogEntry('journal', 'nm-dispatcher', LINE)
+    json_rate, json_size = bench(pck.encode, args.packets)
+    bin_rate, bin_size = bench(pck.encode_binary, args.packets)
+    print(f'json:   {json_size:4d} bytes/packet {json_rate:10.0f} packets/s')
+    print(f'binary: {bin_size:4d} bytes/packet {bin_rate:10.0f} packets/s ({bin_rate / json_rate:.1f}x)')
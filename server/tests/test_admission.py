@@ -0,0 +1,55 @@
+'''Module for testing the admission control'''
+
+import time
+
+import pytest
+
+import dvic_log_server.admission as admission
+from dvic_log_server.admission import AdmissionController, AdmissionConfig, TokenBucket
+from dvic_log_server.network.packets import *
+from tests.test_presence import Node
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=20, now=0.0)
+    assert bucket.take(20, 0.0) == 0.0
+    assert bucket.take(5, 0.0) == pytest.approx(0.5)  # in debt, paid back in half a second
+    assert bucket.take(0, 0.5) == 0.0
+    assert bucket.take(1, 100.0) == 0.0 and bucket.tokens == 19 # refilled up to the burst
+
+
+def test_handshakes_bounded():
+    controller = AdmissionController.__wrapped__(AdmissionConfig(max_handshakes=2, retry_after=4))
+    assert controller.enter_handshake() == 0 and controller.busy() == 0
+    assert controller.enter_handshake() == 0
+    delays = [controller.enter_handshake() for _ in range(50)] + [controller.busy()]
+    assert all(4 <= d <= 8 for d in delays) and len(set(delays)) > 1 # jittered
+    controller.exit_handshake()
+    assert controller.enter_handshake() == 0
+    assert controller.info()['handshakes'] == 2
+    assert controller.stats == {'handshakes_refused': 50, 'preauths_refused': 1, 'frames_delayed': 0}
+
+
+def test_inbound_rates(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission, 'monotonic', lambda: now[0])
+    controller = AdmissionController.__wrapped__(AdmissionConfig(retry_after=5, packets_per_second=10, packet_burst=10, bytes_per_second=1000, byte_burst=1000))
+    chatty, quiet = Node('chatty'), Node('quiet')
+    batch = PacketBatch([PacketLogEntry('journal', 'sshd', f'line {i}') for i in range(10)])
+    assert controller.inbound(chatty, batch, 100) == 0
+    assert controller.inbound(chatty, batch, 100) == pytest.approx(1.0)     # 10 packets over
+    assert controller.inbound(chatty, PacketHeartbeat(0.0), 2900) == pytest.approx(2.1) # bytes over
+    assert controller.inbound(quiet, PacketHeartbeat(0.0), 100) == 0
+    notices = [p for p in chatty.packets if isinstance(p, PacketRetryAfter)]
+    assert len(notices) == 1 and notices[0].reason == RetryReason.RATE # once per retry_after
+    now[0] += 10
+    assert controller.inbound(chatty, PacketHeartbeat(0.0), 100) == 0
+    info = controller.info()
+    assert list(info['throttled']) == ['chatty'] and info['throttled']['chatty']['frames_delayed'] == 2
+    assert info['frames_delayed'] == 2
+
+
+def test_no_limits():
+    controller = AdmissionController.__wrapped__(AdmissionConfig(packets_per_second=0, bytes_per_second=0))
+    node = Node('n1')
+    assert all(controller.inbound(node, PacketHeartbeat(0.0), 10**9) == 0 for _ in range(100))
@@ -0,0 +1,98 @@
+'''Module for testing the event-driven writer of the server connections'''
+
+import asyncio
+import threading
+
+import dvic_log_server.api # before the connection, the two modules import each other
+from dvic_log_server.connection import Connection
+from dvic_log_server.network.packets import *
+from dvic_log_server.network.packets import decode
+from dvic_log_server.network.replay import ReplayConfig, ResumableSession
+from starlette.websockets import WebSocketState
+
+
+class WebSocket:
+    '''Websocket stand-in recording the sent frames'''
+    def __init__(self) -> None:
+        self.application_state = WebSocketState.CONNECTED
+        self.frames: list[Packet] = []
+
+    async def send_bytes(self, data: bytes) -> None: self.frames.append(decode(data))
+    async def send_text(self, data: str) -> None: self.frames.append(decode(data))
+    async def close(self) -> None: self.application_state = WebSocketState.DISCONNECTED
+
+
+def log(i: int) -> PacketLogEntry:
+    return PacketLogEntry('journal', 'sshd', f'line {i}')
+
+
+async def until(condition, timeout: float = 1.0) -> bool:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        if asyncio.get_running_loop().time() > deadline: return False
+        await asyncio.sleep(0.001)
+    return True
+
+
+def test_writer_wakes_up_on_enqueue():
+    async def scenario():
+        conn = Connection(WebSocket(), 'n1', binary=True)
+        writer = asyncio.create_task(conn.writer())
+        await asyncio.sleep(0.05)
+        assert conn.ws.frames == [] and not writer.done() # sleeping, not polling
+        conn.send_packet(log(0))
+        assert await until(lambda: len(conn.ws.frames) == 1)
+        writer.cancel()
+    asyncio.run(scenario())
+
+
+def test_writer_drains_everything_by_priority():
+    async def scenario():
+        conn = Connection(WebSocket(), 'n1')
+        for i in range(150): conn.send_packet(log(i)) # more than one drain chunk
+        conn.send_packet(PacketInteractiveSession('s', value=b'ls\n'))
+        writer = asyncio.create_task(conn.writer())
+        assert await until(lambda: len(conn.ws.frames) == 151)
+        assert isinstance(conn.ws.frames[0], PacketInteractiveSession)
+        assert [p.log for p in conn.ws.frames[1:]] == [f'line {i}' for i in range(150)]
+        writer.cancel()
+    asyncio.run(scenario())
+
+
+def test_send_packet_from_another_thread():
+    async def scenario():
+        conn = Connection(WebSocket(), 'n1', binary=True)
+        writer = asyncio.create_task(conn.writer())
+        await asyncio.sleep(0.01)
+        thread = threading.Thread(target=lambda: [conn.send_packet(log(i)) for i in range(10)])
+        thread.start()
+        assert await until(lambda: len(conn.ws.frames) == 10) # woken with call_soon_threadsafe
+        thread.join()
+        writer.cancel()
+    asyncio.run(scenario())
+
+
+def test_writer_stops_when_closed():
+    async def scenario():
+        conn = Connection(WebSocket(), 'n1')
+        writer = asyncio.create_task(conn.writer())
+        await asyncio.sleep(0.01)
+        conn.close()
+        await asyncio.wait_for(writer, 1)
+        conn.send_packet(log(0)) # kept in the queue for the next connection
+        assert conn.ws.frames == [] and len(conn.send_queue.drain()) == 1
+    asyncio.run(scenario())
+
+
+def test_end_of_burst_acknowledged():
+    async def scenario():
+        conn = Connection(WebSocket(), 'n1', binary=True, resumable=True)
+        conn.session = ResumableSession(ReplayConfig(ack_delay=0.05))
+        writer = asyncio.create_task(conn.writer())
+        conn.receive_packet(PacketResume('node-session', 0, 1))
+        assert await until(lambda: conn.ws.frames) # the writer answered
+        for i in range(5): conn.receive_packet(PacketHeartbeat(float(i))) # fewer than ack_every, then nothing
+        assert await until(lambda: any(isinstance(p, PacketAck) and p.received == 5 for p in conn.ws.frames))
+        assert isinstance(conn.ws.frames[0], PacketResume) and conn.session.unacked == 0
+        writer.cancel()
+    asyncio.run(scenario())
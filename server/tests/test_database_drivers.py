@@ -0,0 +1,122 @@
+'''Module for testing the database drivers, against a stand-in Elasticsearch server and an SQLite file'''
+
+import pytest
+
+from dvic_log_server.database_drivers import *
+from tests.bench_ingest import StandInElasticServer
+
+
+@pytest.fixture
+def server():
+    server = StandInElasticServer(latency=0)
+    yield server
+    ELASTIC_POOL.close_all()
+    server.close()
+
+
+def test_connectors_share_pooled_client(server: StandInElasticServer):
+    connectors = [ElasticConnector('127.0.0.1', server.port, 'machine_logs') for _ in range(10)]
+    assert len({id(c.es) for c in connectors}) == 1
+    assert server.requests == 2 # one ping, one index existence check
+    for c in connectors: c.close()
+
+    c = ElasticConnector('127.0.0.1', server.port, 'machine_logs')
+    c.insert({'log': 'line'})
+    c.close()
+    assert server.requests == 3
+
+
+def test_bulk_statuses(server: StandInElasticServer):
+    c = ElasticConnector('127.0.0.1', server.port, None)
+    assert c.bulk([('machine_logs', {'log': 'a'}), ('machine_hardware_state', {'kind': 'cpu_usage'})]) == [201, 201]
+    assert server.documents == 2
+    c.close()
+
+
+def test_bulk_duplicates(server: StandInElasticServer):
+    c = ElasticConnector('127.0.0.1', server.port, None)
+    keyed = ('machine_logs', {'log': 'a', 'doc_id': 'k1', IDEMPOTENCY_KEY: 'cursor-1', 'timestamp': 1.0})
+    assert c.bulk([keyed, ('machine_logs', {'log': 'b', 'timestamp': 1.0})]) == [201, 201]
+    assert c.bulk([keyed, ('machine_logs', {'log': 'b', 'timestamp': 1.0})]) == [409, 201] # unkeyed documents are always written
+    assert server.documents == 3
+    again = [keyed, keyed, ('machine_logs', {'log': 'c', 'doc_id': 'k2', IDEMPOTENCY_KEY: 'cursor-2', 'timestamp': 1.0})] # twice in the same batch
+    assert c.bulk(again) == [409, 409, 201]
+    assert server.documents == 4 and server.searches == [] # caught by create, no lookup
+    c.close()
+
+
+def test_unreachable_database():
+    with pytest.raises(ConnectionError):
+        ElasticConnector('127.0.0.1', 1, 'machine_logs')
+    assert '127.0.0.1:1' not in ELASTIC_POOL.clients
+
+
+@pytest.fixture
+def sqlite(tmp_path):
+    db = SQLiteConnector(str(tmp_path / 'logs.db'), 'machine_logs')
+    yield db
+    db.close()
+    SQLITE_POOL.close_all()
+
+
+def test_sqlite_insert_get(sqlite: SQLiteConnector):
+    id = sqlite.insert({'node': 'n1', 'kind': 'journal', 'log': 'line', 'timestamp': 1.0})
+    assert sqlite.get_by_id(id)['_source']['log'] == 'line'
+    sqlite.delete_by_id(id)
+    assert not sqlite.get_by_id(id)['found']
+    assert sqlite.db.conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_sqlite_bulk_search(sqlite: SQLiteConnector):
+    docs = [('machine_logs', {'node': f'n{i % 2}', 'kind': 'journal', 'log': f'line {i}', 'timestamp': float(i)}) for i in range(10)]
+    docs.append(('machine_hardware_state', {'node': 'n0', 'kind': 'cpu_usage', 'data': '12.5', 'timestamp': 0.0}))
+    assert sqlite.bulk(docs) == [201] * 11
+    assert sqlite.get_all()['hits']['total']['value'] == 10
+
+    res = sqlite.search({'bool': {
+        'filter': [{'term': {'node': 'n0'}}, {'range': {'timestamp': {'gte': 2, 'lt': 8}}}],
+        'must_not': {'match': {'log': 'line 4'}},
+    }})
+    assert [h['_source']['log'] for h in res['hits']['hits']] == ['line 2', 'line 6']
+    assert sqlite.search({'terms': {'node.keyword': ['n1']}}, size=2)['hits']['total']['value'] == 5
+    assert sqlite.search({'match': {'log': '%'}})['hits']['total']['value'] == 0
+
+    hardware = SQLiteConnector(sqlite.host, 'machine_hardware_state')
+    assert hardware.search({'term': {'data': '12.5'}})['hits']['total']['value'] == 1
+    hardware.delete_index()
+    hardware.close()
+
+    sqlite.delete_all()
+    assert sqlite.get_all()['hits']['hits'] == []
+
+
+def test_sqlite_duplicates(sqlite: SQLiteConnector):
+    docs = [('machine_logs', {'node': 'n1', 'log': f'line {i}', 'doc_id': f'k{i}', IDEMPOTENCY_KEY: f'1:{i}', 'timestamp': float(i)}) for i in range(3)]
+    assert sqlite.bulk(docs[:2] + [('machine_logs', {'node': 'n1', 'log': 'live', 'doc_id': 'x', 'timestamp': 9.0})]) == [201, 201, 201]
+    assert sqlite.bulk(docs) == [409, 409, 201]
+    assert sqlite.get_all()['hits']['total']['value'] == 4
+    assert sqlite.insert(docs[0][1]) == sqlite.search({'term': {'log': 'line 0'}})['hits']['hits'][0]['_id']
+
+
+def test_sqlite_migrates_older_tables(tmp_path):
+    import sqlite3
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE "machine_logs" (id INTEGER PRIMARY KEY, node TEXT, type TEXT, kind TEXT, name TEXT, timestamp REAL, doc TEXT NOT NULL)')
+    conn.execute('INSERT INTO "machine_logs" (node, doc) VALUES (?, ?)', ('n1', '{"log": "old"}'))
+    conn.commit(); conn.close()
+    db = SQLiteConnector(path, 'machine_logs')
+    doc = {'node': 'n1', 'log': 'new', 'doc_id': 'k', IDEMPOTENCY_KEY: '1:1'}
+    assert db.bulk([('machine_logs', doc), ('machine_logs', doc)]) == [201, 409]
+    assert db.get_all()['hits']['total']['value'] == 2
+    db.close()
+    SQLITE_POOL.close_all()
+
+
+def test_open_connector(tmp_path):
+    db = open_connector(DatabaseConfig(backend=BACKEND_SQLITE, path=str(tmp_path / 'logs.db')), 'machine_logs')
+    assert isinstance(db, SQLiteConnector) and db.test_connection()
+    db.close()
+    SQLITE_POOL.close_all()
+    with pytest.raises(ValueError):
+        open_connector(DatabaseConfig(backend='influx'))
@@ -0,0 +1,89 @@
+'''Module for testing the verification of the connection tokens'''
+
+import asyncio
+import os
+import uuid
+
+import pytest
+from ecdsa import SigningKey, NIST256p
+
+from dvic_log_server.handshake import HandshakeVerifier, HandshakeConfig, PublicKeyCache, TicketStore
+from dvic_log_server.network.packets import PacketSessionTicket
+from dvic_log_server.utils.crypto import CryptClient
+from tests.bench_handshake import Phonebook
+
+
+def new_node(keys, book: Phonebook) -> tuple[str, CryptClient]:
+    uid, sk = str(uuid.uuid4()), SigningKey.generate(NIST256p)
+    (keys / uid).write_bytes(sk.get_verifying_key().to_pem())
+    book.set_client_salt(uid, CryptClient.get_salt())
+    return uid, CryptClient(private_key=sk.to_pem().decode())
+
+
+def test_key_cache_reads_changed_files(tmp_path):
+    cache = PublicKeyCache(tmp_path)
+    (tmp_path / 'n1').write_text('first')
+    version, pem = cache.get('n1')
+    (tmp_path / 'n1').write_text('ignored')
+    os.utime(tmp_path / 'n1', ns=(version, version)) # same mtime, not read again
+    assert cache.get('n1') == (version, 'first')
+    os.utime(tmp_path / 'n1', ns=(version + 10**9, version + 10**9))
+    assert cache.get('n1') == (version + 10**9, 'ignored')
+    (tmp_path / 'n1').unlink()
+    assert cache.get('n1') is None and cache.get('../n1') is None and cache.get('') is None
+
+
+@pytest.mark.parametrize('workers', [0, 1], ids=['inline', 'pool'])
+def test_verify(tmp_path, workers: int):
+    book = Phonebook(tmp_path)
+    uid, node = new_node(tmp_path, book)
+    other, intruder = new_node(tmp_path, book)
+    verifier = HandshakeVerifier.__wrapped__(HandshakeConfig(workers=workers), tmp_path)
+    async def scenario():
+        return [
+            await verifier.verify(node.craft_initial_token(uid, book.salts[uid]), book),
+            await verifier.verify(node.craft_initial_token(uid, 'x' * 16), book),             # old salt
+            await verifier.verify(intruder.craft_initial_token(uid, book.salts[uid]), book),  # wrong key
+            await verifier.verify(node.craft_initial_token(uid, book.salts[uid])[:-8], book), # truncated signature
+            await verifier.verify(intruder.craft_initial_token(str(uuid.uuid4()), 'x' * 16), book), # unknown node
+        ]
+    try:
+        results = asyncio.run(scenario())
+        assert results[0] == (uid, True) and [ok for _, ok in results[1:]] == [False] * 4
+        assert verifier.stats == {'accepted': 1, 'rejected': 4, 'resumed': 0}
+        os.replace(tmp_path / other, tmp_path / uid) # key of the node replaced
+        os.utime(tmp_path / uid, ns=(1, 1))
+        assert asyncio.run(verifier.verify(intruder.craft_initial_token(uid, book.salts[uid]), book)) == (uid, True)
+    finally:
+        verifier.close()
+
+
+def test_tickets_single_use_and_lifetime():
+    store = TicketStore(lifetime=60)
+    ticket = store.issue('n1')
+    assert store.redeem(ticket) == ('n1', True)
+    assert store.redeem(ticket) == ('n1', False) # used
+    old, ticket = store.issue('n1'), store.issue('n1')
+    assert store.redeem(old) == ('n1', False)    # revoked by the newer one
+    store.closed('n1', old, now=1000.0)          # a stale connection closing does not start the lifetime
+    assert store.tickets['n1'][1] is None
+    store.closed('n1', ticket, now=1000.0)
+    assert store.redeem(ticket, now=1061.0) == ('n1', False) # expired
+    ticket = store.issue('n1')
+    uid, nonce, mac = ticket[1:].split('.')
+    for forged in (f'~n2.{nonce}.{mac}', f'~n1.{nonce}.{mac[:-1]}{"1" if mac[-1] == "0" else "0"}', f'~n1.{nonce}.é', '~n1', f'~n1.{nonce}.{TicketStore(60).issue("n1").rsplit(".", 1)[1]}'):
+        assert not store.redeem(forged)[1]
+    assert store.redeem(ticket, now=1e12) == ('n1', True) # connection still open
+
+
+def test_verify_ticket(tmp_path):
+    book = Phonebook(tmp_path)
+    verifier = HandshakeVerifier.__wrapped__(HandshakeConfig(workers=0), tmp_path)
+    ticket = verifier.ticket_for('n1', book)
+    assert isinstance(ticket, PacketSessionTicket) and ticket.lifetime == 300.0
+    assert asyncio.run(verifier.verify(ticket.ticket, book)) == ('n1', True)
+    assert asyncio.run(verifier.verify(ticket.ticket, book)) == ('n1', False)
+    assert verifier.stats == {'accepted': 0, 'rejected': 1, 'resumed': 1}
+    verifier = HandshakeVerifier.__wrapped__(HandshakeConfig(workers=0, ticket_lifetime=0), tmp_path)
+    assert verifier.ticket_for('n1', book) is None
+    assert asyncio.run(verifier.verify(ticket.ticket, book)) == ('n1', False)
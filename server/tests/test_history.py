@@ -0,0 +1,66 @@
+'''Module for testing the in-memory metric history and its downsampling'''
+
+import numpy as np
+import pytest
+
+from dvic_log_server.history import *
+
+
+def test_ring_wraps_in_time_order():
+    series = RingSeries(5)
+    for i in range(8): series.append(float(i), i * 10)
+    ts, vs = series.range()
+    assert ts.tolist() == [3, 4, 5, 6, 7] and vs.tolist() == [30, 40, 50, 60, 70]
+    assert series.range(4.5, 6)[0].tolist() == [5, 6]
+    assert len(series.range(100)[0]) == 0
+
+    series.extend(np.arange(8, 11, dtype=np.float64), np.arange(3, dtype=np.float32))
+    assert series.range()[0].tolist() == [6, 7, 8, 9, 10]
+
+
+def test_downsampling():
+    ts = np.arange(10_000, dtype=np.float64)
+    vs = np.sin(ts / 300).astype(np.float32)
+    vs[1234] = 5 # spike
+
+    for method, f in DOWNSAMPLERS.items():
+        t, v = f(ts, vs, 100)
+        assert len(t) <= 100 and np.all(np.diff(t) > 0), method
+        assert 5 in v, method
+    t, v = downsample_lttb(ts, vs, 100)
+    assert len(t) == 100 and t[0] == 0 and t[-1] == 9_999
+    assert downsample_minmax(ts[:50], vs[:50], 100)[0].tolist() == ts[:50].tolist()
+
+
+def test_history_series_and_eviction():
+    history = MetricHistory.__wrapped__(HistoryConfig(capacity=10, max_series=3, stale_after=60))
+    history.add('n1', 'cpu_usage', 12.5, 1.0)
+    history.add('n1', 'memory_usage', {'total': 100, 'used': 41.5}, 1.0)
+    history.add('n1', 'ip', '10.0.0.2', 1.0) # not numeric
+    assert history.metrics('n1') == ['cpu_usage', 'memory_usage.total', 'memory_usage.used']
+
+    history.add('n1', 'memory_usage', {'total': 100, 'used': 42.0}, 70.0)
+    history.add('n2', 'cpu_usage', 3.0, 70.0) # replaces the idle series
+    assert history.evicted == 1 and history.metrics('n1') == ['memory_usage.total', 'memory_usage.used']
+    ts, vs = history.query('n2', 'cpu_usage')
+    assert ts.tolist() == [70.0] and vs.tolist() == [3.0]
+    with pytest.raises(KeyError):
+        history.query('n1', 'cpu_usage')
+
+
+def test_history_kept_beyond_max_series():
+    history = MetricHistory.__wrapped__(HistoryConfig(capacity=100, max_series=10, stale_after=600))
+    for t in range(0, 500, 10): # 20 nodes of 5 series for 10 series of room, all sending
+        for node in range(20):
+            history.add(f'n{node}', 'memory_usage', {'total': 100, 'free': 50, 'available': 60, 'used': 40.0}, float(t))
+            history.add(f'n{node}', 'cpu_usage', float(t), float(t))
+    assert len(history.series) == 10 and history.evicted == 0 and history.refused > 0
+    ts, _ = history.query('n0', 'cpu_usage')
+    assert len(ts) == 50 # the first series kept all their samples
+    assert history.metrics('n19') == []
+
+
+def test_capacity_fits_memory_bound():
+    config = HistoryConfig()
+    assert MetricHistory.__wrapped__(config).capacity == config.capacity # the defaults keep a week for 500 nodes
+    assert MetricHistory.__wrapped__(HistoryConfig(capacity=1000, max_series=10, max_bytes=100 * SAMPLE_BYTES)).capacity == 10
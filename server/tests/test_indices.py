@@ -0,0 +1,67 @@
+'''Module for testing the time-partitioned indices and the typed hardware state fields'''
+
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+from dvic_log_server.database_drivers import *
+from dvic_log_server.indices import *
+from dvic_log_server.metrics import flatten_metrics
+from tests.bench_ingest import StandInElasticServer
+
+T = datetime(2023, 5, 17, 13, 45, tzinfo=timezone.utc).timestamp()
+
+
+def test_partition_names():
+    assert LOGS.partition(T) == 'machine_logs-2023.05.17'
+    assert LOGS.partition(T, 'hour') == 'machine_logs-2023.05.17.13'
+    assert LOGS.partition(T, 'month') == 'machine_logs-2023.05'
+    assert LOGS.partition_end('machine_logs-2023.05.17') == datetime(2023, 5, 18, tzinfo=timezone.utc).timestamp()
+    assert LOGS.partition_end('machine_logs-2023.12', 'month') == datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    assert LOGS.partition_end('machine_hardware_state-2023.05.17') is None
+    assert LOGS.partition_end('machine_logs-backup') is None
+
+
+def test_template():
+    template = HARDWARE_STATES.template()
+    assert template['index_patterns'] == ['machine_hardware_state-*']
+    assert template['template']['aliases'] == {'machine_hardware_state': {}}
+    properties = template['template']['mappings']['properties']
+    assert properties['node']['type'] == 'keyword' and properties['timestamp']['type'] == 'date'
+
+
+def test_flatten_metrics():
+    assert flatten_metrics(12.5) == {'value': 12.5}
+    assert flatten_metrics('192.168.1.2') == {'text': '192.168.1.2'}
+    assert flatten_metrics({'acpitz': 40, 'x86_pkg_temp': 52.0}) == {'metrics': {'acpitz': 40.0, 'x86_pkg_temp': 52.0}}
+    assert flatten_metrics({'a': {'b.c': 1, 'd': 'text'}}) == {'metrics': {'a_b_c': 1.0}}
+    assert flatten_metrics({}) == {} and flatten_metrics(True) == {}
+
+
+@pytest.fixture
+def server():
+    server = StandInElasticServer(latency=0)
+    yield server
+    ELASTIC_POOL.close_all()
+    server.close()
+
+
+def test_writes_routed_to_partitions(server: StandInElasticServer):
+    db = ElasticConnector('127.0.0.1', server.port, None)
+    db.bulk([('machine_logs', {'log': 'a', 'timestamp': T}), ('machine_logs', {'log': 'b', 'timestamp': T + 86400}),
+             ('machine_hardware_state', {'kind': 'cpu_usage', 'value': 3.0, 'timestamp': T}), ('test', {'timestamp': T})])
+    assert server.indices == {'machine_logs-2023.05.17', 'machine_logs-2023.05.18', 'machine_hardware_state-2023.05.17', 'test'}
+
+    db.drop_before('machine_logs', T + 86400)
+    assert server.indices == {'machine_logs-2023.05.18', 'machine_hardware_state-2023.05.17', 'test'}
+    db.close()
+
+
+def test_sqlite_retention(tmp_path):
+    db = SQLiteConnector(str(tmp_path / 'logs.db'), 'machine_logs')
+    db.bulk([('machine_logs', {'log': str(i), 'timestamp': T + i}) for i in range(10)])
+    db.drop_before('machine_logs', T + 5)
+    assert db.get_all()['hits']['total']['value'] == 5
+    db.close()
+    SQLITE_POOL.close_all()
@@ -0,0 +1,88 @@
+'''Module for testing the timer wheel and the liveness tracking'''
+
+import random
+
+import pytest
+
+from dvic_log_server.liveness import TimerWheel, LivenessTracker, LivenessConfig, ACTIVE, PROBING, STALE
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import Packet, PacketHeartbeat
+
+
+def test_wheel_expiries():
+    '''Small wheels so the timers cascade through every level and overflow the top one'''
+    wheel = TimerWheel(tick=1, slots=4, levels=3, now=0)
+    rng = random.Random(7)
+    deadlines = {i: rng.uniform(0.5, 200) for i in range(500)}
+    for key, deadline in deadlines.items(): wheel.schedule(key, deadline)
+    for key in range(0, 500, 5): wheel.cancel(key)
+    wheel.schedule(1, 3.0) # re-armed
+    deadlines[1] = 3.0
+    expired = {}
+    for now in range(1, 202):
+        for key, _ in wheel.advance(now): expired[key] = now
+    assert len(wheel) == 0
+    assert expired == {k: int(-(-d // 1)) for k, d in deadlines.items() if k % 5}
+
+
+class Node(AConnection):
+    def __init__(self, uid: str) -> None:
+        self.uid = uid
+        self.last_seen = 0.0
+        self.stale = False
+        self.closed = False
+        self.packets: list[Packet] = []
+
+    def close(self) -> None: self.closed = True
+    def is_disconnected(self) -> bool: return self.closed
+    def inherit(self, conn) -> None: pass
+    def send_packet(self, pck: Packet) -> None: self.packets.append(pck)
+
+
+@pytest.fixture
+def tracker() -> LivenessTracker:
+    tracker = LivenessTracker.__wrapped__(LivenessConfig(idle_after=10, max_interval=40, probe_timeout=5, evict_after=30, tick=1))
+    tracker.wheel = TimerWheel(tick=1, now=0)
+    return tracker
+
+
+def run(tracker: LivenessTracker, start: int, end: int, node: Node = None, traffic: range = ()):
+    for now in range(start, end):
+        if node is not None and now in traffic: node.last_seen = now
+        tracker.advance(now)
+
+
+def test_busy_nodes_are_not_probed(tracker: LivenessTracker):
+    node = Node('n1')
+    tracker.track(node)
+    run(tracker, 1, 300, node, range(0, 300, 3)) # data every 3 seconds
+    assert node.packets == [] and tracker.entries[id(node)].state == ACTIVE
+
+
+def test_idle_node_probe_interval_grows(tracker: LivenessTracker):
+    node = Node('n1')
+    tracker.track(node)
+    probes = []
+    for now in range(1, 200):
+        if node.packets and node.packets[-1].sent not in probes: # the node answers every probe a second later
+            probes.append(node.packets[-1].sent)
+            node.last_seen = now
+            tracker.answered(node)
+        tracker.advance(now)
+    assert all(isinstance(p, PacketHeartbeat) for p in node.packets)
+    gaps = [b - a for a, b in zip(probes, probes[1:])]
+    assert gaps[:3] == [21, 41, 41] and not node.stale # 10s, then 20s and 40s of silence, plus the answer delay
+
+
+def test_silent_node_stale_then_evicted(tracker: LivenessTracker):
+    node, legacy = Node('n1'), Node('n2')
+    tracker.track(node)
+    tracker.track(legacy)
+    tracker.entries[id(node)].aware = True
+    run(tracker, 1, 16)
+    assert node.stale and tracker.entries[id(node)].state == STALE and len(node.packets) == 2
+    run(tracker, 16, 46)
+    assert node.closed and id(node) not in tracker.entries
+    assert legacy.stale and not legacy.closed # never answered a heartbeat: marked stale only
+    run(tracker, 46, 200, legacy, range(50, 200, 3)) # sends data again
+    assert not legacy.stale and tracker.entries[id(legacy)].state == ACTIVE
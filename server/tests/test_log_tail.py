@@ -0,0 +1,67 @@
+'''Module for testing the live log tail subscriptions'''
+
+import pytest
+
+from dvic_log_server.log_tail import LogTailHub, SHED_AFTER_DROPS
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import *
+from dvic_log_server.network.queues import PriorityPacketQueue, QueueClassConfig, OverflowPolicy
+
+
+class Subscriber(AConnection):
+    '''Connection stand-in keeping the packets in a real outbound queue'''
+    def __init__(self, uid: str, bulk_size: int = 8192) -> None:
+        self.uid = uid
+        self.send_queue = PriorityPacketQueue({PacketPriority.BULK: QueueClassConfig(bulk_size, OverflowPolicy.DROP_OLDEST)})
+        self.closed = False
+
+    @property
+    def dropped(self) -> dict[str, int]: return self.send_queue.dropped
+    def close(self) -> None: self.closed = True
+    def is_disconnected(self) -> bool: return self.closed
+    def inherit(self, conn) -> None: pass
+    def send_packet(self, pck: Packet) -> None: self.send_queue.put(pck, block=False)
+
+
+def subscribe(hub: LogTailHub, conn: Subscriber, sid: str, **filters) -> bool:
+    return hub.subscribe(conn, PacketLogSubscription(LogSubscriptionAction.SUBSCRIBE, sid, **filters))
+
+
+@pytest.fixture
+def hub() -> LogTailHub:
+    return LogTailHub.__wrapped__()
+
+
+def test_filters(hub: LogTailHub):
+    a, b, c = Subscriber('a'), Subscriber('b'), Subscriber('c')
+    subscribe(hub, a, '1', nodes=['n1'])
+    subscribe(hub, b, '1', kinds=['journal'], regex=r'fail(ed)?')
+    subscribe(hub, c, '1', nodes=['n2'], names=['/var/log/syslog'])
+    assert set(hub.by_node) == {'n1', 'n2'} and len(hub.any_node) == 1
+
+    assert hub.publish('n1', PacketLogEntry('journal', 'sshd', 'Connection failed')) == 2
+    assert hub.publish('n2', PacketLogEntry('file', '/var/log/syslog', 'ok')) == 1
+    assert hub.publish('n3', PacketLogEntry('file', '/var/log/syslog', 'failed')) == 0
+    assert [(p.node, p.log) for p in a.send_queue.drain()] == [('n1', 'Connection failed')]
+    assert [p.node for p in b.send_queue.drain()] == ['n1']
+    assert [p.node for p in c.send_queue.drain()] == ['n2']
+
+    hub.unsubscribe(a, '1')
+    assert hub.publish('n1', PacketLogEntry('file', '/var/log/syslog', 'line')) == 0
+
+
+def test_invalid_regex(hub: LogTailHub):
+    a = Subscriber('a')
+    assert not subscribe(hub, a, '1', regex='(')
+    assert a.send_queue.get(block=False).action == LogSubscriptionAction.REJECTED
+    assert not hub.subscriptions
+
+
+def test_slow_subscriber_shed(hub: LogTailHub):
+    slow, gone = Subscriber('slow', bulk_size=16), Subscriber('gone')
+    subscribe(hub, slow, '1')
+    subscribe(hub, gone, '1')
+    gone.close()
+    for i in range(SHED_AFTER_DROPS + 32): hub.publish('n1', PacketLogEntry('file', 'f', str(i)))
+    assert not hub.subscriptions and hub.stats['shed'] == 2
+    assert slow.send_queue.get(block=False).action == LogSubscriptionAction.SHED # control packets overtake the logs
@@ -0,0 +1,86 @@
+'''Module for testing the live node state registry and its REST endpoints'''
+
+import json
+
+import pytest
+from fastapi import HTTPException
+
+import dvic_log_server.api as api
+from dvic_log_server.liveness import LivenessTracker, LivenessConfig
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import Packet
+from dvic_log_server.network.replay import ReplayConfig
+from dvic_log_server.node_state import NodeStateRegistry
+from dvic_log_server.presence import PresenceHub
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    registry = NodeStateRegistry.__wrapped__()
+    monkeypatch.setattr(NodeStateRegistry, '_instance', registry)
+    return registry
+
+
+def test_snapshots_follow_updates(registry: NodeStateRegistry):
+    assert registry.snapshot() == (b'{}', f'"{registry.generation}-0"')
+    registry.update('n1', 'cpu_usage', 12.5, 1.0)
+    registry.update('n2', 'temperature', {'acpitz': 40.0}, 2.0)
+    fleet, etag = registry.snapshot()
+    assert json.loads(fleet) == {'n1': {'cpu_usage': {'data': 12.5, 'timestamp': 1.0}}, 'n2': {'temperature': {'data': {'acpitz': 40.0}, 'timestamp': 2.0}}}
+    assert registry.snapshot()[0] is fleet # cached until the next update
+
+    n1, n1_etag = registry.snapshot('n1')
+    registry.update('n2', 'cpu_usage', 3.0, 3.0)
+    assert registry.snapshot('n1') == (n1, n1_etag) and registry.snapshot()[1] != etag
+    assert registry.snapshot('unknown') == (None, None)
+
+    registry.remove('n2')
+    assert json.loads(registry.snapshot()[0]).keys() == {'n1'}
+
+
+def test_endpoints(registry: NodeStateRegistry):
+    registry.update('n1', 'cpu_usage', 12.5, 1.0)
+    res = api.get_nodes_state(if_none_match=None)
+    assert res.status_code == 200 and json.loads(res.body) == {'n1': {'cpu_usage': {'data': 12.5, 'timestamp': 1.0}}}
+    etag = res.headers['etag']
+    assert api.get_nodes_state(if_none_match=etag).status_code == 304
+    assert api.get_nodes_state(if_none_match=f'"other", W/{etag}').status_code == 304
+
+    node = api.get_node_state('n1', if_none_match=None)
+    registry.update('n1', 'cpu_usage', 13.0, 2.0)
+    assert api.get_node_state('n1', if_none_match=node.headers['etag']).status_code == 200
+    with pytest.raises(HTTPException) as e:
+        api.get_node_state('n2', if_none_match=None)
+    assert e.value.status_code == 404
+
+
+class Node(AConnection):
+    def __init__(self, uid: str, session=None) -> None:
+        self.uid = uid
+        self.session = session
+        self.last_seen = 0.0
+
+    def close(self) -> None: pass
+    def is_disconnected(self) -> bool: return True
+    def inherit(self, conn) -> None: pass
+    def send_packet(self, pck: Packet) -> None: pass
+
+
+def test_forgotten_once_gone_for_good(registry: NodeStateRegistry, monkeypatch):
+    monkeypatch.setattr(PresenceHub, '_instance', PresenceHub.__wrapped__())
+    monkeypatch.setattr(LivenessTracker, '_instance', LivenessTracker.__wrapped__(LivenessConfig()))
+    manager = object.__new__(api.ConnectionManager.__wrapped__) # without the config file
+    manager.config, manager.connections, manager.detached = None, {}, {}
+    now = [1000.0]
+    monkeypatch.setattr(api, 'time', lambda: now[0])
+
+    manager['plain'], manager['sequenced'] = Node('plain'), Node('sequenced', session=object())
+    registry.update('plain', 'cpu_usage', 1.0, 1.0)
+    registry.update('sequenced', 'cpu_usage', 2.0, 1.0)
+    manager['plain'] = None # nothing to resume
+    manager['sequenced'] = None
+    assert json.loads(registry.snapshot()[0]).keys() == {'sequenced'} # may still resume its session
+
+    now[0] += ReplayConfig().resume_window + 1
+    manager['other'] = Node('other')
+    assert registry.snapshot() == (b'{}', f'"{registry.generation}-{registry.version}"')
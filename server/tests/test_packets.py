@@ -0,0 +1,123 @@
+'''Module for testing the packet codecs'''
+
+import pytest
+
+from dvic_log_server.network.packets import *
+from dvic_log_server.network.packets import decode
+
+
+def sample_packets() -> list[Packet]:
+    return [
+        PacketLogEntry('journal', 'systemd-journald', 'Journal started\n'),
+        PacketLogEntry('file', '/var/log/syslog', 'line', node='1d1f0545-2b60-488e-9419-d54b23bda47d'),
+        PacketLogEntry('journal', 'sshd', 'Accepted publickey\n', key='s=6c3b;i=1a2f;b=91e0;m=2d4b;t=5fb1;x=8d2c', timestamp=1684300000.25),
+        PacketLogSubscription(LogSubscriptionAction.SUBSCRIBE, 'tail-1', ['1d1f0545-2b60-488e-9419-d54b23bda47d'], ['journal'], None, r'error|fail'),
+        PacketQuery('q-1', 'machine_logs', {'nodes': ['1d1f0545-2b60-488e-9419-d54b23bda47d'], 'start': 1684300000.0, 'text': 'error'}, ['log', 'timestamp'], 100),
+        PacketQuery('q-1', 'machine_logs', hits=[{'log': 'Journal started', 'timestamp': 1684300000.5}], next_cursor='WzE2ODQzMDAwMDAuNSwgMV0'),
+        PacketHardwareState('temperature', {'acpitz': 42.0, 'x86_pkg_temp': 51.5}),
+        PacketHardwareState('machine_name', 'demo-node-01'),
+        PacketInteractiveSession('6f1c0b6e-5d8f-4d0c-9a43-31e7b9d9f6a2', executable='/bin/bash', target_machine='1d1f0545-2b60-488e-9419-d54b23bda47d'),
+        PacketInteractiveSession('6f1c0b6e-5d8f-4d0c-9a43-31e7b9d9f6a2', value=b'\x1b[0;32mls\r\n\xff', return_value=0),
+        PacketNodeStatus(NodeStatusAction.LIST_NODES),
+        PacketHeartbeat(1684300000.5),
+        PacketRetryAfter(7.5, RetryReason.HANDSHAKE),
+        PacketResume('5f0c2a9e', 1042, 77),
+        PacketResume('5f0c2a9e', 0),
+        PacketAck(1042),
+        PacketSessionTicket('~1d1f0545-2b60-488e-9419-d54b23bda47d.4f2a.9c1e', 300.0),
+        PacketNodeStatus(NodeStatusAction.DELTA, {'1d1f0545-2b60-488e-9419-d54b23bda47d': {'status': 'disconnected'}}),
+        PacketNodeStatus(node_status={'1d1f0545-2b60-488e-9419-d54b23bda47d': {'status': 'connected', 'last_seen': 1684300000.5}}),
+        PacketNodeAdditionRequest('10.0.0.2', 'dvic', 'p4ss', '1d1f0545-2b60-488e-9419-d54b23bda47d'),
+        PacketScriptInteractiveSession('echo hello\nexit 0', ['1d1f0545-2b60-488e-9419-d54b23bda47d']),
+    ]
+
+
+def fields(pck: Packet) -> dict:
+    return {name: getattr(pck, name) for name, _ in pck.WIRE_FIELDS}
+
+
+@pytest.mark.parametrize('pck', sample_packets(), ids=lambda p: p.identifier)
+def test_binary_round_trip(pck: Packet):
+    data = pck.encode_binary()
+    assert isinstance(data, bytes)
+    decoded = decode(data)
+    assert type(decoded) is type(pck)
+    expected = fields(pck)
+    if isinstance(pck, PacketNodeStatus) and pck.action is not None:
+        expected['action'] = NodeStatusAction(pck.action)
+    assert fields(decoded) == expected
+
+
+@pytest.mark.parametrize('pck', sample_packets(), ids=lambda p: p.identifier)
+def test_binary_matches_json(pck: Packet):
+    '''Both codecs must hand the same packet to the handlers'''
+    from_json, from_binary = decode(pck.encode()), decode(pck.encode_binary())
+    assert from_json.get_data() == from_binary.get_data()
+
+
+@pytest.mark.parametrize('binary', [False, True], ids=['json', 'binary'])
+def test_batch_round_trip(binary: bool):
+    batch = PacketBatch(sample_packets())
+    decoded = decode(batch.encode_binary() if binary else batch.encode())
+    assert isinstance(decoded, PacketBatch)
+    assert [type(p) for p in decoded.packets] == [type(p) for p in batch.packets]
+    assert [p.get_data() for p in decoded.packets] == [decode(p.encode()).get_data() for p in batch.packets]
+
+
+def test_binary_missing_trailing_fields():
+    '''Frames of peers that do not know the last fields of a packet yet'''
+    frame = PacketLogEntry('file', '/var/log/syslog', 'line', node='n1').encode_binary()
+    old = frame[:-(1 + 4 + len('n1') + 1 + 1)] # without the node field (tag, u32 length, value), the key and timestamp fields (None tags)
+    decoded = decode(old)
+    assert (decoded.log, decoded.node, decoded.key, decoded.timestamp) == ('line', None, None, None)
+    assert decode(frame[:-2]).node == 'n1' # without the key and timestamp fields
+    frame = PacketLogEntry('file', '/var/log/syslog', 'line', key='12:40', timestamp=1.5).encode_binary()
+    assert decode(frame[:-(1 + 8)]).key == '12:40' # without the timestamp field (tag, f64)
+    assert decode(frame).timestamp == 1.5
+
+
+def test_binary_rejects_trailing_data():
+    with pytest.raises(ValueError):
+        decode(PacketLogEntry('file', '/var/log/syslog', 'line').encode_binary() + b'\x00')
+
+
+def test_registry_matches_identifiers():
+    for identifier, cls in PACKET_REGISTRY.items():
+        assert cls.identifier == identifier
+        assert PACKET_TYPE_REGISTRY[cls.type_id] is cls
+    assert PACKET_REGISTRY['log_entry'] is PacketLogEntry
+    assert PACKET_REGISTRY['machine_log'] is PacketMachineLog
+
+
+def test_registry_detects_collisions():
+    with pytest.raises(TypeError):
+        class PacketDuplicateLogEntry(Packet, identifier="log_entry", type_id=250): pass
+    with pytest.raises(TypeError):
+        class PacketDuplicateTypeId(Packet, identifier="duplicate_type_id", type_id=PacketLogEntry.type_id): pass
+    assert 'duplicate_type_id' not in PACKET_REGISTRY
+
+
+@pytest.mark.parametrize('pck', sample_packets(), ids=lambda p: p.identifier)
+def test_packets_are_slotted(pck: Packet):
+    assert not hasattr(pck, '__dict__')
+    assert not hasattr(decode(pck.encode_binary()), '__dict__')
+
+
+def test_handler_table():
+    class Owner:
+        def _handle_log_entry(self, pck): return pck.log
+    table = handler_table(Owner)
+    assert list(table) == ['log_entry']
+    assert table['log_entry'](Owner(), PacketLogEntry('file', 'f', 'x')) == 'x'
+
+
+def test_select_subprotocol():
+    assert select_subprotocol([SUBPROTOCOL_JSON, SUBPROTOCOL_BINARY]) == SUBPROTOCOL_BINARY
+    assert select_subprotocol([SUBPROTOCOL_JSON]) == SUBPROTOCOL_JSON
+    assert select_subprotocol([]) is None
+
+
+def test_binary_size():
+    '''The binary frame of a log line is smaller than its JSON, see bench_packets for the throughput'''
+    pck = PacketLogEntry('journal', 'nm-dispatcher', 'May 17 10:31:02 demo-node NetworkManager[812]: <info> [1684312262.1211] device (wlp2s0): state change: activated -> deactivating\n')
+    assert len(pck.encode_binary()) < len(pck.encode()) * 0.8
@@ -0,0 +1,77 @@
+'''Module for testing the node status subscriptions'''
+
+import asyncio
+import time
+
+import pytest
+
+import dvic_log_server.presence as presence
+from dvic_log_server.meta import AConnection
+from dvic_log_server.network.packets import *
+from dvic_log_server.presence import PresenceHub
+
+
+class Node(AConnection):
+    '''Connection stand-in recording the packets sent to it'''
+    def __init__(self, uid: str) -> None:
+        self.uid = uid
+        self.last_seen = time.time()
+        self.dropped = {'interactive': 0, 'state': 0, 'bulk': 0}
+        self.packets: list[Packet] = []
+        self.closed = False
+
+    def close(self) -> None: self.closed = True
+    def is_disconnected(self) -> bool: return self.closed
+    def inherit(self, conn) -> None: pass
+    def send_packet(self, pck: Packet) -> None: self.packets.append(decode(pck.encode_binary()))
+
+
+@pytest.fixture
+def hub() -> PresenceHub:
+    return PresenceHub.__wrapped__()
+
+
+def test_snapshot_then_coalesced_deltas(hub: PresenceHub):
+    nodes = {f'n{i}': Node(f'n{i}') for i in range(3)}
+    client = Node('cli')
+    hub.subscribe(client, nodes)
+    snapshot, = client.packets
+    assert snapshot.action == NodeStatusAction.SNAPSHOT and set(snapshot.node_status) == {'n0', 'n1', 'n2'}
+    assert snapshot.node_status['n0']['status'] == 'connected'
+
+    for _ in range(1000): # mass reconnect
+        for uid, node in nodes.items():
+            hub.disconnected(uid)
+            hub.connected(uid, node)
+    hub.disconnected('n2')
+    assert hub.flush() == 3
+    delta = client.packets[-1]
+    assert len(client.packets) == 2 and delta.action == NodeStatusAction.DELTA
+    assert delta.node_status['n0']['status'] == 'connected' and delta.node_status['n2']['status'] == 'disconnected'
+    assert delta.node_status['n0']['last_seen'] % presence.LAST_SEEN_BUCKET == 0
+    assert hub.flush() == 0 and len(client.packets) == 2
+
+
+def test_unsubscribe_and_disconnected_subscribers(hub: PresenceHub):
+    a, b = Node('a'), Node('b')
+    hub.subscribe(a, {})
+    hub.subscribe(b, {})
+    hub.unsubscribe(a)
+    b.closed = True
+    hub.changed('n0', last_seen=0.0)
+    hub.flush()
+    assert len(a.packets) == len(b.packets) == 1 and not hub.subscribers
+    hub.changed('n0', last_seen=30.0) # nobody listens anymore
+    assert not hub.pending
+
+
+def test_deltas_scheduled_on_event_loop(hub: PresenceHub, monkeypatch):
+    monkeypatch.setattr(presence, 'COALESCE_WINDOW', 0.01)
+    client = Node('cli')
+    async def scenario():
+        hub.subscribe(client, {})
+        for i in range(100): hub.connected(f'n{i}', Node(f'n{i}'))
+        await asyncio.sleep(0.05)
+    asyncio.run(scenario())
+    assert [p.action for p in client.packets] == [NodeStatusAction.SNAPSHOT, NodeStatusAction.DELTA]
+    assert len(client.packets[1].node_status) == 100
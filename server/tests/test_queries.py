@@ -0,0 +1,150 @@
+'''Module for testing the paginated queries'''
+
+import time
+
+import pytest
+
+from dvic_log_server.database_drivers import *
+from dvic_log_server.queries import *
+from tests.bench_ingest import StandInElasticServer
+
+
+def test_build_query():
+    assert build_query() == {'match_all': {}}
+    assert build_query(nodes=['n1'], start=10.0, text='fail') == {'bool': {
+        'filter': [{'terms': {'node': ['n1']}}, {'range': {'timestamp': {'gte': 10.0}}}],
+        'must': [{'match_phrase': {'log': 'fail'}}],
+    }}
+
+
+def test_cursor_round_trip():
+    assert encode_cursor(None) is None and decode_cursor(None) is None
+    assert decode_cursor(encode_cursor([1684300000.5, 'a1b2'])) == [1684300000.5, 'a1b2']
+    for cursor in ('not a cursor', encode_cursor({'after': 1.0})):
+        with pytest.raises(ValueError): decode_cursor(cursor)
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = DatabaseConfig(backend=BACKEND_SQLITE, path=str(tmp_path / 'logs.db'))
+    db = open_connector(database)
+    db.bulk([('machine_logs', {'node': f'n{i % 2}', 'kind': 'journal', 'log': f'line {i}', 'timestamp': float(i // 3)}) for i in range(30)])
+    db.close()
+    yield database
+    SQLITE_POOL.close_all()
+
+
+def test_sqlite_pages_are_stable(database: DatabaseConfig):
+    '''Pages split on equal timestamps and are not shifted by documents written in between'''
+    page, cursor = query_page(database, 'machine_logs', size=7)
+    seen = [d['log'] for d in page]
+    db = open_connector(database)
+    db.bulk([('machine_logs', {'node': 'n0', 'log': 'late', 'timestamp': 0.0})])
+    db.close()
+    while cursor is not None:
+        page, cursor = query_page(database, 'machine_logs', size=7, cursor=cursor)
+        seen += [d['log'] for d in page]
+    assert seen == [f'line {i}' for i in range(30)]
+
+
+def test_sqlite_filters_fields_order(database: DatabaseConfig):
+    filters = {'nodes': ['n1'], 'start': 2.0, 'end': 5.0}
+    pages = list(iter_pages(database, 'machine_logs', filters, ['log', 'timestamp'], size=2, descending=True))
+    docs = [d for p in pages for d in p]
+    assert [len(p) for p in pages] == [2, 2, 2]
+    assert docs[0] == {'log': 'line 17', 'timestamp': 5.0}
+    assert [d['timestamp'] for d in docs] == sorted((d['timestamp'] for d in docs), reverse=True)
+    assert [d['log'] for d in query_page(database, 'machine_logs', {'text': 'line 2'}, size=100)[0]] == ['line 2'] + [f'line {i}' for i in range(20, 30)]
+
+
+def test_invalid_queries(database: DatabaseConfig):
+    with pytest.raises(KeyError): query_page(database, 'users')
+    with pytest.raises(ValueError): query_page(database, 'machine_logs', size=MAX_PAGE_SIZE + 1)
+    with pytest.raises(ValueError): query_page(database, 'machine_logs', {'host': 'n1'})
+
+
+def test_elastic_search_after():
+    server = StandInElasticServer(latency=0)
+    try:
+        c = ElasticConnector('127.0.0.1', server.port, 'machine_logs')
+        assert c.search_page({'match_all': {}}, 50, [10.0, 'a1b2'], ['log']) == ([], None)
+        c.close()
+        body = server.searches[-1]
+        assert body['sort'] == [{'timestamp': 'asc'}, {'doc_id': 'asc'}]
+        assert body['search_after'] == [10.0, 'a1b2'] and body['_source'] == ['log'] and body['size'] == 50
+    finally:
+        ELASTIC_POOL.close_all()
+        server.close()
+
+
+@pytest.fixture
+def recent(tmp_path):
+    '''Logs of two nodes every 3 seconds over the last 100 seconds, two per timestamp'''
+    database = DatabaseConfig(backend=BACKEND_SQLITE, path=str(tmp_path / 'logs.db'))
+    now = time.time()
+    db = open_connector(database)
+    db.bulk([('machine_logs', {'node': f'n{i % 2}', 'log': f'line {i}', 'timestamp': now - 100 + 3 * (i // 2)}) for i in range(68)])
+    db.close()
+    yield database
+    SQLITE_POOL.close_all()
+
+
+def all_pages(page, **kwargs) -> list[dict]:
+    docs, cursor = [], None
+    while True:
+        hits, cursor = page(index='machine_logs', cursor=cursor, **kwargs)
+        docs += hits
+        if cursor is None: return docs
+
+
+@pytest.mark.parametrize('descending', [False, True], ids=['asc', 'desc'])
+@pytest.mark.parametrize('filters', [{}, {'nodes': ['n1'], 'start': time.time() - 55}, {'end': time.time() - 20, 'text': 'line 1'}], ids=['all', 'node-start', 'end-text'])
+def test_cache_matches_database(recent: DatabaseConfig, filters: dict, descending: bool):
+    cache = QueryCache.__wrapped__(QueryCacheConfig(bucket=10, grace=5), recent)
+    expected = all_pages(lambda **kw: query_page(recent, **kw), filters=filters, size=7, descending=descending)
+    for _ in range(2):
+        assert all_pages(cache.page, filters=filters, size=7, descending=descending, fields=['log', 'timestamp']) == \
+            [{'log': d['log'], 'timestamp': d['timestamp']} for d in expected]
+    assert cache.stats['hits'] >= cache.stats['misses'] > 0
+
+
+def test_cache_open_bucket_and_invalidation(recent: DatabaseConfig):
+    cache = QueryCache.__wrapped__(QueryCacheConfig(bucket=10, grace=5), recent)
+    before = all_pages(cache.page, size=50)
+    misses = cache.stats['misses']
+    db = open_connector(recent)
+    db.bulk([('machine_logs', {'node': 'n0', 'log': 'new', 'timestamp': time.time()}), ('machine_logs', {'node': 'n0', 'log': 'late', 'timestamp': time.time() - 99})])
+    db.close()
+    assert [d['log'] for d in all_pages(cache.page, size=50)] == [d['log'] for d in before] + ['new'] # closed buckets served from the cache
+    assert cache.stats['misses'] == misses
+    cache.invalidate('machine_logs', time.time() - 99)
+    assert cache.stats['invalidations'] == 1
+    assert 'late' in [d['log'] for d in all_pages(cache.page, size=50)]
+    assert cache.stats['misses'] == misses + 1
+
+
+def test_cache_bounds(recent: DatabaseConfig):
+    cache = QueryCache.__wrapped__(QueryCacheConfig(max_bytes=2000, bucket=10, grace=5), recent)
+    expected = all_pages(lambda **kw: query_page(recent, **kw), size=10)
+    assert all_pages(cache.page, size=10) == expected
+    assert cache.stats['evictions'] > 0 and cache.info()['bytes'] <= 2000
+    cache = QueryCache.__wrapped__(QueryCacheConfig(bucket=10, grace=5, max_bucket_documents=3), recent)
+    assert all_pages(cache.page, size=10) == expected
+    assert cache.stats['uncacheable'] > 0
+
+
+@pytest.mark.parametrize('descending', [False, True], ids=['asc', 'desc'])
+def test_cache_skips_empty_buckets(tmp_path, monkeypatch, descending: bool):
+    database = DatabaseConfig(backend=BACKEND_SQLITE, path=str(tmp_path / 'logs.db'))
+    now = time.time()
+    db = open_connector(database)
+    db.bulk([('machine_logs', {'node': 'n0', 'log': f'line {i}', 'timestamp': now - 5000 + 1000 * i}) for i in range(5)]) # 100 buckets apart
+    db.close()
+    queries = []
+    search_page = SQLiteConnector.search_page
+    monkeypatch.setattr(SQLiteConnector, 'search_page', lambda self, *args, **kwargs: queries.append(args) or search_page(self, *args, **kwargs))
+    cache = QueryCache.__wrapped__(QueryCacheConfig(bucket=10, grace=5), database)
+    docs = all_pages(cache.page, size=2, descending=descending)
+    assert [d['log'] for d in docs] == [f'line {i}' for i in (range(4, -1, -1) if descending else range(5))]
+    assert len(queries) < 30 # instead of one per bucket
+    SQLITE_POOL.close_all()
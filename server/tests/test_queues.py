@@ -0,0 +1,67 @@
+'''Module for testing the bounded outbound packet queues'''
+
+import threading
+
+from dvic_log_server.network.packets import PacketHardwareState, PacketInteractiveSession, PacketLogEntry, PacketPriority
+from dvic_log_server.network.queues import *
+
+
+def log(i: int) -> PacketLogEntry:
+    return PacketLogEntry('file', '/var/log/syslog', f'line {i}')
+
+
+def test_priority_order():
+    q = PriorityPacketQueue()
+    q.put(log(0))
+    q.put(PacketHardwareState('cpu_usage', 12.5))
+    q.put(PacketInteractiveSession('s', value=b'ls\n'))
+    assert [p.priority for p in q.drain()] == [PacketPriority.INTERACTIVE, PacketPriority.STATE, PacketPriority.BULK]
+
+
+def test_drop_oldest():
+    q = PriorityPacketQueue({PacketPriority.BULK: QueueClassConfig(3, OverflowPolicy.DROP_OLDEST)})
+    for i in range(5): assert q.put(log(i))
+    assert [p.log for p in q.drain()] == ['line 2', 'line 3', 'line 4']
+    assert q.dropped['bulk'] == 2
+
+
+def test_latest_value_wins():
+    q = PriorityPacketQueue()
+    q.put(PacketHardwareState('cpu_usage', 10.0))
+    q.put(PacketHardwareState('temperature', {'acpitz': 40.0}))
+    q.put(PacketHardwareState('cpu_usage', 90.0))
+    assert [(p.kind, p.data) for p in q.drain()] == [('cpu_usage', 90.0), ('temperature', {'acpitz': 40.0})]
+    assert q.dropped['state'] == 1
+
+
+def test_block():
+    q = PriorityPacketQueue({PacketPriority.INTERACTIVE: QueueClassConfig(1, OverflowPolicy.BLOCK)})
+    assert q.put(PacketInteractiveSession('s', value=b'a'))
+    assert not q.put(PacketInteractiveSession('s', value=b'b'), block=False)
+    assert q.dropped['interactive'] == 1
+
+    t = threading.Thread(target=lambda: q.put(PacketInteractiveSession('s', value=b'c')))
+    t.start()
+    assert q.get().value == b'a'
+    t.join(1)
+    assert not t.is_alive()
+    assert q.get(timeout=1).value == b'c'
+    assert q.get(block=False) is None
+
+
+def test_requeue():
+    q = PriorityPacketQueue()
+    for i in range(4): q.put(log(i))
+    q.put(PacketHardwareState('cpu_usage', 10.0))
+    unsent = q.drain(3)
+    q.put(PacketHardwareState('cpu_usage', 90.0))
+    q.requeue(unsent)
+    assert [p.data if p.priority == PacketPriority.STATE else p.log for p in q.drain()] == [90.0, 'line 0', 'line 1', 'line 2', 'line 3']
+    assert q.dropped['state'] == 1 # older value not put back
+
+
+def test_queue_config_from_dict():
+    cfg = queue_config_from_dict({'bulk': {'max_size': 10}, 'state': {'policy': 'drop_oldest'}})
+    assert cfg[PacketPriority.BULK] == QueueClassConfig(10, DEFAULT_QUEUE_CONFIG[PacketPriority.BULK].policy)
+    assert cfg[PacketPriority.STATE].policy == OverflowPolicy.DROP_OLDEST
+    assert cfg[PacketPriority.INTERACTIVE] == DEFAULT_QUEUE_CONFIG[PacketPriority.INTERACTIVE]
@@ -0,0 +1,125 @@
+'''Module for testing the sequenced sessions resumed across reconnections'''
+
+import time
+
+import dvic_log_server.api # before the interactive sessions, the two modules import each other
+from dvic_log_server.network.packets import *
+from dvic_log_server.network.replay import ReplayBuffer, ReplayConfig, ResumableSession
+from dvic_log_server.interactive_sessions import InteractiveSession, INTERACTIVE_SESSIONS
+from tests.test_presence import Node
+
+
+def log(i: int) -> PacketLogEntry:
+    return PacketLogEntry('journal', 'sshd', f'line {i}')
+
+
+def connect(server: ResumableSession, node: ResumableSession) -> tuple[list[Packet], list[Packet]]:
+    '''Resumption exchange of a new connection, returns the packets replayed (to the server, to the node)'''
+    node.stop()
+    node.peer_resumed(server.offer())
+    answer, to_server = node.resume()
+    server.peer_resumed(answer)
+    start, to_node = server.resume()
+    node.peer_resumed(start)
+    return to_server, to_node
+
+
+def transfer(sender: ResumableSession, receiver: ResumableSession, packets: list[Packet], delivered: bool = True) -> list[Packet]:
+    '''Send packets, returns the acks of the receiver (nothing is received if not delivered)'''
+    acks = []
+    for pck in packets:
+        sender.sent_packet(pck, 100)
+        if delivered and (ack := receiver.received_packet(pck)) is not None: acks.append(ack)
+    return acks
+
+
+def test_replay_buffer_bounds():
+    buffer = ReplayBuffer(max_packets=3, max_bytes=250)
+    for i in range(1, 5): buffer.append(i, log(i), 100)
+    assert [seq for seq, _, _ in buffer.packets] == [3, 4] and buffer.bytes == 200 and buffer.dropped == 2
+    buffer.ack(3)
+    assert len(buffer) == 1 and buffer.bytes == 100
+
+
+def test_resume_replays_missing_tail():
+    server, node = ResumableSession(ReplayConfig(ack_every=4)), ResumableSession(ReplayConfig(ack_every=4))
+    assert connect(server, node) == ([], [])
+    for ack in transfer(node, server, [log(i) for i in range(10)]): node.acked(ack)
+    assert len(node.replay) == 2 # acked up to 8
+    transfer(node, server, [log(i) for i in range(10, 13)], delivered=False) # connection dropped
+    transfer(server, node, [PacketHeartbeat(1.0)], delivered=False)
+
+    to_server, to_node = connect(server, node)
+    assert [p.log for p in to_server] == ['line 10', 'line 11', 'line 12'] # 8 and 9 were received, not sent again
+    assert [type(p) for p in to_node] == [PacketHeartbeat]
+    for p in to_server: server.received_packet(p)
+    assert server.received == node.sent == 13
+    transfer(node, server, [log(13)])
+    assert server.received == 14 and server.lost == node.lost == 0
+
+
+def test_restart_is_not_replayed():
+    server, node = ResumableSession(), ResumableSession()
+    connect(server, node)
+    transfer(server, node, [PacketHeartbeat(1.0)] * 3)
+    transfer(node, server, [log(i) for i in range(5)], delivered=False)
+    server = ResumableSession() # server restarted, its state is lost
+    to_server, to_node = connect(server, node)
+    assert to_server == [] and to_node == [] and len(node.replay) == 0
+    transfer(node, server, [log(5)])
+    assert server.received == 6 and server.lost == 0 # numbering of the node adopted
+
+
+def test_on_acked():
+    acked = []
+    server, node = ResumableSession(ReplayConfig(ack_every=2)), ResumableSession(on_acked=acked.extend)
+    connect(server, node)
+    for ack in transfer(node, server, [log(i) for i in range(3)]): node.acked(ack)
+    assert [p.log for p in acked] == ['line 0', 'line 1']
+    connect(server, node) # the offer acknowledges the rest
+    assert [p.log for p in acked] == ['line 0', 'line 1', 'line 2']
+
+
+def test_ack_delay():
+    server, node = ResumableSession(ReplayConfig(ack_every=100, ack_delay=0.2)), ResumableSession()
+    connect(server, node)
+    assert transfer(node, server, [log(0)]) == []
+    time.sleep(0.25)
+    assert [ack.received for ack in transfer(node, server, [log(1), log(2)])] == [2] # the next ack waits again
+
+
+def test_flush_ack_after_burst():
+    server, node = ResumableSession(ReplayConfig(ack_delay=0.2)), ResumableSession()
+    connect(server, node)
+    assert transfer(node, server, [log(i) for i in range(5)]) == [] and server.flush_ack() is None # fewer than ack_every
+    assert 0 < server.ack_due() <= 0.2
+    time.sleep(0.25)
+    assert server.ack_due() == 0 and server.flush_ack().received == 5
+    assert server.ack_due() is None and server.flush_ack() is None
+
+
+def test_lost_when_buffer_overflowed():
+    server, node = ResumableSession(), ResumableSession(ReplayConfig(max_packets=2))
+    connect(server, node)
+    transfer(node, server, [log(i) for i in range(5)], delivered=False)
+    to_server, _ = connect(server, node)
+    assert [p.log for p in to_server] == ['line 3', 'line 4'] and server.lost == 3
+
+
+def test_control_packets_not_numbered():
+    server, node = ResumableSession(ReplayConfig(ack_every=1)), ResumableSession(ReplayConfig(ack_every=1))
+    assert server.sent_packet(log(0), 10) is None # before the resumption exchange
+    connect(server, node)
+    assert node.received_packet(PacketAck(3)) is None and server.sent_packet(PacketResume('s', 0, 1), 10) is None
+    assert server.sent_packet(log(0), 10) == 1 and node.received_packet(log(0)).received == 1
+
+
+def test_rebind_interactive_sessions():
+    old, new, cli = Node('n1'), Node('n1'), Node('cli')
+    session = InteractiveSession(None, old)
+    session.subscribe(cli)
+    InteractiveSession.rebind(old, new)
+    assert session.target_machine is new and session.subscribers == [cli]
+    InteractiveSession.rebind(cli, old)
+    assert session.subscribers == [old]
+    del INTERACTIVE_SESSIONS[session.uid]
@@ -0,0 +1,51 @@
+'''Module for testing the streaming rollups of the hardware metrics'''
+
+
+import pytest
+
+from dvic_log_server.indices import FAMILIES
+from dvic_log_server.rollups import *
+
+
+@pytest.fixture
+def engine():
+    emitted = []
+    engine = RollupEngine.__wrapped__(RollupConfig(windows=['1m', '1h'], grace=5, flush_interval=60), lambda i, d: emitted.append((i, d)))
+    engine.emitted = emitted
+    yield engine
+    engine.stop()
+
+
+def test_parse_window():
+    assert [parse_window(w) for w in ('30s', '5m', '1h', '2d')] == [30, 300, 3600, 172800]
+    with pytest.raises(ValueError):
+        parse_window('5w')
+
+
+def test_aggregates_and_closing(engine: RollupEngine, monkeypatch):
+    clock = [3600 * 1000 + 10.0]
+    monkeypatch.setattr('dvic_log_server.rollups.time', type('Clock', (), {'time': staticmethod(lambda: clock[0])}))
+    for i, v in enumerate([3.0, 1.0, 2.0]): engine.add('n1', 'cpu_usage', v, clock[0] + i)
+    engine.add('n1', 'memory_usage', {'used': 40.0, 'total': 100}, clock[0])
+    engine.add('n1', 'ip', '10.0.0.2', clock[0]) # not numeric
+    assert engine.flush() == 0
+
+    clock[0] += 60 + engine.config.grace # the first minute is closed
+    engine.add('n1', 'memory_usage', {'used': 50.0, 'total': 100}, clock[0])
+    assert engine.flush() == 3
+    index, doc = next((i, d) for i, d in engine.emitted if d['metric'] == 'cpu_usage')
+    assert index == 'machine_hardware_rollup_1m' and index in FAMILIES
+    assert doc['timestamp'] == 3600 * 1000 and doc['window'] == '1m'
+    assert {k: doc[k] for k in ('min', 'max', 'mean', 'count', 'last')} == {'min': 1.0, 'max': 3.0, 'mean': 2.0, 'count': 3, 'last': 2.0}
+
+    engine.flush(force=True)
+    hour = next(d for i, d in engine.emitted if d['metric'] == 'memory_usage.used' and d['window'] == '1h')
+    assert hour['mean'] == 45.0 and hour['last'] == 50.0 and hour['count'] == 2
+
+
+def test_late_samples(engine: RollupEngine, monkeypatch):
+    now = 3600 * 1000 + 1800.0 # middle of an hour
+    monkeypatch.setattr('dvic_log_server.rollups.time', type('Clock', (), {'time': staticmethod(lambda: now)}))
+    engine.add('n1', 'cpu_usage', 10.0, now - 600) # its minute is closed, its hour is not
+    assert engine.stats['late'] == 1
+    assert [k[3] for k in engine.buckets] == ['1h']
@@ -0,0 +1,121 @@
+'''Module for testing the disk spool and its use by the ingest pipeline'''
+
+import json
+import time
+
+from dvic_log_server.database_drivers import DatabaseConfig
+from dvic_log_server.ingest import IngestPipeline, IngestConfig
+from dvic_log_server.utils.spool import *
+from dvic_log_server.utils.spool import _HEADER
+from tests.bench_ingest import StandInElasticServer, document
+
+
+def records(n: int, start: int = 0) -> list[bytes]:
+    return [f'record {i}'.encode() * 10 for i in range(start, start + n)]
+
+
+def test_read_commit_across_segments(tmp_path):
+    spool = Spool(tmp_path, segment_bytes=1024)
+    assert spool.append_many(records(100)) == 100
+    assert len(spool.segments) > 1
+    read = []
+    while not spool.is_empty():
+        chunk, pos = spool.read(7)
+        read += chunk
+        spool.commit(pos)
+    assert read == records(100)
+    assert len(spool.segments) == 1
+
+
+def test_resume_after_restart(tmp_path):
+    spool = Spool(tmp_path, segment_bytes=1024)
+    spool.append_many(records(50))
+    chunk, pos = spool.read(20)
+    spool.commit(pos)
+    spool.read(10) # not committed, read again after the restart
+    spool.close()
+    spool = Spool(tmp_path, segment_bytes=1024)
+    assert spool.read(1000)[0] == records(30, 20)
+
+
+def test_torn_tail_truncated_on_open(tmp_path):
+    for torn in (b'\x00\x00', _HEADER.pack(100, 0) + b'partial'): # header, payload cut by a crash
+        spool = Spool(tmp_path / str(len(torn)), segment_bytes=2**20)
+        spool.append_many(records(3))
+        spool.active.write(torn)
+        spool.close()
+        spool = Spool(tmp_path / str(len(torn)), segment_bytes=2**20)
+        assert spool.stats['corrupted'] == 1
+        spool.append_many(records(2, 3))
+        chunk, pos = spool.read(1000)
+        assert chunk == records(5)
+        spool.commit(pos)
+        assert spool.is_empty()
+        spool.close()
+
+
+def test_eviction(tmp_path):
+    spool = Spool(tmp_path, segment_bytes=1024, max_bytes=4096)
+    spool.append_many(records(200))
+    assert spool.size_bytes <= 4096
+    remaining = spool.read(1000)[0]
+    assert remaining == records(len(remaining), 200 - len(remaining))
+    assert spool.stats['evicted'] == 200 - len(remaining)
+
+    full = Spool(tmp_path / 'none', segment_bytes=1024, max_bytes=4096, eviction=EVICT_NONE)
+    n = full.append_many(records(200))
+    assert n < 200 and full.stats['rejected'] == 200 - n
+    assert full.read(1000)[0] == records(n)
+
+
+def test_corrupted_record(tmp_path):
+    spool = Spool(tmp_path)
+    spool.append_many(records(3))
+    spool.close()
+    segment = next(tmp_path.glob(f'*{SEGMENT_SUFFIX}'))
+    data = bytearray(segment.read_bytes())
+    data[-1] ^= 0xff
+    segment.write_bytes(data)
+    spool = Spool(tmp_path)
+    assert spool.read(10)[0] == records(2)
+    assert spool.stats['corrupted'] == 1
+
+
+def test_pipeline_replays_spool(tmp_path):
+    server = StandInElasticServer()
+    server.close() # database down
+    pipeline = IngestPipeline.__wrapped__(IngestConfig(flush_interval=0.05, max_retries=1, retry_backoff=0.05, spool_path=str(tmp_path)),
+                                          DatabaseConfig(host='127.0.0.1', port=server.port))
+    for i in range(1000): pipeline.submit('machine_logs', document(i))
+    assert pipeline.flush(5)
+    assert pipeline.stats['spooled'] == 1000 and not pipeline.backend_up
+
+    server = StandInElasticServer()
+    pipeline.database.port = server.port # database back
+    deadline = time.monotonic() + 10
+    while not pipeline.spool.is_empty() and time.monotonic() < deadline: time.sleep(0.05)
+    pipeline.stop()
+    server.close()
+    assert pipeline.stats['replayed'] == 1000 and pipeline.stats['dropped'] == 0
+    assert server.documents == 1000
+
+
+def test_pipeline_dead_letters_refused_documents(tmp_path):
+    server = StandInElasticServer(latency=0)
+    server.close() # database down, everything is spooled
+    pipeline = IngestPipeline.__wrapped__(IngestConfig(flush_interval=0.05, max_retries=1, retry_backoff=0.01, spool_path=str(tmp_path), max_replay_attempts=3),
+                                          DatabaseConfig(host='127.0.0.1', port=server.port))
+    docs = [document(i) for i in range(20)]
+    for doc in docs: pipeline.submit('machine_logs', doc)
+    assert pipeline.flush(5)
+
+    server = StandInElasticServer(latency=0)
+    server.refused.add(docs[3]['log'])
+    pipeline.database.port = server.port
+    deadline = time.monotonic() + 10
+    while not pipeline.spool.is_empty() and time.monotonic() < deadline: time.sleep(0.05)
+    pipeline.stop()
+    server.close()
+    assert server.documents == 19 and pipeline.stats['dead_lettered'] == 1
+    entry = json.loads(Spool(tmp_path / 'dead_letter').read(10)[0][0])
+    assert entry[1]['log'] == docs[3]['log'] and entry[2] == 3